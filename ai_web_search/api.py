@@ -0,0 +1,393 @@
+import os
+import json
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+from contextlib import asynccontextmanager
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from .cache import TieredCache
+from .crawler import CRAWL_MODE_FIFO, CRAWL_MODE_BEST
+from .fakes import Fixtures, FakeAssistant, FakeFetcher, FakeSearchBackend
+from .jobs import JobStore, QueueFull, JobLost, DEFAULT_JOB_FILE, JOB_RETENTION, JOB_DONE, JOB_FAILED, JOB_CANCELLED, JOB_QUEUED, FINISHED_STATES
+from .lexical import PREFILTER_OFF, PREFILTER_LOG, PREFILTER_ON
+from .pagestore import PageStore
+from .retrieval import LocalIndex
+from .searcher import SearchEngine, SearchInterface
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# ジョブで指定できる process_search のパラメータと既定値 (query は必須)
+JOB_DEFAULTS = {
+    "keywords_count": 3,
+    "max_depth": 2,
+    "max_threads": 2,
+    "max_articles": 5,
+    "article_quality": 7,
+    "model": "openai/gpt-4o-2024-08-06",
+    "engine": "DuckDuckGo",
+    "crawl_mode": CRAWL_MODE_FIFO,
+    "prefilter": PREFILTER_OFF,
+    "prefilter_threshold": 0.2,
+    "batch_size": 1,
+    "time_limit": None,
+    "prefetch_top_k": 2,
+    "cache_first": False,
+}
+JOB_CHOICES = {
+    "crawl_mode": (CRAWL_MODE_FIFO, CRAWL_MODE_BEST),
+    "prefilter": (PREFILTER_OFF, PREFILTER_LOG, PREFILTER_ON),
+}
+
+# 待ちジョブが無いときに待ち行列を確認する間隔と、実行中のジョブのハートビートの間隔 (秒)
+POLL_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = 2.0
+# SSE で新しいイベントを確認する間隔と、接続維持のコメントを送る間隔 (秒)
+EVENT_POLL_INTERVAL = 0.25
+KEEPALIVE_INTERVAL = 15.0
+# 待ち行列が一杯のときに返す Retry-After (秒)
+RETRY_AFTER = 5
+
+# フェイクのバックエンドで使う遅延 (秒)
+FAKE_LATENCIES = {"search": 0.05, "fetch": 0.05, "llm": 0.2}
+
+
+def parse_job_params(body) -> dict:
+    """リクエストの JSON を検証し、process_search に渡す引数にする (不正なら ValueError)"""
+    if not isinstance(body, dict):
+        raise ValueError("request body must be a JSON object")
+    query = body.get("query")
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError("query is required")
+    unknown = set(body) - set(JOB_DEFAULTS) - {"query"}
+    if unknown:
+        raise ValueError(f"unknown parameters: {', '.join(sorted(unknown))}")
+
+    params = {"query": query.strip()}
+    for name, default in JOB_DEFAULTS.items():
+        value = body.get(name, default)
+        if name == "time_limit":
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+                raise ValueError("time_limit must be a positive number or null")
+        elif isinstance(default, bool):
+            if not isinstance(value, bool):
+                raise ValueError(f"{name} must be a boolean")
+        elif isinstance(default, (int, float)):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{name} must be a number")
+            value = type(default)(value)
+            if value < 0 or (isinstance(default, int) and name != "prefetch_top_k" and value < 1):
+                raise ValueError(f"{name} is out of range")
+        elif not isinstance(value, str):
+            raise ValueError(f"{name} must be a string")
+        if name in JOB_CHOICES and value not in JOB_CHOICES[name]:
+            raise ValueError(f"{name} must be one of {', '.join(JOB_CHOICES[name])}")
+        params[name] = value
+    return params
+
+
+def create_fake_interface_factory(fixtures_path: str = None):
+    """記録済み (または架空) のデータで応答するフェイクの検索・取得・LLM を使う SearchInterface の生成関数
+
+    キャッシュ類は本番のファイルを汚さないように、プロセスごとに作る一時ディレクトリに置く。
+    """
+    fixtures = Fixtures.load(fixtures_path) if fixtures_path else Fixtures.synthetic(60)
+    directory = tempfile.mkdtemp(prefix="ai_web_search_fake_")
+    cache = TieredCache(os.path.join(directory, "web_cache.db"))
+    index = LocalIndex(os.path.join(directory, "local_index.db"))
+    page_store = PageStore(os.path.join(directory, "page_store.db"), index=index)
+    assistant = FakeAssistant(fixtures, FAKE_LATENCIES["llm"])
+    fetcher = FakeFetcher(fixtures, FAKE_LATENCIES["fetch"])
+    backend = FakeSearchBackend(fixtures, FAKE_LATENCIES["search"])
+
+    def factory() -> SearchInterface:
+        return SearchInterface(engine_factory=lambda engine: SearchEngine(
+            engine, fetcher=fetcher, cache=cache, assistant=assistant, search_backend=backend,
+            index=index, page_store=page_store))
+    return factory
+
+
+class JobRunner:
+    """JobStore の待ち行列からジョブを取り出して process_search を実行するワーカー
+
+    API のプロセスごとに1つ動き、最大 concurrency 件のジョブを同時に実行する。
+    """
+
+    def __init__(self, store: JobStore, interface_factory=None, concurrency: int = 2) -> None:
+        self.store = store
+        self.interface_factory = interface_factory or SearchInterface
+        self.concurrency = max(1, concurrency)
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.running = {}
+        self.cancel_requested = set()
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+        self.tasks.append(asyncio.create_task(self.heartbeat()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        for task in self.running.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks, *self.running.values(), return_exceptions=True)
+
+    async def worker(self):
+        while True:
+            try:
+                claimed = await self.store.claim(self.name)
+            except Exception as e:
+                logger.error(f"Failed to claim a job: {str(e)}")
+                claimed = None
+            if claimed is None:
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+            job_id, params = claimed
+            task = asyncio.create_task(self.run_job(job_id, params))
+            self.running[job_id] = task
+            try:
+                # ジョブの中止で worker 自身が止まらないように、完了を待つだけにする
+                await asyncio.wait([task])
+            finally:
+                self.running.pop(job_id, None)
+                self.cancel_requested.discard(job_id)
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                cancelled = await self.store.heartbeat(self.name, list(self.running))
+            except Exception as e:
+                logger.error(f"Failed to update heartbeat: {str(e)}")
+                continue
+            for job_id in cancelled:
+                task = self.running.get(job_id)
+                if task is not None and job_id not in self.cancel_requested:
+                    logger.info(f"Cancel job: {job_id}")
+                    self.cancel_requested.add(job_id)
+                    task.cancel()
+
+    async def run_job(self, job_id: str, params: dict):
+        logger.info(f"Start job: {job_id} ({params['query']})")
+        interface = self.interface_factory()
+        last = None
+        last_result = ""
+        events = interface.process_search(**params)
+        try:
+            async for event in events:
+                last = event
+                # 回答は変わったときだけ保存し、前回の続きなら増えた部分だけを保存する (SSE でも同じ形で送る)
+                result = event.result or ""
+                if result == last_result:
+                    await self.store.add_event(job_id, self.name, event.progress, event.status)
+                elif last_result and result.startswith(last_result):
+                    await self.store.add_event(job_id, self.name, event.progress, event.status, result[len(last_result):], append=True)
+                else:
+                    await self.store.add_event(job_id, self.name, event.progress, event.status, result)
+                last_result = result
+        except JobLost:
+            # ハートビートが途絶えている間に他のワーカーがやり直し始めたので、こちらの実行は捨てる
+            logger.warning(f"Abandon job taken over by another worker: {job_id}")
+            return
+        except asyncio.CancelledError:
+            if job_id in self.cancel_requested:
+                try:
+                    await self.store.add_event(job_id, self.name, 0.0, "検索を中止しました")
+                except JobLost:
+                    pass
+                await self.store.finish(job_id, self.name, JOB_CANCELLED)
+            else:
+                # サーバーの停止で中断したジョブは、他のワーカー (または再起動後) がやり直す
+                await self.store.requeue(job_id, self.name)
+            raise
+        except Exception as e:
+            logger.exception(f"Job failed: {job_id}")
+            await self.store.finish(job_id, self.name, JOB_FAILED, error=str(e))
+            return
+        finally:
+            await events.aclose()
+
+        trace = interface.last_trace.summary() if interface.last_trace is not None else None
+        if last is not None and last.progress >= 1.0:
+            finished = await self.store.finish(job_id, self.name, JOB_DONE, result=last.result, trace=trace)
+        else:
+            finished = await self.store.finish(job_id, self.name, JOB_FAILED, error=last.status if last is not None else None, trace=trace)
+        if finished:
+            logger.info(f"Finish job: {job_id}")
+
+
+def format_sse(event: str, data: dict, id: int = None) -> str:
+    lines = [f"id: {id}"] if id is not None else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+def create_app(
+        store: JobStore = None,
+        interface_factory=None,
+        concurrency: int = None,
+        max_queue: int = None) -> Starlette:
+    """検索ジョブの ASGI アプリを作る (省略した設定は環境変数から読む)
+
+    POST   /jobs              ジョブの受け付け (待ち行列が一杯なら 429)
+    GET    /jobs/{id}         ジョブの状態と結果
+    GET    /jobs/{id}/events  進捗の Server-Sent Events
+    DELETE /jobs/{id}         ジョブの中止
+    GET    /health            待ち行列の状況
+    """
+    store = store or JobStore(os.getenv("API_JOB_DB") or DEFAULT_JOB_FILE, float(os.getenv("API_JOB_RETENTION") or JOB_RETENTION))
+    if interface_factory is None and os.getenv("API_BACKEND") == "fake":
+        interface_factory = create_fake_interface_factory(os.getenv("API_FIXTURES") or None)
+    concurrency = concurrency or int(os.getenv("API_CONCURRENCY") or 2)
+    max_queue = max_queue or int(os.getenv("API_MAX_QUEUE") or 32)
+    runner = JobRunner(store, interface_factory, concurrency)
+
+    async def submit_job(request: Request):
+        try:
+            params = parse_job_params(await request.json())
+        except json.JSONDecodeError:
+            return JSONResponse({"error": "invalid JSON"}, status_code=400)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+        try:
+            job_id = await store.submit(params, max_queue)
+        except QueueFull as e:
+            return JSONResponse({"error": f"queue is full: {str(e)}"}, status_code=429, headers={"Retry-After": str(RETRY_AFTER)})
+        return JSONResponse({
+            "id": job_id,
+            "status": JOB_QUEUED,
+            "result_url": f"/jobs/{job_id}",
+            "events_url": f"/jobs/{job_id}/events",
+        }, status_code=202)
+
+    async def get_job(request: Request):
+        job = await store.get(request.path_params["job_id"])
+        if job is None:
+            return JSONResponse({"error": "job not found"}, status_code=404)
+        return JSONResponse(job)
+
+    async def cancel_job(request: Request):
+        job_id = request.path_params["job_id"]
+        status = await store.cancel(job_id)
+        if status is None:
+            return JSONResponse({"error": "job not found"}, status_code=404)
+        if status in FINISHED_STATES:
+            return JSONResponse({"error": f"job is already {status}"}, status_code=409)
+        return JSONResponse({"id": job_id, "status": JOB_CANCELLED if status == JOB_QUEUED else "cancelling"}, status_code=202)
+
+    async def job_events(request: Request):
+        job_id = request.path_params["job_id"]
+        if await store.get(job_id) is None:
+            return JSONResponse({"error": "job not found"}, status_code=404)
+        try:
+            after = int(request.headers.get("last-event-id") or request.query_params.get("after") or 0)
+        except ValueError:
+            after = 0
+
+        async def stream():
+            nonlocal after
+            idle = 0.0
+            while True:
+                events = await store.events(job_id, after)
+                for id, progress, status, result, append in events:
+                    data = {"progress": progress, "status": status}
+                    if result is not None:
+                        data["delta" if append else "result"] = result
+                    yield format_sse("progress", data, id)
+                    after = id
+                if events:
+                    idle = 0.0
+                    continue
+                job = await store.get(job_id)
+                if job is None or job["status"] in FINISHED_STATES:
+                    # 終了後に書き込まれたイベントを取りこぼさないよう、もう一度確認してから閉じる
+                    if not await store.events(job_id, after):
+                        yield format_sse("end", {"status": job["status"] if job else None, "error": job["error"] if job else None})
+                        return
+                    continue
+                await asyncio.sleep(EVENT_POLL_INTERVAL)
+                idle += EVENT_POLL_INTERVAL
+                if idle >= KEEPALIVE_INTERVAL:
+                    idle = 0.0
+                    yield ": keep-alive\n\n"
+
+        return StreamingResponse(
+            stream(), media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    async def health(request: Request):
+        counts = await store.counts()
+        return JSONResponse({
+            "worker": runner.name,
+            "running": len(runner.running),
+            "concurrency": runner.concurrency,
+            "queued": counts.get(JOB_QUEUED, 0),
+            "max_queue": max_queue,
+            "jobs": counts,
+        })
+
+    @asynccontextmanager
+    async def lifespan(app):
+        runner.start()
+        try:
+            yield
+        finally:
+            await runner.stop()
+
+    app = Starlette(routes=[
+        Route("/jobs", submit_job, methods=["POST"]),
+        Route("/jobs/{job_id}", get_job, methods=["GET"]),
+        Route("/jobs/{job_id}", cancel_job, methods=["DELETE"]),
+        Route("/jobs/{job_id}/events", job_events, methods=["GET"]),
+        Route("/health", health, methods=["GET"]),
+    ], lifespan=lifespan)
+    app.state.store = store
+    app.state.runner = runner
+    return app
+
+
+app = create_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="検索ジョブの HTTP API サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="ワーカープロセス数 (キャッシュとジョブのファイルを共有する)")
+    parser.add_argument("--concurrency", type=int, help="1プロセスあたりの同時実行ジョブ数")
+    parser.add_argument("--max-queue", type=int, help="受け付ける待ちジョブの上限")
+    parser.add_argument("--jobs-db", help="ジョブと進捗イベントを保存する SQLite ファイル")
+    parser.add_argument("--retention-hours", type=float, help="終了したジョブを残しておく時間")
+    parser.add_argument("--fake", action="store_true", help="検索・取得・LLM をフェイクにする (動作確認用)")
+    parser.add_argument("--fixtures", help="--fake で使う Fixtures の JSON (省略時は架空のサイトを生成する)")
+    args = parser.parse_args()
+
+    # ワーカープロセスはモジュールを読み込み直して app を作るので、設定は環境変数で渡す
+    if args.concurrency:
+        os.environ["API_CONCURRENCY"] = str(args.concurrency)
+    if args.max_queue:
+        os.environ["API_MAX_QUEUE"] = str(args.max_queue)
+    if args.jobs_db:
+        os.environ["API_JOB_DB"] = args.jobs_db
+    if args.retention_hours:
+        os.environ["API_JOB_RETENTION"] = str(args.retention_hours * 60 * 60)
+    if args.fake:
+        os.environ["API_BACKEND"] = "fake"
+    if args.fixtures:
+        os.environ["API_FIXTURES"] = args.fixtures
+    uvicorn.run("ai_web_search.api:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
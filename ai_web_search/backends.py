@@ -0,0 +1,267 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import functools
+
+from duckduckgo_search import DDGS
+from duckduckgo_search.exceptions import RatelimitException
+from googleapiclient.discovery import build
+
+from .singleflight import SingleFlight
+from .tracing import span
+from .urlutil import canonicalize_url
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# reciprocal rank fusion の定数 (大きいほど下位の結果の重みが上位に近づく)
+RRF_K = 60
+
+# エンジンごとのリクエスト数の上限 (毎秒の補充数, 連続で送れる数)。プロセス内の全セッションで共有する
+DEFAULT_RATE_LIMITS = {
+    "duckduckgo": (0.5, 3),
+    "google": (5.0, 10),
+}
+
+# 制限を受けたときの再試行 (回数, 初回の待ち時間, 最大の待ち時間)
+MAX_RETRIES = 4
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 60.0
+
+
+def normalize_result(result: dict) -> dict:
+    """検索エンジンごとに異なるキーを {"title", "href", "body"} に揃える"""
+    return {
+        "title": result.get("title", ""),
+        "href": result.get("href", result.get("link", "")),
+        "body": result.get("body", result.get("snippet", "")),
+    }
+
+
+def reciprocal_rank_fusion(result_lists: dict[str, list[dict]], k: int = RRF_K) -> list[dict]:
+    """複数エンジンの検索結果を reciprocal rank fusion で統合し、正規化した URL で重複を除く"""
+    scores = {}
+    merged = {}
+    for name, results in result_lists.items():
+        for rank, result in enumerate(results):
+            key = canonicalize_url(result.get("href", ""))
+            if not key:
+                continue
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank + 1)
+            if key not in merged:
+                merged[key] = {**result, "engines": []}
+            merged[key]["engines"].append(name)
+    return [merged[key] for key in sorted(merged, key=lambda key: -scores[key])]
+
+
+def is_rate_limited(error: Exception) -> bool:
+    """検索エンジンの回数制限によるエラーかどうか"""
+    if isinstance(error, RatelimitException):
+        return True
+    # googleapiclient の HttpError は resp.status に HTTP ステータスを持つ
+    status = getattr(getattr(error, "resp", None), "status", None)
+    return str(status) == "429"
+
+
+class TokenBucket:
+    """毎秒 rate 個補充され、最大 capacity 個まで溜まるトークンバケット"""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        # 先にトークンを予約し (足りなければ負になる)、不足分が補充されるまで待つ
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            try:
+                await asyncio.sleep(-self.tokens / self.rate)
+            except asyncio.CancelledError:
+                self.tokens += 1
+                raise
+
+
+class SearchScheduler:
+    """1つの検索エンジンへのリクエストを調整するクラス
+
+    トークンバケットで送信間隔を制限し、回数制限を受けたらエンジン全体を指数的に待たせてから再試行する。
+    同じ検索語の同時リクエストは1回の呼び出しにまとめる。
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float) -> None:
+        self.name = name
+        self.bucket = TokenBucket(rate, capacity)
+        self.blocked_until = 0.0
+        self.inflight = SingleFlight()
+
+    async def wait_turn(self):
+        while True:
+            delay = self.blocked_until - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        await self.bucket.acquire()
+
+    async def call(self, request, query: str, max_results: int) -> list[dict]:
+        for attempt in range(MAX_RETRIES + 1):
+            await self.wait_turn()
+            try:
+                return await request(query, max_results)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == MAX_RETRIES:
+                    raise
+                # full jitter: 0 から上限までの一様乱数だけ待つ
+                delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+                self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+                logger.warning(f"Rate limited: {self.name} - retry {attempt + 1}/{MAX_RETRIES} in {delay:.1f} 秒")
+
+    async def run(self, request, query: str, max_results: int) -> list[dict]:
+        key = (query.strip().lower(), max_results)
+        if self.inflight.running(key):
+            logger.info(f"Search coalesced: {self.name} - {query}")
+        return list(await self.inflight.run(key, self.call, request, query, max_results))
+
+
+@functools.cache
+def get_scheduler(name: str) -> SearchScheduler:
+    """エンジンごとに1つの SearchScheduler を共有する"""
+    rate, capacity = DEFAULT_RATE_LIMITS.get(name, (1.0, 5))
+    return SearchScheduler(name, rate, capacity)
+
+
+class SearchBackend:
+    """検索バックエンドの基底クラス (インスタンスを (query, max_results) で呼び出す)"""
+
+    name = ""
+
+    async def search(self, query: str, max_results: int) -> list[dict]:
+        raise NotImplementedError
+
+    async def request(self, query: str, max_results: int) -> list[dict]:
+        with span("search_backend", engine=self.name) as s:
+            results = [normalize_result(result) for result in await self.search(query, max_results)][:max_results]
+            s.set(results=len(results))
+            return results
+
+    async def __call__(self, query: str, max_results: int = 3) -> list[dict]:
+        return await get_scheduler(self.name).run(self.request, query, max_results)
+
+
+class DuckDuckGoBackend(SearchBackend):
+    name = "duckduckgo"
+
+    async def search(self, query: str, max_results: int) -> list[dict]:
+        def ddg_search():
+            with DDGS() as ddgs:
+                return list(ddgs.text(
+                    keywords=query,
+                    region='wt-wt',
+                    safesearch='off',
+                    timelimit=None,
+                    max_results=max_results
+                ))
+
+        return await asyncio.get_running_loop().run_in_executor(None, ddg_search)
+
+
+class GoogleBackend(SearchBackend):
+    name = "google"
+
+    async def search(self, query: str, max_results: int) -> list[dict]:
+        def ggl_search():
+            service = build(
+                "customsearch", "v1", developerKey=os.getenv("GOOGLE_SEARCH_API_KEY")
+            )
+
+            res = (
+                service.cse().list(
+                    fields="items(title,snippet,link)",
+                    q=query,
+                    cx=os.getenv("GOOGLE_SEARCH_ENGUINE_ID"),
+                ).execute()
+            )
+
+            return res.get('items', [])
+
+        return await asyncio.get_running_loop().run_in_executor(None, ggl_search)
+
+
+class FederatedBackend(SearchBackend):
+    """複数の検索エンジンに同時に問い合わせて結果を統合するバックエンド
+
+    最初のエンジンが結果を返してから grace 秒だけ他のエンジンを待ち、それ以降に遅れたエンジンは打ち切る。
+    各エンジンは timeout 秒で打ち切るので、遅いエンジンや制限を受けたエンジンが全体の待ち時間を決めない。
+    """
+
+    name = "federated"
+
+    def __init__(self, backends: list[SearchBackend], timeout: float = 10.0, grace: float = 1.0) -> None:
+        self.backends = backends
+        self.timeout = timeout
+        self.grace = grace
+
+    async def search_one(self, backend: SearchBackend, query: str, max_results: int) -> list[dict]:
+        try:
+            return await asyncio.wait_for(backend(query, max_results), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Search timed out: {backend.name} ({self.timeout} 秒)")
+        except Exception as e:
+            logger.warning(f"Search failed: {backend.name} - {str(e)}")
+        return []
+
+    async def search(self, query: str, max_results: int) -> list[dict]:
+        tasks = {asyncio.create_task(self.search_one(backend, query, max_results)): backend.name for backend in self.backends}
+        pending = set(tasks)
+        results = {}
+        try:
+            # 最初に結果を返したエンジンが決まるまで待つ
+            while pending and not any(results.values()):
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    results[tasks[task]] = task.result()
+            if pending:
+                done, pending = await asyncio.wait(pending, timeout=self.grace)
+                for task in done:
+                    results[tasks[task]] = task.result()
+                if pending:
+                    logger.info(f"Search results merged without: {[tasks[task] for task in pending]}")
+        finally:
+            for task in pending:
+                task.cancel()
+        # 統合の順番はエンジンの登録順に揃える
+        return reciprocal_rank_fusion({name: results[name] for name in tasks.values() if name in results})
+
+    async def __call__(self, query: str, max_results: int = 3) -> list[dict]:
+        with span("search_federated") as s:
+            results = (await self.search(query, max_results))[:max_results]
+            s.set(results=len(results))
+            return results
+
+
+def available_backends() -> list[SearchBackend]:
+    """設定済みの検索エンジンのバックエンドを返す"""
+    backends = [DuckDuckGoBackend()]
+    if os.environ.get("GOOGLE_SEARCH_ENGUINE_ID") is not None:
+        backends.append(GoogleBackend())
+    return backends
+
+
+def create_backend(engine: str):
+    """エンジン名 (duckduckgo / google / federated) から検索バックエンドを作る"""
+    engine = engine.strip().lower()
+    if engine == DuckDuckGoBackend.name:
+        return DuckDuckGoBackend()
+    if engine == GoogleBackend.name:
+        return GoogleBackend()
+    if engine == FederatedBackend.name:
+        return FederatedBackend(available_backends())
+    logger.error(f"Unknown search engine: {engine}")
+    return None
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import itertools
+import tracemalloc
+
+from .cache import TieredCache
+from .crawler import CRAWL_MODE_FIFO, CRAWL_MODE_BEST
+from .fakes import Fixtures, FakeAssistant, FakeFetcher, FakeSearchBackend, RecordingAssistant, RecordingFetcher, RecordingSearchBackend
+from .fetcher import get_fetcher
+from .pagestore import PageStore
+from .retrieval import LocalIndex
+from .searcher import SearchEngine, SearchInterface
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# 回帰判定で比較する項目
+REGRESSION_METRICS = ["wall_s", "llm_calls", "fetch_calls", "search_calls"]
+
+
+async def drain(interface: SearchInterface, query: str, params: dict) -> str:
+    """process_search を最後まで実行し、最後のステータスを返す"""
+    status = ""
+    async for event in interface.process_search(query, **params):
+        status = event.status
+    return status
+
+
+async def run_case(fixtures: Fixtures, params: dict, latencies: dict, warm: bool = False) -> list[dict]:
+    """1つのパラメータの組み合わせを (warm=True なら同じキャッシュでもう1回) 実行して計測する"""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        cache = TieredCache(os.path.join(directory, "bench_cache.db"))
+        index = LocalIndex(os.path.join(directory, "bench_index.db"))
+        page_store = PageStore(os.path.join(directory, "bench_pages.db"), index=index)
+        for run in ["cold", "warm"] if warm else ["cold"]:
+            assistant = FakeAssistant(fixtures, latencies["llm"])
+            fetcher = FakeFetcher(fixtures, latencies["fetch"])
+            backend = FakeSearchBackend(fixtures, latencies["search"])
+            interface = SearchInterface(engine_factory=lambda engine: SearchEngine(
+                engine, fetcher=fetcher, cache=cache, assistant=assistant, search_backend=backend, index=index, page_store=page_store))
+            cache.stats.__init__()
+
+            tracemalloc.reset_peak()
+            started = time.perf_counter()
+            status = await drain(interface, fixtures.query, params)
+            wall = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            # 次の実行 (cache-first) で索引を使えるように、裏で追加中のページを待つ
+            await index.wait_pending()
+
+            summary = interface.last_trace.summary()
+            cache_stats = cache.get_stats()
+            results.append({
+                "depth": params["max_depth"],
+                "threads": params["max_threads"],
+                "articles": params["max_articles"],
+                "run": run,
+                "ok": status == "検索完了!",
+                "wall_s": round(wall, 3),
+                "stages": {name: stage["count"] for name, stage in summary["stages"].items()},
+                "search_calls": backend.calls,
+                "fetch_calls": fetcher.calls,
+                "llm_calls": assistant.calls,
+                "cache_hit_rate": round(cache_stats["hit_rate"], 3),
+                "peak_mb": round(peak / 1024 / 1024, 2),
+            })
+    return results
+
+
+async def run_grid(fixtures: Fixtures, grid: dict, base_params: dict, latencies: dict, warm: bool = False) -> list[dict]:
+    results = []
+    tracemalloc.start()
+    try:
+        for depth, threads, articles in itertools.product(grid["depth"], grid["threads"], grid["articles"]):
+            params = {**base_params, "max_depth": depth, "max_threads": threads, "max_articles": articles}
+            for result in await run_case(fixtures, params, latencies, warm):
+                print(format_row(result), flush=True)
+                results.append(result)
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def format_row(result: dict) -> str:
+    stages = " ".join(f"{name}={count}" for name, count in sorted(result["stages"].items()))
+    return (
+        f"depth={result['depth']} threads={result['threads']} articles={result['articles']} {result['run']:<4} "
+        f"{'ok ' if result['ok'] else 'NG '} wall={result['wall_s']:.2f}s "
+        f"search={result['search_calls']} fetch={result['fetch_calls']} llm={result['llm_calls']} "
+        f"hit={result['cache_hit_rate']:.0%} peak={result['peak_mb']:.1f}MB [{stages}]")
+
+
+def case_key(result: dict) -> tuple:
+    return (result["depth"], result["threads"], result["articles"], result["run"])
+
+
+def find_regressions(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """ベースラインより tolerance の割合を超えて悪化した項目を返す"""
+    baseline = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get(case_key(result))
+        if base is None:
+            continue
+        if base["ok"] and not result["ok"]:
+            regressions.append(f"{case_key(result)}: failed")
+        for metric in REGRESSION_METRICS:
+            if result[metric] > base[metric] * (1 + tolerance) and result[metric] - base[metric] > 0.05:
+                regressions.append(f"{case_key(result)}: {metric} {base[metric]} -> {result[metric]}")
+    return regressions
+
+
+async def record(query: str, output: str, model: str, engine: str, params: dict):
+    """実際の検索・取得・LLM を使って1回検索し、その応答を Fixtures として保存する"""
+    fixtures = Fixtures({"query": query})
+
+    def factory(engine_name: str) -> SearchEngine:
+        search_engine = SearchEngine(engine_name, fetcher=RecordingFetcher(get_fetcher(), fixtures), use_llm_cache=False)
+        search_engine.assistant = RecordingAssistant(search_engine.assistant, fixtures)
+        search_engine.search_backend = RecordingSearchBackend(search_engine.search_backend, fixtures)
+        return search_engine
+
+    interface = SearchInterface(engine_factory=factory)
+    status = await drain(interface, query, {**params, "model": model, "engine": engine})
+    fixtures.save(output)
+    print(f"{status} -> {output} ({len(fixtures.searches)} searches, {len(fixtures.pages)} pages)")
+
+
+def parse_ints(value: str) -> list[int]:
+    return [int(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録済みデータを使ったオフラインのベンチマーク")
+    parser.add_argument("--fixtures", help="Fixtures の JSON (省略時は --pages 件の架空のサイトを生成する)")
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--depth", type=parse_ints, default=[1, 2, 3])
+    parser.add_argument("--threads", type=parse_ints, default=[1, 4])
+    parser.add_argument("--articles", type=parse_ints, default=[5, 10])
+    parser.add_argument("--keywords", type=int, default=3)
+    parser.add_argument("--quality", type=int, default=6)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--cache-first", action="store_true", help="手元の索引の記事を先に解析する (--warm と組み合わせて使う)")
+    parser.add_argument("--crawl-mode", choices=[CRAWL_MODE_FIFO, CRAWL_MODE_BEST], default=CRAWL_MODE_BEST)
+    parser.add_argument("--search-latency", type=float, default=0.05)
+    parser.add_argument("--fetch-latency", type=float, default=0.05)
+    parser.add_argument("--llm-latency", type=float, default=0.2)
+    parser.add_argument("--warm", action="store_true", help="同じキャッシュでもう1回実行してキャッシュ有りの場合も計測する")
+    parser.add_argument("--json", help="結果を JSON で保存するパス")
+    parser.add_argument("--baseline", help="比較するベースラインの JSON (悪化していれば終了コード 1)")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--record", help="実際の検索を1回実行して Fixtures をこのパスに保存する")
+    parser.add_argument("--query", help="--record で検索する問い合わせ")
+    parser.add_argument("--model", default="openai/gpt-4o-2024-08-06")
+    parser.add_argument("--engine", default="DuckDuckGo")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    base_params = {
+        "keywords_count": args.keywords,
+        "article_quality": args.quality,
+        "model": "fake-model",
+        "engine": "fake",
+        "crawl_mode": args.crawl_mode,
+        "batch_size": args.batch_size,
+        "cache_first": args.cache_first,
+    }
+
+    if args.record:
+        params = {**base_params, "max_depth": args.depth[0], "max_threads": args.threads[0], "max_articles": args.articles[0]}
+        del params["model"], params["engine"]
+        asyncio.run(record(args.query, args.record, args.model, args.engine, params))
+        return
+
+    fixtures = Fixtures.load(args.fixtures) if args.fixtures else Fixtures.synthetic(args.pages)
+    latencies = {"search": args.search_latency, "fetch": args.fetch_latency, "llm": args.llm_latency}
+    grid = {"depth": args.depth, "threads": args.threads, "articles": args.articles}
+    results = asyncio.run(run_grid(fixtures, grid, base_params, latencies, args.warm))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import os
+import json
+import logging
+import functools
+
+from .lexical import estimate_tokens, select_chunks
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMITS_FILE = "model_limits.json"
+
+DEFAULT_LIMITS = {
+    "context_tokens": 32000,
+    "article_tokens": 6000,
+    "answer_tokens": 8000,
+    "latin_chars_per_token": 4.0,
+    "cjk_tokens_per_char": 1.0,
+}
+
+
+class ModelBudget:
+    """モデルごとのトークン予算 (model_limits.json) を扱うクラス"""
+
+    def __init__(self, path: str = DEFAULT_LIMITS_FILE) -> None:
+        self.limits = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.limits = json.load(f)
+        else:
+            logger.info(f"Model limits file not found: {path}")
+
+    def for_model(self, model: str) -> dict:
+        limits = {**DEFAULT_LIMITS, **self.limits.get("default", {})}
+        if model in self.limits:
+            limits.update(self.limits[model])
+        return limits
+
+    def estimator(self, model: str):
+        """モデルに合わせたトークン数見積もり関数を返す"""
+        limits = self.for_model(model)
+        return functools.partial(
+            estimate_tokens,
+            latin_chars_per_token=limits["latin_chars_per_token"],
+            cjk_tokens_per_char=limits["cjk_tokens_per_char"])
+
+    def estimate(self, text: str, model: str) -> int:
+        return self.estimator(model)(text)
+
+    def answer_budget(self, model: str) -> int:
+        """回答生成に渡す記事の抜粋のトークン数の上限"""
+        limits = self.for_model(model)
+        return min(limits["answer_tokens"], limits["context_tokens"] // 2)
+
+    def fit_article(self, text: str, query: str, model: str) -> tuple[str, int]:
+        """記事を予算内に収め、(収めた本文, 削減したトークン数) を返す"""
+        limits = self.for_model(model)
+        estimate = self.estimator(model)
+        max_tokens = min(limits["article_tokens"], limits["context_tokens"] // 2)
+        fitted = select_chunks(text, query, max_tokens, estimate)
+        if fitted is text:
+            return text, 0
+        saved = estimate(text) - estimate(fitted)
+        logger.info(f"Article trimmed: {saved} tokens saved")
+        return fitted, saved
+
+
+@functools.cache
+def get_budget() -> ModelBudget:
+    return ModelBudget()
@@ -0,0 +1,252 @@
+import time
+import pickle
+import asyncio
+import logging
+import argparse
+import functools
+from typing import Any, Optional
+from collections import OrderedDict
+
+from .sqlitestore import SQLiteStore
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_FILE = "web_cache.db"
+# 容量超過時に1回の問い合わせで削除候補として読む件数
+EVICT_BATCH = 256
+
+# 名前空間ごとの有効期限 (秒)。None は無期限
+DEFAULT_TTLS = {
+    "search": 24 * 60 * 60,
+    "llm": 7 * 24 * 60 * 60,
+    "fingerprint": 7 * 24 * 60 * 60,
+}
+
+
+class CacheStats:
+    """キャッシュのヒット率などの集計"""
+
+    def __init__(self) -> None:
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def to_dict(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+class LRUCache:
+    """件数とバイト数の上限を持つプロセス内 LRU"""
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key) -> Optional[tuple]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, value: Any, size: int, expires_at: Optional[float]):
+        self.delete(key)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size, expires_at)
+        self.total_bytes += size
+        while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            _, (_, old_size, _) = self.entries.popitem(last=False)
+            self.total_bytes -= old_size
+
+    def delete(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+
+class TieredCache(SQLiteStore):
+    """プロセス内 LRU と SQLite 永続層からなる2層キャッシュ
+
+    永続層は名前空間ごとの有効期限を持ち、合計サイズが max_bytes を超えると
+    最終アクセスの古いものから削除する。
+    """
+
+    thread_name = "cache"
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_FILE,
+        ttls: Optional[dict] = None,
+        max_bytes: int = 1024 * 1024 * 1024,
+        memory_entries: int = 2048,
+        memory_bytes: int = 64 * 1024 * 1024
+    ) -> None:
+        super().__init__(path)
+        self.ttls = {**DEFAULT_TTLS, **(ttls or {})}
+        self.max_bytes = max_bytes
+        self.memory = LRUCache(memory_entries, memory_bytes)
+        self.stats = CacheStats()
+        self.total_bytes = None
+
+    def _setup(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def _load_sync(self, namespace: str, key: str, now: float) -> Optional[tuple]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value, size, expires_at FROM cache WHERE namespace = ? AND key = ?",
+            (namespace, key)).fetchone()
+        if row is None:
+            return None
+        value, size, expires_at = row
+        if expires_at is not None and expires_at < now:
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+            conn.commit()
+            self.total_bytes -= size
+            self.stats.expired += 1
+            return None
+        conn.execute("UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+        conn.commit()
+        return value, size, expires_at
+
+    def _save_sync(self, namespace: str, key: str, value: bytes, now: float, expires_at: Optional[float]):
+        conn = self._connect()
+        old = conn.execute("SELECT size FROM cache WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, size, created_at, expires_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (namespace, key, value, len(value), now, expires_at, now))
+        conn.commit()
+        self.total_bytes += len(value) - (old[0] if old else 0)
+        if self.total_bytes > self.max_bytes:
+            self._evict_sync(int(self.max_bytes * 0.9))
+
+    def _delete_sync(self, namespace: str, key: str):
+        conn = self._connect()
+        conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+        conn.commit()
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+
+    def _evict_sync(self, target_bytes: int) -> int:
+        """合計サイズが target_bytes 以下になるまで最終アクセスの古いものから削除する"""
+        conn = self._connect()
+        evicted = 0
+        while self.total_bytes > target_bytes:
+            rows = conn.execute(
+                "SELECT namespace, key, size FROM cache ORDER BY accessed_at LIMIT ?", (EVICT_BATCH,)).fetchall()
+            if not rows:
+                break
+            for namespace, key, size in rows:
+                if self.total_bytes <= target_bytes:
+                    break
+                conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+                self.total_bytes -= size
+                evicted += 1
+        conn.commit()
+        self.stats.evictions += evicted
+        logger.info(f"Cache evicted {evicted} entries ({self.total_bytes} bytes left)")
+        return evicted
+
+    def _compact_sync(self) -> dict:
+        conn = self._connect()
+        now = time.time()
+        expired = conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?", (now,)).rowcount
+        conn.commit()
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        evicted = 0
+        if self.total_bytes > self.max_bytes:
+            evicted = self._evict_sync(int(self.max_bytes * 0.9))
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+        entries = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {"expired": expired, "evicted": evicted, "entries": entries, "bytes": self.total_bytes}
+
+    async def load(self, namespace: str, key: str, defval: Any = None) -> Any:
+        now = time.time()
+        entry = self.memory.get((namespace, key))
+        if entry is not None:
+            value, _, expires_at = entry
+            if expires_at is None or expires_at >= now:
+                self.stats.memory_hits += 1
+                return value
+            self.memory.delete((namespace, key))
+
+        row = await self._run(self._load_sync, namespace, key, now)
+        if row is None:
+            self.stats.misses += 1
+            return defval
+        data, size, expires_at = row
+        value = pickle.loads(data)
+        self.memory.set((namespace, key), value, size, expires_at)
+        self.stats.disk_hits += 1
+        return value
+
+    async def save(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        now = time.time()
+        ttl = ttl if ttl is not None else self.ttls.get(namespace)
+        expires_at = now + ttl if ttl is not None else None
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self.memory.set((namespace, key), value, len(data), expires_at)
+        await self._run(self._save_sync, namespace, key, data, now, expires_at)
+
+    async def delete(self, namespace: str, key: str):
+        self.memory.delete((namespace, key))
+        await self._run(self._delete_sync, namespace, key)
+
+    async def compact(self) -> dict:
+        """期限切れの削除、容量超過分の削除、データベースの最適化を行う"""
+        return await self._run(self._compact_sync)
+
+    def get_stats(self) -> dict:
+        return {**self.stats.to_dict(), "disk_bytes": self.total_bytes, "memory_bytes": self.memory.total_bytes}
+
+
+@functools.cache
+def get_cache() -> TieredCache:
+    return TieredCache()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="検索キャッシュのメンテナンス")
+    parser.add_argument("command", choices=["compact", "stats"])
+    parser.add_argument("--db", default=DEFAULT_CACHE_FILE)
+    parser.add_argument("--max-mb", type=int, default=1024)
+    args = parser.parse_args()
+
+    cache = TieredCache(args.db, max_bytes=args.max_mb * 1024 * 1024)
+    if args.command == "compact":
+        print(await cache.compact())
+    else:
+        await cache._run(cache._connect)
+        print(cache.get_stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
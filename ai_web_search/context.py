@@ -0,0 +1,107 @@
+import logging
+from typing import Callable
+
+from .lexical import tokenize, overlap_score
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# 抜粋のスコアに占める LLM の関連度評価の重み (残りは問い合わせとの語彙の重なり)
+RATING_WEIGHT = 0.7
+# この割合以上のトークンが他の抜粋に含まれていれば重複とみなす
+DUPLICATE_CONTAINMENT = 0.8
+
+
+class Excerpt:
+    def __init__(self, source: int, url: str, text: str, score: float) -> None:
+        self.source = source
+        self.url = url
+        self.text = text
+        self.score = score
+        self.tokens = set(tokenize(text))
+
+
+def collect_excerpts(question: str, articles: list) -> list[Excerpt]:
+    """記事の抜粋をスコアの高い順に並べる"""
+    excerpts = []
+    for source, article in enumerate(articles):
+        items = article.excerpted_articles
+        if isinstance(items, str):
+            items = [items]
+        for item in items or []:
+            text = str(item).strip()
+            if not text:
+                continue
+            rating = min(max(float(article.relevance_rating or 0), 0.0), 10.0) / 10
+            score = rating * RATING_WEIGHT + overlap_score(question, text) * (1 - RATING_WEIGHT)
+            excerpts.append(Excerpt(source, article.url, text, score))
+    excerpts.sort(key=lambda excerpt: -excerpt.score)
+    return excerpts
+
+
+def dedupe_excerpts(excerpts: list[Excerpt]) -> list[Excerpt]:
+    """他の (スコアの高い) 抜粋とほぼ同じ内容の抜粋を除く"""
+    kept = []
+    for excerpt in excerpts:
+        duplicate = False
+        for other in kept:
+            common = len(excerpt.tokens & other.tokens)
+            smaller = min(len(excerpt.tokens), len(other.tokens))
+            if excerpt.text == other.text or (smaller >= 5 and common / smaller >= DUPLICATE_CONTAINMENT):
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(excerpt)
+    return kept
+
+
+def truncate(text: str, max_tokens: int, estimate: Callable[[str], int]) -> str:
+    tokens = estimate(text)
+    if tokens <= max_tokens:
+        return text
+    return text[:max(1, int(len(text) * max_tokens / tokens))] + "…"
+
+
+def build_answer_context(question: str, articles: list, max_tokens: int, estimate: Callable[[str], int]) -> str:
+    """回答生成に渡す記事の抜粋を、予算内に収めて出典番号付きで組み立てる
+
+    1. 抜粋を LLM の関連度評価と問い合わせとの語彙の重なりで順位付けする
+    2. ほぼ同じ内容の抜粋を除く
+    3. まず出典ごとに最も良い抜粋を1つずつ入れ、残りの予算を順位の高い抜粋から埋める
+    4. 出典ごとに [番号] URL と抜粋の箇条書きで出力する
+    """
+    excerpts = dedupe_excerpts(collect_excerpts(question, articles))
+    # 1つの抜粋が予算の大半を占めないように上限を設ける
+    max_excerpt_tokens = max(100, max_tokens // 8)
+
+    selected = []
+    used = 0
+    covered = set()
+    for coverage_round in (True, False):
+        for excerpt in excerpts:
+            if excerpt in selected or (coverage_round and excerpt.source in covered):
+                continue
+            text = truncate(excerpt.text, max_excerpt_tokens, estimate)
+            tokens = estimate(text) + estimate(excerpt.url) if excerpt.source not in covered else estimate(text)
+            if used + tokens > max_tokens:
+                continue
+            excerpt.text = text
+            selected.append(excerpt)
+            covered.add(excerpt.source)
+            used += tokens
+
+    if len(selected) < len(excerpts):
+        logger.info(f"Answer context: {len(selected)} / {len(excerpts)} excerpts, {used} tokens")
+
+    # 出典は最も良い抜粋の順に番号を振る
+    order = []
+    for excerpt in selected:
+        if excerpt.source not in order:
+            order.append(excerpt.source)
+    blocks = []
+    for number, source in enumerate(order, start=1):
+        lines = [f"[{number}] {articles[source].url}"]
+        lines += [f"- {excerpt.text}" for excerpt in selected if excerpt.source == source]
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks)
@@ -0,0 +1,395 @@
+import asyncio
+import itertools
+import logging
+from typing import AsyncGenerator
+
+from .events import ProgressEvent
+from .dedup import DuplicateIndex
+from .lexical import overlap_score, RelevanceGate
+from .tracing import span
+from .urlutil import canonicalize_url, normalize_keyword
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# 探索モード
+CRAWL_MODE_FIFO = "fifo"  # 見つかった順に処理する
+CRAWL_MODE_BEST = "best"  # 有望度の高い順に処理する (best-first)
+
+# 有望度の減衰率 (リスト内の順位ごと / 深さごと)
+RANK_DECAY = 0.85
+DEPTH_DECAY = 0.7
+
+# 先読みで保持する未使用の本文の上限 (バイト)
+PREFETCH_MAX_BYTES = 16 * 1024 * 1024
+
+
+class CrawlTask:
+    """フロンティアに積む作業単位 (キーワード検索 または 記事解析)"""
+
+    SEARCH = "search"
+    ANALYZE = "analyze"
+
+    def __init__(self, kind: str, target: str, keyword: str, depth: int, score: float = 1.0) -> None:
+        self.kind = kind
+        self.target = target
+        self.keyword = keyword
+        self.depth = depth
+        self.score = score
+
+    def priority(self) -> float:
+        """best-first モードでの優先度 (小さいほど先に処理される)"""
+        return -self.score * (DEPTH_DECAY ** (self.depth - 1))
+
+
+class VisitedIndex:
+    """1回の検索実行内で処理済みの URL とキーワードを記録するクラス"""
+
+    def __init__(self) -> None:
+        self.urls = set()
+        self.keywords = set()
+
+    def add_url(self, url: str) -> bool:
+        """未訪問の URL なら記録して True を返す"""
+        key = canonicalize_url(url)
+        if not key or key in self.urls:
+            return False
+        self.urls.add(key)
+        return True
+
+    def add_keyword(self, keyword: str) -> bool:
+        """未検索のキーワードなら記録して True を返す"""
+        key = normalize_keyword(keyword)
+        if not key or key in self.keywords:
+            return False
+        self.keywords.add(key)
+        return True
+
+
+class AnalyzeBatcher:
+    """ワーカーからの記事解析要求を溜めて SearchEngine.analyze_batch でまとめて処理するクラス"""
+
+    def __init__(self, search_engine, question: str, batch_size: int, delay: float = 0.5) -> None:
+        self.search_engine = search_engine
+        self.question = question
+        self.batch_size = batch_size
+        self.delay = delay
+        self.pending = []
+        self.timer = None
+        self.tasks = set()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def analyze(self, url: str, keyword: str, article_text: str):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((url, keyword, article_text, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            # 一定時間内に揃わなければ溜まった分だけで実行する
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        items, self.pending = self.pending, []
+        task = asyncio.create_task(self._run(items))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, items: list[tuple]):
+        try:
+            results = await self.search_engine.analyze_batch(
+                self.question,
+                [(url, keyword, article_text) for url, keyword, article_text, _ in items],
+                max_batch_size=self.batch_size)
+        except Exception as e:
+            for *_, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class Prefetcher:
+    """解析の順番が来る前にページの取得と本文抽出を始めておくクラス
+
+    LLM の解析を待っている間に次の候補の取得を済ませておき、解析の段階で I/O を待たないようにする。
+    同時に先読みする数と、まだ使われていない先読み済み本文の合計バイト数で先読みを制限する。
+    """
+
+    def __init__(self, search_engine, concurrency: int = 4, max_bytes: int = PREFETCH_MAX_BYTES) -> None:
+        self.search_engine = search_engine
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_bytes = max_bytes
+        self.pending_bytes = 0
+        self.tasks = {}
+        self.sizes = {}
+        self.prefetched = 0
+        self.used = 0
+
+    def prefetch(self, url: str):
+        if url in self.tasks or self.pending_bytes >= self.max_bytes:
+            return
+        self.tasks[url] = asyncio.create_task(self._prefetch(url))
+        self.prefetched += 1
+
+    async def _prefetch(self, url: str) -> tuple[str, str]:
+        async with self.semaphore:
+            with span("prefetch", url=url):
+                final_url, text = await self.search_engine.fetch_page(url)
+        if url in self.tasks and text:
+            self.sizes[url] = len(text.encode("utf-8"))
+            self.pending_bytes += self.sizes[url]
+        return final_url, text
+
+    async def fetch_page(self, url: str) -> tuple[str, str]:
+        """先読み済み (または先読み中) ならその結果を、そうでなければ取得して返す"""
+        task = self.tasks.pop(url, None)
+        if task is None:
+            return await self.search_engine.fetch_page(url)
+        self.used += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.pending_bytes -= self.sizes.pop(url, 0)
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+
+
+class Crawler:
+    """(キーワード|URL, 深さ) のフロンティアを複数のワーカーで並列に処理するクラス"""
+
+    def __init__(
+        self,
+        search_engine,
+        question: str,
+        max_depth: int,
+        max_threads: int,
+        max_articles: int,
+        article_quality: int,
+        mode: str = CRAWL_MODE_FIFO,
+        relevance_gate: RelevanceGate = None,
+        batch_size: int = 1,
+        time_limit: float = None,
+        prefetch_top_k: int = 2,
+        prefetch_concurrency: int = 4,
+        duplicate_threshold: float = 0.8
+    ) -> None:
+        self.search_engine = search_engine
+        self.question = question
+        self.max_depth = max_depth
+        self.max_threads = max(1, max_threads)
+        self.max_articles = max_articles
+        self.article_quality = article_quality
+        self.mode = mode
+        self.articles = []
+        self.tokens_saved = 0
+        self.prefilter_skipped = 0
+        # 転載・ミラーなど内容がほぼ同じ記事は LLM に送らない
+        self.duplicates = DuplicateIndex(duplicate_threshold)
+        self.duplicates_skipped = 0
+        self.relevance_gate = relevance_gate or RelevanceGate()
+        self.batcher = AnalyzeBatcher(search_engine, question, batch_size) if batch_size > 1 else None
+        self.time_limit = time_limit
+        # 検索結果と関連リンクの上位 prefetch_top_k 件は、順番が来る前に取得を始める
+        self.prefetch_top_k = prefetch_top_k
+        self.prefetcher = Prefetcher(search_engine, prefetch_concurrency)
+        self.stop_reason = None
+        # cache-first で手元の索引から解析した候補数と、そこから採用した記事数
+        self.local_candidates = 0
+        self.local_articles = 0
+        self.local_phase = False
+        self.visited = VisitedIndex()
+        self.frontier = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.events = asyncio.Queue()
+
+    def is_full(self) -> bool:
+        return len(self.articles) >= self.max_articles
+
+    def progress(self, base: float) -> float:
+        return base + (len(self.articles) / self.max_articles / 2)
+
+    def stop(self, reason: str):
+        """探索を打ち切る (実行中の取得・解析は run() の終了時にキャンセルされる)"""
+        if self.stop_reason is not None:
+            return
+        self.stop_reason = reason
+        logger.info(f"Crawl stopped: {reason}")
+        self.events.put_nowait(ProgressEvent(self.progress(0.3), reason))
+        self.events.put_nowait(None)
+
+    def push(self, task: CrawlTask, prefetch: bool = False):
+        if task.depth > self.max_depth:
+            return
+        if self.is_full():
+            return
+        if task.kind == CrawlTask.SEARCH:
+            if not self.visited.add_keyword(task.target):
+                return
+        elif not self.visited.add_url(task.target):
+            return
+        # fifo モードでは優先度を揃えて投入順に処理する
+        priority = task.priority() if self.mode == CRAWL_MODE_BEST else 0.0
+        self.frontier.put_nowait((priority, next(self.sequence), task))
+        if prefetch and task.kind == CrawlTask.ANALYZE:
+            self.prefetcher.prefetch(task.target)
+
+    async def emit(self, base: float, status: str):
+        await self.events.put(ProgressEvent(self.progress(base), status))
+
+    async def run_search(self, task: CrawlTask):
+        await self.emit(0.2, f"検索中: {task.target} (深さ: {task.depth})")
+
+        results = await self.search_engine.search(task.target)
+
+        await self.emit(0.2, f"検索完了: {task.target} - {len(results)}件の結果")
+
+        for rank, search_result in enumerate(results):
+            url = search_result.get('href', search_result.get('link', ""))
+            # 検索結果のタイトルと抜粋から有望度を事前に見積もる
+            snippet = f"{search_result.get('title', '')} {search_result.get('body', search_result.get('snippet', ''))}"
+            pre_score = overlap_score(f"{self.question} {task.target}", snippet)
+            score = task.score * (RANK_DECAY ** rank) * 0.5 + pre_score * 0.5
+            self.push(CrawlTask(CrawlTask.ANALYZE, url, task.target, task.depth + 1, score), prefetch=rank < self.prefetch_top_k)
+
+    async def run_analyze(self, task: CrawlTask):
+        url = task.target
+        await self.emit(0.3, f"記事を解析中: {url} (深さ: {task.depth})")
+
+        try:
+            final_url, article_text = await self.prefetcher.fetch_page(url)
+            # リダイレクト先が既に解析済み (または解析中) なら LLM には送らない
+            if canonicalize_url(final_url) != canonicalize_url(url) and not self.visited.add_url(final_url):
+                logger.info(f"Skip duplicate: {url} -> {final_url}")
+                await self.emit(0.3, f"解析済みの記事のためスキップ: {url}")
+                return
+            # トークンが1つも取れない本文は署名が無いので、重複の確認をせずに解析する
+            signature = await self.search_engine.fingerprint(article_text) if article_text else None
+            if signature is not None:
+                duplicate = self.duplicates.find(signature)
+                if duplicate is not None:
+                    self.duplicates_skipped += 1
+                    logger.info(f"Skip near-duplicate: {url} ~ {duplicate[0]} ({duplicate[1]:.2f})")
+                    await self.emit(0.3, f"内容が重複している記事のためスキップ: {url} (類似: {duplicate[0]})")
+                    return
+                self.duplicates.add(url, signature)
+            pre_score = None
+            if article_text and self.relevance_gate.enabled:
+                passed, pre_score = self.relevance_gate.check(article_text, f"{self.question} {task.keyword}")
+                if not passed:
+                    self.prefilter_skipped += 1
+                    await self.emit(0.3, f"関連度が低いためスキップ: {url} (事前スコア {pre_score:.2f})")
+                    return
+            if self.batcher is not None and article_text is not None:
+                analyzed_url = await self.batcher.analyze(url, task.keyword, article_text)
+            else:
+                analyzed_url = await self.search_engine.analyze(self.question, url, task.keyword, article_text=article_text)
+        except Exception as e:
+            logger.error(f"記事の解析でエラーが発生: {str(e)}")
+            await self.emit(0.3, f"記事の解析エラー: {url} - {str(e)}")
+            return
+
+        if analyzed_url is None:
+            logger.error(f"url none: {url}")
+            await self.emit(0.3, f"記事の解析失敗: {url}")
+            return
+
+        self.tokens_saved += analyzed_url.tokens_saved
+        if pre_score is not None:
+            # しきい値調整用に事前スコアと LLM の評価を並べて記録する
+            logger.info(f"Prefilter calibration: score={pre_score:.3f} rating={analyzed_url.relevance_rating} url={url}")
+        if analyzed_url.relevance_rating >= self.article_quality and not self.is_full():
+            self.articles.append(analyzed_url)
+            if self.local_phase:
+                self.local_articles += 1
+        await self.emit(0.3, f"記事の解析完了: {url}\nスコア ( {analyzed_url.relevance_rating} / 10 )")
+        if self.is_full():
+            self.stop("参照記事数に達したため探索を終了します")
+            return
+
+        parent_score = analyzed_url.relevance_rating / 10
+        for rank, keyword in enumerate(analyzed_url.keywords):
+            self.push(CrawlTask(CrawlTask.SEARCH, keyword, keyword, task.depth + 1, parent_score * (RANK_DECAY ** rank)))
+        for rank, link in enumerate(analyzed_url.related_links):
+            self.push(
+                CrawlTask(CrawlTask.ANALYZE, link, task.keyword, task.depth + 1, parent_score * (RANK_DECAY ** rank)),
+                prefetch=rank < self.prefetch_top_k)
+
+    async def worker(self):
+        while True:
+            _, _, task = await self.frontier.get()
+            try:
+                # 記事数が上限に達した後のタスクは読み捨てる
+                if self.is_full():
+                    continue
+                if task.kind == CrawlTask.SEARCH:
+                    await self.run_search(task)
+                else:
+                    await self.run_analyze(task)
+            except Exception as e:
+                logger.error(f"クロール処理でエラーが発生: {str(e)}")
+                await self.emit(0.2, f"処理エラー: {task.target} - {str(e)}")
+            finally:
+                self.frontier.task_done()
+
+    async def close_when_done(self, keywords: list[str]):
+        if self.local_phase:
+            await self.frontier.join()
+            self.local_phase = False
+            await self.emit(0.3, f"手元の記事から {self.local_articles} 件を採用しました。不足分を Web で検索します")
+        for keyword in keywords:
+            self.push(CrawlTask(CrawlTask.SEARCH, keyword, keyword, 1))
+        await self.frontier.join()
+        await self.events.put(None)
+
+    async def run(self, keywords: list[str], local_urls: list[str] = None) -> AsyncGenerator[ProgressEvent, None]:
+        """初期キーワードからクロールを開始し、進捗イベントを順に返す
+
+        local_urls (手元の索引から見つけた記事) を指定すると、先にそれらだけを解析し、
+        max_articles に届かなかったときだけキーワードでの Web 検索に進む。
+        """
+        for rank, url in enumerate(local_urls or []):
+            # 手元の記事からは関連リンクやキーワードをたどらない (Web 検索は不足時にまとめて行う)
+            self.push(CrawlTask(CrawlTask.ANALYZE, url, self.question, self.max_depth, RANK_DECAY ** rank))
+        self.local_candidates = self.frontier.qsize()
+        self.local_phase = self.local_candidates > 0
+
+        tasks = [asyncio.create_task(self.worker()) for _ in range(self.max_threads)]
+        tasks.append(asyncio.create_task(self.close_when_done(keywords)))
+        deadline = None
+        if self.time_limit:
+            deadline = asyncio.get_running_loop().call_later(
+                self.time_limit, self.stop, f"制限時間 ({self.time_limit} 秒) に達したため探索を打ち切りました")
+        try:
+            while True:
+                event = await self.events.get()
+                if event is None:
+                    break
+                yield event
+        finally:
+            # 記事数の上限・制限時間・呼び出し元の切断のいずれでも、実行中の取得と解析を止める
+            if deadline is not None:
+                deadline.cancel()
+            if self.batcher is not None:
+                self.batcher.cancel()
+            self.prefetcher.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
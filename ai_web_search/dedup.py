@@ -0,0 +1,97 @@
+import zlib
+import logging
+from typing import Optional
+
+from .lexical import tokenize
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# MinHash の設定 (署名の長さ = BANDS * ROWS)
+BANDS = 16
+ROWS = 4
+NUM_BINS = BANDS * ROWS
+SHINGLE_SIZE = 4
+# 署名の計算に使う本文の最大文字数
+MAX_FINGERPRINT_CHARS = 50000
+
+# 署名はキャッシュに保存してプロセスをまたいで使うので、Python の hash() ではなく固定の関数で作る
+MIX = 0x9E3779B97F4A7C15
+MASK64 = (1 << 64) - 1
+BIN_SHIFT = 64 - (NUM_BINS - 1).bit_length()
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> set[int]:
+    """トークン列の size-gram をハッシュ値の集合にする"""
+    tokens = tokenize(text[:MAX_FINGERPRINT_CHARS])
+    if len(tokens) < size:
+        return {zlib.crc32(" ".join(tokens).encode())} if tokens else set()
+    return {zlib.crc32(" ".join(tokens[i:i + size]).encode()) for i in range(len(tokens) - size + 1)}
+
+
+def minhash(text: str) -> Optional[tuple[int, ...]]:
+    """本文の MinHash 署名を返す (本文が空なら None)
+
+    One Permutation Hashing: ハッシュ値の上位ビットで NUM_BINS 個のビンに振り分けて各ビンの最小値を取る。
+    ハッシュ関数を NUM_BINS 回適用する通常の MinHash と違い、shingle 1つあたりの計算が1回で済む。
+    """
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    bins = [None] * NUM_BINS
+    low_mask = (1 << BIN_SHIFT) - 1
+    for value in hashes:
+        value = (value * MIX) & MASK64
+        index = value >> BIN_SHIFT
+        value &= low_mask
+        if bins[index] is None or value < bins[index]:
+            bins[index] = value
+    # 空のビンは右隣 (循環) の空でないビンの値で埋める
+    filled = [index for index, value in enumerate(bins) if value is not None]
+    for index in range(NUM_BINS):
+        if bins[index] is None:
+            source = next((other for other in filled if other > index), filled[0])
+            bins[index] = bins[source] + NUM_BINS + (source - index) % NUM_BINS
+    return tuple(bins)
+
+
+def similarity(left: tuple, right: tuple) -> float:
+    """2つの署名から Jaccard 係数を推定する"""
+    return sum(1 for x, y in zip(left, right) if x == y) / len(left)
+
+
+class DuplicateIndex:
+    """MinHash 署名の LSH 索引で、内容がほぼ同じ記事を探すクラス
+
+    署名を BANDS 個の帯に分け、どれかの帯が一致した候補だけを推定 Jaccard 係数で確かめる。
+    """
+
+    def __init__(self, threshold: float = 0.8) -> None:
+        self.threshold = threshold
+        self.signatures = {}
+        self.buckets = {}
+
+    def bands(self, signature: tuple) -> list[tuple]:
+        return [(band, signature[band * ROWS:(band + 1) * ROWS]) for band in range(BANDS)]
+
+    def find(self, signature: Optional[tuple]) -> Optional[tuple[str, float]]:
+        """threshold 以上に似ている登録済みの記事を (キー, 類似度) で返す (署名が None なら探さない)"""
+        if signature is None:
+            return None
+        candidates = set()
+        for band in self.bands(signature):
+            candidates.update(self.buckets.get(band, ()))
+        best = None
+        for key in candidates:
+            score = similarity(signature, self.signatures[key])
+            if score >= self.threshold and (best is None or score > best[1]):
+                best = (key, score)
+        return best
+
+    def add(self, key: str, signature: Optional[tuple]):
+        if signature is None:
+            return
+        self.signatures[key] = signature
+        for band in self.bands(signature):
+            self.buckets.setdefault(band, set()).add(key)
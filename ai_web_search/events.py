@@ -0,0 +1,88 @@
+import time
+import asyncio
+from collections import deque
+from typing import NamedTuple, AsyncGenerator
+
+
+class ProgressEvent(NamedTuple):
+    """process_search が返す進捗イベント (progress, status, result のタプルとしても扱える)"""
+    progress: float
+    status: str
+    result: str = ""
+
+
+class StatusLog:
+    """直近 max_lines 行だけを保持するステータスログ"""
+
+    def __init__(self, max_lines: int = 200) -> None:
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+        self._text = ""
+
+    def append(self, status: str) -> bool:
+        if not status or (self.lines and self.lines[-1] == status):
+            return False
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(status)
+        self._text = None
+        return True
+
+    def text(self) -> str:
+        if self._text is None:
+            text = "\n".join(self.lines)
+            if self.dropped:
+                text = f"... ({self.dropped} 行省略)\n" + text
+            self._text = text
+        return self._text
+
+
+async def coalesce(source: AsyncGenerator, interval: float) -> AsyncGenerator[list, None]:
+    """イベントを溜めて、最大でも interval 秒に1回のまとまりとして返す
+
+    最初のイベントはすぐに返し、以降は前回から interval 秒経つまでに届いたイベントをまとめる。
+    受け手が途中で止めた場合は source 側の処理もキャンセルする。
+    """
+    queue = asyncio.Queue()
+    finished = object()
+
+    async def pump():
+        try:
+            async for event in source:
+                await queue.put(event)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(finished)
+
+    task = asyncio.create_task(pump())
+    last_yield = float("-inf")
+    done = False
+    try:
+        while not done:
+            event = await queue.get()
+            if event is finished:
+                break
+            batch = [event]
+            while True:
+                timeout = last_yield + interval - time.monotonic()
+                try:
+                    if timeout > 0:
+                        event = await asyncio.wait_for(queue.get(), timeout)
+                    else:
+                        event = queue.get_nowait()
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                if event is finished:
+                    done = True
+                    break
+                batch.append(event)
+
+            errors = [event for event in batch if isinstance(event, Exception)]
+            if errors:
+                raise errors[0]
+            yield batch
+            last_yield = time.monotonic()
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
@@ -0,0 +1,85 @@
+import os
+import asyncio
+import logging
+import functools
+from typing import Optional
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import trafilatura
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+
+def extract_markdown(data: bytes, url: str) -> Optional[str]:
+    """HTML (UTF-8 バイト列) から本文をメタデータ付きの markdown として抽出する"""
+    return trafilatura.extract(
+        data.decode("utf-8", errors="replace"),
+        url=url,
+        include_comments=True,
+        output_format="markdown",
+        include_tables=True,
+        include_images=False,
+        include_formatting=False,
+        include_links=True,
+        deduplicate=False,
+        with_metadata=True)
+
+
+class Extractor:
+    """本文抽出を実行するクラス
+
+    workers が 1 以上の場合は大きな文書の抽出をプロセスプールで並列に実行し、
+    GIL による直列化とイベントループとの競合を避ける。小さな文書はスレッドで処理する。
+    """
+
+    def __init__(self, workers: int = 0, queue_size: int = None, min_process_size: int = 64 * 1024) -> None:
+        self.workers = max(0, workers)
+        self.min_process_size = min_process_size
+        # プロセスプールへ同時に投入できる件数 (超えた分は空きが出るまで待つ)
+        self.queue_size = queue_size or self.workers * 2
+        self._pool = None
+        self._slots = None
+        self._loop = None
+
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._loop is not loop:
+            self._slots = asyncio.Semaphore(self.queue_size)
+            self._loop = loop
+        return self._slots
+
+    async def extract(self, html: str, url: str) -> Optional[str]:
+        if html is None:
+            return None
+        data = html.encode("utf-8", errors="replace")
+        loop = asyncio.get_running_loop()
+
+        if self.workers == 0 or len(data) < self.min_process_size:
+            return await loop.run_in_executor(None, extract_markdown, data, url)
+
+        async with self.slots():
+            try:
+                return await loop.run_in_executor(self.pool(), extract_markdown, data, url)
+            except BrokenProcessPool:
+                logger.error("Extractor process pool is broken, falling back to thread")
+                self._pool = None
+                return await loop.run_in_executor(None, extract_markdown, data, url)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+@functools.cache
+def get_extractor() -> Extractor:
+    """ワーカー数は EXTRACT_PROCESS_WORKERS で指定する"""
+    return Extractor(workers=int(os.getenv("EXTRACT_PROCESS_WORKERS") or 0))
@@ -0,0 +1,293 @@
+import re
+import copy
+import json
+import random
+import asyncio
+import hashlib
+import logging
+from html import escape
+from typing import Optional
+
+from .fetcher import FetchResult
+from .lexical import overlap_score
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+URL_LINE_PATTERN = re.compile(r"^URL: (\S+)$", re.MULTILINE)
+
+
+def prompt_urls(system: str, message: str) -> list[str]:
+    """記事解析のプロンプトに含まれる記事の URL を順に返す"""
+    return list(dict.fromkeys(URL_LINE_PATTERN.findall(f"{system}\n{message}")))
+
+
+SYNTHETIC_VOCABULARY = [
+    "python", "asyncio", "crawler", "cache", "index", "search", "ranking", "token",
+    "parser", "markdown", "latency", "throughput", "sqlite", "compression", "fetch", "prompt",
+    "embedding", "scheduler", "budget", "excerpt", "queue", "worker", "session", "trace",
+]
+
+
+class Fixtures:
+    """検索結果・HTML・LLM の応答を記録したデータ (ベンチマークと動作確認用)
+
+    形式:
+        {"query": str,
+         "keyword_analysis": {...analyze_keyword の応答...},
+         "search": {キーワード: [検索結果, ...]},
+         "pages": {URL: {"title": str, "html": str, "analysis": {...analyze の応答...}, "keywords": [...], "links": [...]}},
+         "answer": str}
+    """
+
+    def __init__(self, data: Optional[dict] = None) -> None:
+        data = data or {}
+        self.query = data.get("query", "")
+        self.keyword_analysis = data.get("keyword_analysis", {})
+        self.searches = data.get("search", {})
+        self.pages = data.get("pages", {})
+        self.answer = data.get("answer", "")
+
+    @classmethod
+    def load(cls, path: str) -> "Fixtures":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def to_dict(self) -> dict:
+        return {
+            "query": self.query,
+            "keyword_analysis": self.keyword_analysis,
+            "search": self.searches,
+            "pages": self.pages,
+            "answer": self.answer,
+        }
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=1)
+
+    @classmethod
+    def synthetic(cls, pages: int = 60, links_per_page: int = 4, paragraphs: int = 8, seed: int = 0) -> "Fixtures":
+        """リンクで相互につながった架空のサイト群を生成する"""
+        rng = random.Random(seed)
+        urls = [f"https://bench{index % 7}.example.com/articles/{index}" for index in range(pages)]
+        data = {"pages": {}, "search": {}}
+        for index, url in enumerate(urls):
+            keywords = rng.sample(SYNTHETIC_VOCABULARY, 3)
+            title = " ".join(keywords).title()
+            links = rng.sample([other for other in urls if other != url], min(links_per_page, pages - 1))
+            body = "".join(
+                f"<p>{' '.join(rng.choice(keywords + SYNTHETIC_VOCABULARY) for _ in range(60))}.</p>"
+                for _ in range(paragraphs))
+            anchors = "".join(f'<li><a href="{escape(link)}">{escape(link)}</a></li>' for link in links)
+            data["pages"][url] = {
+                "title": title,
+                "keywords": keywords,
+                "links": links,
+                "html": f"<html><head><title>{escape(title)}</title></head><body><article><h1>{escape(title)}</h1>{body}<ul>{anchors}</ul></article></body></html>",
+            }
+        words = rng.sample(SYNTHETIC_VOCABULARY, 4)
+        data["query"] = " ".join(words[:2])
+        data["keyword_analysis"] = {
+            "fulltext question": f"{words[0]} と {words[1]} について教えてください",
+            "search words": words[:3],
+            "search words english translation": words[1:],
+        }
+        data["answer"] = "# 回答\n\n" + "\n\n".join(f"- {word} についての説明です。" for word in words)
+        return cls(data)
+
+    def search(self, query: str, max_results: int = 3) -> list[dict]:
+        """記録済みの検索結果を返す (未記録のキーワードはページとの語彙の重なりで順位付けする)"""
+        if query in self.searches:
+            return copy.deepcopy(self.searches[query][:max_results])
+        scored = []
+        for url, page in self.pages.items():
+            score = overlap_score(query, f"{page.get('title', '')} {' '.join(page.get('keywords', []))}")
+            if score > 0:
+                scored.append((-score, url))
+        scored.sort()
+        return [
+            {"title": self.pages[url].get("title", ""), "href": url, "body": " ".join(self.pages[url].get("keywords", []))}
+            for _, url in scored[:max_results]]
+
+    def analysis(self, url: str) -> dict:
+        """記録済みの解析結果を返す (未記録の場合はページ情報から決定的に作る)"""
+        page = self.pages.get(url, {})
+        if "analysis" in page:
+            return copy.deepcopy(page["analysis"])
+        rating = 4 + int(hashlib.sha256(url.encode()).hexdigest(), 16) % 7
+        return {
+            "Relevance rating": rating,
+            "Related links to explore": page.get("links", [])[:3],
+            "Keywords to research": page.get("keywords", [])[:3],
+            "Excerpted articles": [f"{page.get('title', url)} の抜粋"],
+        }
+
+
+class CallCounter:
+    """フェイクの呼び出し回数と、模擬遅延を扱う基底クラス"""
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        # 実行ごとに複製されても (pin_model) 回数は元のインスタンスと共有する
+        self.counter = {"calls": 0}
+
+    @property
+    def calls(self) -> int:
+        return self.counter["calls"]
+
+    async def wait(self):
+        self.counter["calls"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeModelManager:
+    def __init__(self, model: str = "fake-model") -> None:
+        self.model = model
+
+    def get_current_model(self) -> str:
+        return self.model
+
+    def change_model(self, model: str):
+        self.model = model
+
+
+class FakeAssistant(CallCounter):
+    """記録済みの応答を返す ChatAssistant の代替"""
+
+    def __init__(self, fixtures: Fixtures, latency: float = 0.0, stream_chunks: int = 20) -> None:
+        super().__init__(latency)
+        self.fixtures = fixtures
+        self.model_manager = FakeModelManager()
+        self.stream_chunks = stream_chunks
+
+    def respond(self, system: str, message: str, json_mode: bool):
+        if not json_mode:
+            return self.fixtures.answer
+        if "fulltext question" in system:
+            return copy.deepcopy(self.fixtures.keyword_analysis)
+        urls = prompt_urls(system, message)
+        if len(urls) == 1:
+            return self.fixtures.analysis(urls[0])
+        return [{"URL": url, **self.fixtures.analysis(url)} for url in urls]
+
+    async def chat(self, system: str = "", message: str = "", use_cache: bool = True, json_mode: bool = False, chat_log=None):
+        await self.wait()
+        return self.respond(system, message, json_mode)
+
+    async def chat_stream(self, system: str = "", message: str = "", chat_log=None, use_cache: bool = True, json_mode: bool = False):
+        await self.wait()
+        result = self.respond(system, message, json_mode)
+        size = max(1, len(result) // self.stream_chunks)
+        for index in range(0, len(result), size):
+            await asyncio.sleep(0)
+            yield result[index:index + size]
+
+
+class FakeFetcher(CallCounter):
+    """記録済みの HTML を返す Fetcher の代替"""
+
+    def __init__(self, fixtures: Fixtures, latency: float = 0.0) -> None:
+        super().__init__(latency)
+        self.fixtures = fixtures
+
+    async def fetch(self, url: str, headers: Optional[dict] = None) -> Optional[FetchResult]:
+        await self.wait()
+        page = self.fixtures.pages.get(url)
+        if page is None or "html" not in page:
+            return FetchResult(url, url, 404, {}, b"")
+        body = page["html"].encode("utf-8")
+        # 条件付きリクエストの再検証を再現するため、本文のハッシュを ETag として返す
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if (headers or {}).get("If-None-Match") == etag:
+            return FetchResult(url, url, 304, {"etag": etag}, b"")
+        return FetchResult(url, url, 200, {"content-type": "text/html; charset=utf-8", "etag": etag}, body, "utf-8")
+
+    async def close(self):
+        pass
+
+
+class FakeSearchBackend(CallCounter):
+    """記録済みの検索結果を返す検索バックエンド"""
+
+    def __init__(self, fixtures: Fixtures, latency: float = 0.0) -> None:
+        super().__init__(latency)
+        self.fixtures = fixtures
+
+    async def __call__(self, query: str, max_results: int = 3) -> list[dict]:
+        await self.wait()
+        return self.fixtures.search(query, max_results)
+
+
+class RecordingAssistant:
+    """実際の ChatAssistant の応答を Fixtures に記録するラッパー"""
+
+    def __init__(self, assistant, fixtures: Fixtures) -> None:
+        self.assistant = assistant
+        self.fixtures = fixtures
+
+    # モデル設定は記録元の assistant のものを使う
+    @property
+    def model_manager(self):
+        return self.assistant.model_manager
+
+    @model_manager.setter
+    def model_manager(self, model_manager):
+        self.assistant.model_manager = model_manager
+
+    def __copy__(self):
+        return RecordingAssistant(copy.copy(self.assistant), self.fixtures)
+
+    def record(self, system: str, message: str, json_mode: bool, result):
+        if not json_mode:
+            self.fixtures.answer = result
+        elif "fulltext question" in system:
+            self.fixtures.keyword_analysis = result
+        else:
+            urls = prompt_urls(system, message)
+            entries = result if isinstance(result, list) else [dict(result, URL=urls[0])] if len(urls) == 1 else []
+            for entry in entries:
+                if isinstance(entry, dict) and entry.get("URL") in urls:
+                    analysis = {key: value for key, value in entry.items() if key != "URL"}
+                    self.fixtures.pages.setdefault(entry["URL"], {})["analysis"] = analysis
+
+    async def chat(self, system: str = "", message: str = "", use_cache: bool = True, json_mode: bool = False, chat_log=None):
+        result = await self.assistant.chat(system, message, use_cache=use_cache, json_mode=json_mode)
+        self.record(system, message, json_mode, result)
+        return result
+
+    async def chat_stream(self, system: str = "", message: str = "", chat_log=None, use_cache: bool = True, json_mode: bool = False):
+        result = ""
+        async for chunk in self.assistant.chat_stream(system, message, use_cache=use_cache, json_mode=json_mode):
+            result += chunk
+            yield chunk
+        self.record(system, message, json_mode, result)
+
+
+class RecordingFetcher:
+    """実際の Fetcher の取得結果を Fixtures に記録するラッパー"""
+
+    def __init__(self, fetcher, fixtures: Fixtures) -> None:
+        self.fetcher = fetcher
+        self.fixtures = fixtures
+
+    async def fetch(self, url: str, headers: Optional[dict] = None) -> Optional[FetchResult]:
+        response = await self.fetcher.fetch(url, headers=headers)
+        if response is not None and response.status == 200 and response.body:
+            self.fixtures.pages.setdefault(url, {})["html"] = response.html
+        return response
+
+
+class RecordingSearchBackend:
+    """検索結果を Fixtures に記録する検索バックエンドのラッパー"""
+
+    def __init__(self, backend, fixtures: Fixtures) -> None:
+        self.backend = backend
+        self.fixtures = fixtures
+
+    async def __call__(self, query: str, max_results: int = 3) -> list[dict]:
+        results = await self.backend(query, max_results)
+        self.fixtures.searches[query] = results
+        return results
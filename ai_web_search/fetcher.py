@@ -0,0 +1,187 @@
+import re
+import time
+import asyncio
+import logging
+import functools
+from typing import Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+try:
+    from charset_normalizer import from_bytes
+except ImportError:
+    from_bytes = None
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36"
+
+# 本文の抽出対象とする Content-Type
+TEXT_CONTENT_TYPES = ("html", "xml", "text/plain")
+
+META_CHARSET_PATTERN = re.compile(rb"""<meta[^>]+charset=["']?\s*([a-zA-Z0-9_\-]+)""", re.IGNORECASE)
+
+
+def detect_charset(body: bytes, header_charset: Optional[str] = None) -> str:
+    """HTTP ヘッダ、meta タグ、バイト列の内容の順に文字コードを推定する"""
+    candidates = []
+    if header_charset:
+        candidates.append(header_charset)
+    match = META_CHARSET_PATTERN.search(body[:4096])
+    if match:
+        candidates.append(match.group(1).decode("ascii", errors="ignore"))
+    candidates.append("utf-8")
+
+    for charset in candidates:
+        try:
+            body.decode(charset)
+            return charset
+        except (LookupError, UnicodeDecodeError):
+            continue
+
+    if from_bytes is not None:
+        best = from_bytes(body[:20000]).best()
+        if best is not None:
+            return best.encoding
+    return "utf-8"
+
+
+class FetchResult:
+    """ページ取得結果"""
+
+    def __init__(self, url: str, final_url: str, status: int, headers: dict, body: bytes, charset: Optional[str] = None, truncated: bool = False) -> None:
+        self.url = url
+        self.final_url = final_url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.charset = charset
+        self.truncated = truncated
+        self._html = None
+
+    @property
+    def html(self) -> str:
+        if self._html is None:
+            charset = detect_charset(self.body, self.charset)
+            self._html = self.body.decode(charset, errors="replace")
+        return self._html
+
+
+class Fetcher:
+    """keep-alive 接続を共有する非同期 HTTP クライアント
+
+    ホストごとの同時接続数と、同一ホストへの連続アクセスの間隔 (politeness delay) を制御する。
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 32,
+        max_per_host: int = 4,
+        politeness_delay: float = 0.5,
+        total_timeout: float = 30.0,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 15.0,
+        max_body_size: int = 5 * 1024 * 1024,
+        user_agent: str = DEFAULT_USER_AGENT
+    ) -> None:
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.politeness_delay = politeness_delay
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+        self.max_body_size = max_body_size
+        self.headers = {
+            "User-Agent": user_agent,
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "Accept-Language": "ja,en;q=0.8",
+        }
+        self._session = None
+        self._loop = None
+        self._host_slots = {}
+        self._host_locks = {}
+        self._host_next_time = {}
+
+    def session(self) -> aiohttp.ClientSession:
+        """実行中のイベントループに紐づくセッションを返す (ループが変わった場合は作り直す)"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=30)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers=self.headers,
+                auto_decompress=True)
+            self._loop = loop
+            self._host_slots = {}
+            self._host_locks = {}
+            self._host_next_time = {}
+        return self._session
+
+    async def _wait_politeness(self, host: str):
+        lock = self._host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            wait = self._host_next_time.get(host, 0.0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._host_next_time[host] = time.monotonic() + self.politeness_delay
+
+    async def fetch(self, url: str, headers: Optional[dict] = None) -> Optional[FetchResult]:
+        """URL を取得する。取得できなかった場合は None を返す"""
+        host = urlsplit(url).hostname
+        if not host:
+            logger.error(f"Invalid URL: {url}")
+            return None
+
+        session = self.session()
+        slot = self._host_slots.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        async with slot:
+            await self._wait_politeness(host)
+            try:
+                async with session.get(url, headers=headers, allow_redirects=True) as response:
+                    content_type = response.headers.get("Content-Type", "text/html").lower()
+                    if response.status == 200 and not any(t in content_type for t in TEXT_CONTENT_TYPES):
+                        logger.info(f"Skip non-text content: {url} ({content_type})")
+                        return None
+
+                    body, truncated = await self._read_body(response)
+                    if truncated:
+                        logger.warning(f"Body truncated at {self.max_body_size} bytes: {url}")
+
+                    return FetchResult(
+                        url,
+                        str(response.url),
+                        response.status,
+                        dict(response.headers),
+                        body,
+                        response.charset,
+                        truncated)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Fetch error: {url} - {type(e).__name__}: {e}")
+                return None
+
+    async def _read_body(self, response: aiohttp.ClientResponse) -> tuple[bytes, bool]:
+        """圧縮を展開しながら本文を読み込み、上限サイズを超えたら打ち切る"""
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= self.max_body_size:
+                return b"".join(chunks)[:self.max_body_size], True
+        return b"".join(chunks), False
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+@functools.cache
+def get_fetcher() -> Fetcher:
+    return Fetcher()
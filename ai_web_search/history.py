@@ -0,0 +1,143 @@
+import time
+import sqlite3
+import logging
+import functools
+from datetime import datetime
+from typing import Optional
+
+from .sqlitestore import SQLiteStore
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_FILE = "history.db"
+
+# 一覧に表示する回答の先頭の文字数
+PREVIEW_CHARS = 100
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class HistoryStore(SQLiteStore):
+    """検索履歴を SQLite に追記していくストア
+
+    一覧は新しい順にページ単位で読み込み、回答の全文は行を選択したときだけ読み込む。
+    SQLite が FTS5 (trigram) に対応していれば、過去の問い合わせと回答を全文検索できる。
+    """
+
+    thread_name = "history"
+
+    def __init__(self, path: str = DEFAULT_HISTORY_FILE) -> None:
+        super().__init__(path)
+        self.fts = False
+
+    def _setup(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                query TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_created_at ON history (created_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS history_meta (key TEXT PRIMARY KEY, value TEXT)")
+        try:
+            # 日本語は単語に区切れないため trigram で部分一致を検索する
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5("
+                "query, answer, content='history', content_rowid='id', tokenize='trigram')")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN
+                    INSERT INTO history_fts (rowid, query, answer) VALUES (new.id, new.query, new.answer);
+                END""")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN
+                    INSERT INTO history_fts (history_fts, rowid, query, answer) VALUES ('delete', old.id, old.query, old.answer);
+                END""")
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            logger.info(f"Full-text search is not available: {str(e)}")
+
+    def _add_sync(self, query: str, answer: str, created_at: float) -> int:
+        conn = self._connect()
+        cursor = conn.execute(
+            "INSERT INTO history (query, answer, created_at) VALUES (?, ?, ?)", (query, answer, created_at))
+        conn.commit()
+        return cursor.lastrowid
+
+    def _where(self, search: Optional[str]) -> tuple[str, tuple]:
+        if not search:
+            return "", ()
+        # trigram は3文字未満の語を検索できないので、その場合は LIKE で探す
+        if self.fts and len(search) >= 3:
+            phrase = '"' + search.replace('"', '""') + '"'
+            return "WHERE id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)", (phrase,)
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        return "WHERE query LIKE ? ESCAPE '\\' OR answer LIKE ? ESCAPE '\\'", (pattern, pattern)
+
+    def _page_sync(self, offset: int, limit: int, search: Optional[str]) -> list[list]:
+        conn = self._connect()
+        where, params = self._where(search)
+        rows = conn.execute(
+            f"SELECT id, query, substr(answer, 1, {PREVIEW_CHARS}), created_at FROM history {where} "
+            "ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+            (*params, limit, offset)).fetchall()
+        return [[id, query, preview, datetime.fromtimestamp(created_at).strftime(TIME_FORMAT)] for id, query, preview, created_at in rows]
+
+    def _count_sync(self, search: Optional[str]) -> int:
+        conn = self._connect()
+        where, params = self._where(search)
+        return conn.execute(f"SELECT COUNT(*) FROM history {where}", params).fetchone()[0]
+
+    def _get_sync(self, id: int) -> Optional[tuple]:
+        conn = self._connect()
+        row = conn.execute("SELECT query, answer, created_at FROM history WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None
+        query, answer, created_at = row
+        return query, answer, datetime.fromtimestamp(created_at).strftime(TIME_FORMAT)
+
+    def _migrate_sync(self, entries: list) -> int:
+        conn = self._connect()
+        if conn.execute("SELECT value FROM history_meta WHERE key = 'migrated'").fetchone() is not None:
+            return 0
+        rows = []
+        # 旧形式のリストは新しい順に並んでいる
+        for entry in reversed(entries or []):
+            query, answer, created = entry[0], entry[1], entry[2] if len(entry) > 2 else None
+            try:
+                created_at = datetime.strptime(created, TIME_FORMAT).timestamp()
+            except (TypeError, ValueError):
+                created_at = time.time()
+            rows.append((query, answer, created_at))
+        conn.executemany("INSERT INTO history (query, answer, created_at) VALUES (?, ?, ?)", rows)
+        conn.execute("INSERT INTO history_meta (key, value) VALUES ('migrated', ?)", (str(time.time()),))
+        conn.commit()
+        return len(rows)
+
+    async def add(self, query: str, answer: str) -> int:
+        return await self._run(self._add_sync, query, answer, time.time())
+
+    async def page(self, offset: int = 0, limit: int = 50, search: Optional[str] = None) -> list[list]:
+        """[ID, 検索クエリ, 回答の先頭, 検索日時] の行を新しい順に返す"""
+        return await self._run(self._page_sync, offset, limit, search)
+
+    async def count(self, search: Optional[str] = None) -> int:
+        return await self._run(self._count_sync, search)
+
+    async def get(self, id: int) -> Optional[tuple]:
+        """(検索クエリ, 回答, 検索日時) を返す"""
+        return await self._run(self._get_sync, id)
+
+    async def migrate(self, entries: list) -> int:
+        """旧形式 (search_history の (query, result, datetime) のリスト) を一度だけ取り込む"""
+        count = await self._run(self._migrate_sync, entries)
+        if count:
+            logger.info(f"Migrated {count} history entries")
+        return count
+
+
+@functools.cache
+def get_history_store() -> HistoryStore:
+    return HistoryStore()
@@ -0,0 +1,285 @@
+import json
+import time
+import uuid
+import logging
+from typing import Optional
+
+from .sqlitestore import SQLiteStore
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOB_FILE = "jobs.db"
+
+# ジョブの状態
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATES = (JOB_DONE, JOB_FAILED, JOB_CANCELLED)
+
+# この時間 (秒) ハートビートが途絶えた実行中のジョブは、ワーカーが落ちたものとみなしてやり直す
+STALE_AFTER = 60
+# 終了したジョブとその進捗イベントを残しておく時間と、削除を試みる間隔 (秒)
+JOB_RETENTION = 24 * 60 * 60
+PURGE_INTERVAL = 10 * 60
+
+
+class QueueFull(Exception):
+    """待ち行列が上限に達していてジョブを受け付けられない"""
+
+
+class JobLost(Exception):
+    """ハートビートが途絶えた間に他のワーカーがジョブをやり直していて、このワーカーからは書き込めない"""
+
+
+class JobStore(SQLiteStore):
+    """検索ジョブと進捗イベントを SQLite に保存するストア
+
+    API のプロセスが複数あっても同じファイルを共有し、どのプロセスのワーカーもジョブを取り出して実行できる。
+    進捗イベントもここに書き込むので、ジョブを受け付けたのと別のプロセスからでも配信できる。
+    終了してから retention 秒を過ぎたジョブは、ハートビートの際にイベントごと削除する。
+    """
+
+    thread_name = "jobs"
+    # 取り出しと受け付けはプロセス間で排他する必要があるので、トランザクションは明示的に張る
+    isolation_level = None
+
+    def __init__(self, path: str = DEFAULT_JOB_FILE, retention: float = JOB_RETENTION) -> None:
+        super().__init__(path)
+        self.retention = retention
+        self._purged_at = 0.0
+
+    def _setup(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                trace TEXT,
+                worker TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL,
+                heartbeat_at REAL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created_at ON jobs (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                progress REAL NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                append INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS job_events_job_id ON job_events (job_id, id)")
+
+    def _submit_sync(self, params: dict, max_queue: int) -> str:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (JOB_QUEUED,)).fetchone()[0]
+            if queued >= max_queue:
+                raise QueueFull(f"{queued} jobs are waiting")
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, params, status, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, json.dumps(params, ensure_ascii=False), JOB_QUEUED, time.time()))
+            conn.execute("COMMIT")
+            return job_id
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _claim_sync(self, worker: str) -> Optional[tuple[str, dict]]:
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 落ちたワーカーが実行していたジョブは最初からやり直す
+            stale = [row[0] for row in conn.execute(
+                "SELECT id FROM jobs WHERE status = ? AND heartbeat_at < ?", (JOB_RUNNING, now - STALE_AFTER))]
+            for job_id in stale:
+                logger.warning(f"Requeue stale job: {job_id}")
+                self._requeue_locked(job_id)
+            row = conn.execute(
+                "SELECT id, params FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1", (JOB_QUEUED,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started_at = ?, heartbeat_at = ? WHERE id = ?",
+                (JOB_RUNNING, worker, now, now, row[0]))
+            conn.execute("COMMIT")
+            return row[0], json.loads(row[1])
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _requeue_locked(self, job_id: str):
+        conn = self._connect()
+        conn.execute("DELETE FROM job_events WHERE job_id = ?", (job_id,))
+        conn.execute(
+            "UPDATE jobs SET status = ?, worker = NULL, started_at = NULL, heartbeat_at = NULL WHERE id = ?",
+            (JOB_QUEUED, job_id))
+
+    def _owned_locked(self, job_id: str, worker: str) -> bool:
+        row = self._connect().execute(
+            "SELECT 1 FROM jobs WHERE id = ? AND worker = ? AND status = ?", (job_id, worker, JOB_RUNNING)).fetchone()
+        return row is not None
+
+    def _requeue_sync(self, job_id: str, worker: str):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self._owned_locked(job_id, worker):
+                self._requeue_locked(job_id)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _add_event_sync(self, job_id: str, worker: str, progress: float, status: str, result: Optional[str], append: bool):
+        cursor = self._connect().execute(
+            "INSERT INTO job_events (job_id, progress, status, result, append, created_at) "
+            "SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM jobs WHERE id = ? AND worker = ? AND status = ?)",
+            (job_id, progress, status, result, int(append), time.time(), job_id, worker, JOB_RUNNING))
+        if cursor.rowcount == 0:
+            raise JobLost(job_id)
+
+    def _events_sync(self, job_id: str, after: int) -> list[tuple]:
+        rows = self._connect().execute(
+            "SELECT id, progress, status, result, append FROM job_events WHERE job_id = ? AND id > ? ORDER BY id",
+            (job_id, after)).fetchall()
+        return [(id, progress, status, result, bool(append)) for id, progress, status, result, append in rows]
+
+    def _purge_sync(self, now: float) -> int:
+        """終了してから retention 秒を過ぎたジョブとその進捗イベントを削除する"""
+        conn = self._connect()
+        cutoff = now - self.retention
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)", (cutoff,))
+            purged = conn.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,)).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if purged:
+            logger.info(f"Purged {purged} finished jobs")
+        return purged
+
+    def _heartbeat_sync(self, worker: str, job_ids: list[str]) -> list[str]:
+        conn = self._connect()
+        now = time.time()
+        conn.executemany(
+            "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ? AND status = ?",
+            [(now, job_id, worker, JOB_RUNNING) for job_id in job_ids])
+        if now - self._purged_at >= PURGE_INTERVAL:
+            self._purged_at = now
+            self._purge_sync(now)
+        if not job_ids:
+            return []
+        return [row[0] for row in conn.execute(
+            f"SELECT id FROM jobs WHERE cancel_requested = 1 AND id IN ({','.join('?' * len(job_ids))})", job_ids)]
+
+    def _finish_sync(self, job_id: str, worker: str, status: str, result: Optional[str], error: Optional[str], trace: Optional[dict]) -> bool:
+        cursor = self._connect().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, trace = ?, finished_at = ? WHERE id = ? AND worker = ? AND status = ?",
+            (status, result, error, json.dumps(trace, ensure_ascii=False) if trace else None, time.time(), job_id, worker, JOB_RUNNING))
+        if cursor.rowcount == 0:
+            logger.warning(f"Discard the result of a job taken over by another worker: {job_id}")
+            return False
+        return True
+
+    def _cancel_sync(self, job_id: str) -> Optional[str]:
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            status = row[0]
+            if status == JOB_QUEUED:
+                status = JOB_CANCELLED
+                conn.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?", (status, time.time(), job_id))
+            elif status == JOB_RUNNING:
+                # 実行中のワーカーがハートビートの際に気付いて止める
+                conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+            conn.execute("COMMIT")
+            return status
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _get_sync(self, job_id: str) -> Optional[dict]:
+        row = self._connect().execute(
+            "SELECT id, params, status, result, error, trace, cancel_requested, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+            (job_id,)).fetchone()
+        if row is None:
+            return None
+        id, params, status, result, error, trace, cancel_requested, created_at, started_at, finished_at = row
+        return {
+            "id": id,
+            "params": json.loads(params),
+            "status": status,
+            "result": result,
+            "error": error,
+            "trace": json.loads(trace) if trace else None,
+            "cancel_requested": bool(cancel_requested),
+            "created_at": created_at,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+
+    def _counts_sync(self) -> dict:
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    async def submit(self, params: dict, max_queue: int) -> str:
+        """ジョブを待ち行列に追加して ID を返す (待ちが max_queue 件以上なら QueueFull)"""
+        return await self._run(self._submit_sync, params, max_queue)
+
+    async def claim(self, worker: str) -> Optional[tuple[str, dict]]:
+        """最も古い待ちジョブを実行中にして (ID, パラメータ) を返す"""
+        return await self._run(self._claim_sync, worker)
+
+    async def requeue(self, job_id: str, worker: str):
+        """worker が実行中のジョブを待ち行列に戻す"""
+        await self._run(self._requeue_sync, job_id, worker)
+
+    async def add_event(self, job_id: str, worker: str, progress: float, status: str, result: Optional[str] = None, append: bool = False):
+        """進捗を追加する (append なら result は直前までの回答に続く部分だけ。worker がジョブを失っていれば JobLost)"""
+        await self._run(self._add_event_sync, job_id, worker, progress, status, result, append)
+
+    async def events(self, job_id: str, after: int = 0) -> list[tuple]:
+        """after より後の (イベント ID, progress, status, result, append) を返す (result は変化したときだけ入る)"""
+        return await self._run(self._events_sync, job_id, after)
+
+    async def heartbeat(self, worker: str, job_ids: list[str]) -> list[str]:
+        """worker が実行中のジョブのハートビートを更新し、中止を求められているジョブの ID を返す"""
+        return await self._run(self._heartbeat_sync, worker, job_ids)
+
+    async def finish(self, job_id: str, worker: str, status: str, result: Optional[str] = None, error: Optional[str] = None, trace: Optional[dict] = None) -> bool:
+        """ジョブを終了させる (worker がまだ実行しているジョブでなければ何もせずに False を返す)"""
+        return await self._run(self._finish_sync, job_id, worker, status, result, error, trace)
+
+    async def cancel(self, job_id: str) -> Optional[str]:
+        """ジョブの中止を求め、求めた時点の状態を返す (存在しなければ None)"""
+        return await self._run(self._cancel_sync, job_id)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        return await self._run(self._get_sync, job_id)
+
+    async def counts(self) -> dict:
+        return await self._run(self._counts_sync)
@@ -0,0 +1,200 @@
+import re
+import math
+import unicodedata
+from collections import Counter
+
+
+# 日本語・中国語・韓国語・タイ語など分かち書きされない (または単語が長く連なる) 文字
+UNSEGMENTED_CHARS = "\u0e00-\u0eff\u1000-\u109f\u1780-\u17ff\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af"
+# 分かち書きされない文字列は 2-gram 単位、それ以外の文字 (任意の言語の英数字) は単語単位で扱う
+WORD_PATTERN = re.compile(rf"(?P<unsegmented>[{UNSEGMENTED_CHARS}]+)|(?P<word>(?:(?![{UNSEGMENTED_CHARS}])[^\W_])+)")
+# ひらがなだけの 2-gram は助詞・語尾であることが多いので捨てる
+HIRAGANA_PATTERN = re.compile(r"[\u3040-\u309f]+")
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it",
+    "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which",
+    "who", "why", "with",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    """言語に依存しない簡易トークナイザ"""
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKC", text).casefold()
+    tokens = []
+    for match in WORD_PATTERN.finditer(text):
+        word = match.group()
+        if match.lastgroup == "word":
+            if word not in STOPWORDS:
+                tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(
+                bigram for bigram in (word[i:i + 2] for i in range(len(word) - 1))
+                if not HIRAGANA_PATTERN.fullmatch(bigram))
+    return tokens
+
+
+def overlap_score(query: str, text: str) -> float:
+    """query のトークンのうち text に含まれるものの割合 (0.0 - 1.0)"""
+    query_tokens = set(tokenize(query))
+    if not query_tokens:
+        return 0.0
+    text_tokens = set(tokenize(text))
+    return len(query_tokens & text_tokens) / len(query_tokens)
+
+
+CJK_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+HEADING_PATTERN = re.compile(r"^#{1,6}\s", re.MULTILINE)
+
+
+def estimate_tokens(text: str, latin_chars_per_token: float = 4.0, cjk_tokens_per_char: float = 1.0) -> int:
+    """トークナイザを使わずにトークン数を見積もる (CJK 文字とそれ以外で係数を変える)"""
+    if not text:
+        return 0
+    cjk = len(CJK_PATTERN.findall(text))
+    return int(cjk * cjk_tokens_per_char + (len(text) - cjk) / latin_chars_per_token) + 1
+
+
+class BM25:
+    """トークン列の集合に対する BM25 スコアリング"""
+
+    def __init__(self, documents: list[list[str]], k1: float = 1.5, b: float = 0.75) -> None:
+        self.k1 = k1
+        self.b = b
+        self.documents = [Counter(tokens) for tokens in documents]
+        self.lengths = [len(tokens) for tokens in documents]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        document_frequency = Counter()
+        for counts in self.documents:
+            document_frequency.update(counts.keys())
+        total = len(self.documents)
+        self.idf = {
+            token: math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for token, df in document_frequency.items()
+        }
+
+    def score(self, query_tokens: list[str]) -> list[float]:
+        scores = []
+        for counts, length in zip(self.documents, self.lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / self.average_length) if self.average_length else self.k1
+            for token in set(query_tokens):
+                tf = counts.get(token, 0)
+                if tf:
+                    score += self.idf[token] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+
+def split_markdown(text: str, max_chunk_tokens: int, estimate=estimate_tokens) -> list[str]:
+    """markdown を見出し単位、長い節はさらに段落単位で分割する"""
+    starts = [m.start() for m in HEADING_PATTERN.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts = [0] + starts
+    sections = [text[a:b] for a, b in zip(starts, starts[1:] + [len(text)])]
+
+    chunks = []
+    for section in sections:
+        if estimate(section) <= max_chunk_tokens:
+            chunks.append(section)
+            continue
+        current = ""
+        for paragraph in re.split(r"\n\s*\n", section):
+            candidate = f"{current}\n\n{paragraph}" if current else paragraph
+            if current and estimate(candidate) > max_chunk_tokens:
+                chunks.append(current)
+                current = paragraph
+            else:
+                current = candidate
+        if current:
+            chunks.append(current)
+
+    # 段落単体で上限を超える場合は文字数で切る
+    result = []
+    for chunk in chunks:
+        tokens = estimate(chunk)
+        if tokens <= max_chunk_tokens:
+            result.append(chunk)
+            continue
+        step = max(1, int(len(chunk) * max_chunk_tokens / tokens))
+        result.extend(chunk[i:i + step] for i in range(0, len(chunk), step))
+    return [chunk.strip() for chunk in result if chunk.strip()]
+
+
+def select_chunks(text: str, query: str, max_tokens: int, estimate=estimate_tokens, max_chunk_tokens: int = 400) -> str:
+    """本文が max_tokens を超える場合、query との BM25 スコアが高い塊だけを元の順序で残す"""
+    if estimate(text) <= max_tokens:
+        return text
+
+    chunks = split_markdown(text, max_chunk_tokens, estimate)
+    bm25 = BM25([tokenize(chunk) for chunk in chunks])
+    scores = bm25.score(tokenize(query))
+
+    # 先頭の塊 (タイトルやメタデータ) は常に残す
+    selected = {0}
+    used = estimate(chunks[0])
+    for index in sorted(range(1, len(chunks)), key=lambda i: scores[i], reverse=True):
+        tokens = estimate(chunks[index])
+        if used + tokens > max_tokens:
+            continue
+        selected.add(index)
+        used += tokens
+
+    parts = []
+    previous = -1
+    for index in sorted(selected):
+        if parts and index != previous + 1:
+            parts.append("[...]")
+        parts.append(chunks[index])
+        previous = index
+    return "\n\n".join(parts)
+
+
+# 事前フィルタのモード
+PREFILTER_OFF = "off"  # 使用しない
+PREFILTER_LOG = "log"  # スコアをログに出すだけ (しきい値の調整用)
+PREFILTER_ON = "on"  # しきい値未満の記事は LLM に送らない
+
+
+class RelevanceGate:
+    """LLM で評価する前に、本文と問い合わせの語彙的な関連度で明らかに無関係な記事を除外する
+
+    スコアは問い合わせの各トークンを IDF で重み付けし、本文中の出現回数に応じて
+    飽和させた被覆率 (0.0 - 1.0)。IDF は同じ検索実行で取得した記事から逐次推定する。
+    """
+
+    def __init__(self, threshold: float = 0.2, mode: str = PREFILTER_OFF) -> None:
+        self.threshold = threshold
+        self.mode = mode
+        self.documents = 0
+        self.document_frequency = Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in (PREFILTER_LOG, PREFILTER_ON)
+
+    def score(self, text: str, query: str) -> float:
+        counts = Counter(tokenize(text))
+        self.documents += 1
+        self.document_frequency.update(counts.keys())
+
+        query_tokens = set(tokenize(query))
+        if not query_tokens:
+            return 1.0
+
+        total = 0.0
+        matched = 0.0
+        for token in query_tokens:
+            weight = math.log(1 + (self.documents + 1) / (self.document_frequency[token] + 0.5))
+            total += weight
+            matched += weight * (1 - math.exp(-counts.get(token, 0)))
+        return matched / total
+
+    def check(self, text: str, query: str) -> tuple[bool, float]:
+        """(LLM に送るべきか, スコア) を返す"""
+        score = self.score(text, query)
+        return self.mode != PREFILTER_ON or score >= self.threshold, score
@@ -6,7 +6,6 @@ import logging
 import markdown
 import json
 import traceback
-from datetime import datetime
 
 from duckduckgo_search import DDGS
 from googleapiclient.discovery import build
@@ -15,6 +14,9 @@ from pmem.sync_pmem import PersistentMemory
 from pmem.async_pmem import PersistentMemory as AsyncPersistentMemory
 
 from . import searcher
+from .crawler import CRAWL_MODE_FIFO, CRAWL_MODE_BEST
+from .lexical import PREFILTER_OFF, PREFILTER_LOG, PREFILTER_ON
+from .history import get_history_store
 
 
 # ログ設定
@@ -22,6 +24,11 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 mem = PersistentMemory("newui.db")
 amem = AsyncPersistentMemory("newui.db")
+history_store = get_history_store()
+
+# 検索履歴の1ページあたりの行数
+HISTORY_PAGE_SIZE = 50
+history_migrated = False
 
 
 def create_ui() -> gr.Interface:
@@ -42,6 +49,7 @@ def create_ui() -> gr.Interface:
                 engines = ["DuckDuckGo", ]
                 if os.environ.get("GOOGLE_SEARCH_ENGUINE_ID") is not None:
                     engines.append("Google")
+                    engines.append("Federated")
 
                 engine_dropdown = gr.Dropdown(
                     label="検索エンジン",
@@ -50,6 +58,27 @@ def create_ui() -> gr.Interface:
                     interactive=True
                 )
 
+                crawl_mode_dropdown = gr.Dropdown(
+                    label="探索順序",
+                    choices=[("見つかった順", CRAWL_MODE_FIFO), ("関連度の高い順", CRAWL_MODE_BEST)],
+                    value=mem.load("setting_crawl_mode", CRAWL_MODE_BEST),
+                    interactive=True
+                )
+
+                prefilter_dropdown = gr.Dropdown(
+                    label="事前フィルタ",
+                    choices=[("使用しない", PREFILTER_OFF), ("ログのみ", PREFILTER_LOG), ("使用する", PREFILTER_ON)],
+                    value=mem.load("setting_prefilter", PREFILTER_OFF),
+                    interactive=True
+                )
+                prefilter_threshold_bar = gr.Slider(
+                    minimum=0,
+                    maximum=1,
+                    value=mem.load("setting_prefilter_threshold", 0.2),
+                    step=0.05,
+                    label="事前フィルタのしきい値",
+                )
+
                 keywords_bar = gr.Slider(
                     minimum=1,
                     maximum=10,
@@ -71,6 +100,13 @@ def create_ui() -> gr.Interface:
                     step=1,
                     label="最大平行処理数",
                 )
+                batch_size_bar = gr.Slider(
+                    minimum=1,
+                    maximum=8,
+                    value=mem.load("setting_batch_size", 1),
+                    step=1,
+                    label="一括解析する記事数",
+                )
                 articles_bar = gr.Slider(
                     minimum=1,
                     maximum=50,
@@ -85,6 +121,17 @@ def create_ui() -> gr.Interface:
                     step=1,
                     label="参照する記事の関連度",
                 )
+                time_limit_bar = gr.Slider(
+                    minimum=0,
+                    maximum=600,
+                    value=mem.load("setting_time_limit", 0),
+                    step=10,
+                    label="探索の制限時間 (秒、0 は無制限)",
+                )
+                cache_first_checkbox = gr.Checkbox(
+                    value=mem.load("setting_cache_first", False),
+                    label="取得済みの記事を優先する (足りないときだけ Web を検索)",
+                )
                 hr = gr.HTML("<hr />")
                 progress_bar = gr.Slider(
                     minimum=0,
@@ -106,11 +153,22 @@ def create_ui() -> gr.Interface:
                     lines=3
                 )
                 search_button = gr.Button("検索開始")
+                stop_button = gr.Button("検索中止")
                 result_output = gr.HTML()
         
             with gr.Row():
                 new_search_button = gr.Button("新規検索")
                 gr.HTML("<hr />")
+                history_search = gr.Textbox(
+                    label="履歴を検索",
+                    placeholder="過去の検索クエリと回答から検索します..."
+                )
+                history_page = gr.Number(
+                    label="履歴のページ",
+                    value=1,
+                    minimum=1,
+                    precision=0
+                )
                 history_list = gr.DataFrame(
                     headers=["ID", "検索クエリ", "結果", "検索日時"],
                     label="検索履歴"
@@ -119,9 +177,11 @@ def create_ui() -> gr.Interface:
             def clear_inputs():
                 return "", "", 0, ""
 
-            async def select_history(evt: gr.SelectData):
-                history = mem.load("search_history", [])
-                selected_row = history[evt.index[0]]
+            async def select_history(history, evt: gr.SelectData):
+                # 一覧には回答の先頭しか無いので、選択した行の全文をここで読み込む
+                selected_row = await history_store.get(int(history.iloc[evt.index[0], 0]))
+                if selected_row is None:
+                    return {}
                 return {
                     query_input: selected_row[0],
                     result_output: "<hr />" + markdown.markdown(selected_row[1]) + "<hr />"
@@ -135,17 +195,21 @@ def create_ui() -> gr.Interface:
 
             history_list.select(
                 fn=select_history,
+                inputs=[history_list],
                 outputs=[query_input, result_output]
             )
 
-        async def load_history():
-            history = await amem.load("search_history", [])
-            return history
+        async def load_history(search: str = "", page: int = 1):
+            global history_migrated
+            if not history_migrated:
+                # 旧形式 (newui.db の search_history) の履歴を一度だけ取り込む
+                await history_store.migrate(await amem.load("search_history", []))
+                history_migrated = True
+            offset = (max(1, int(page or 1)) - 1) * HISTORY_PAGE_SIZE
+            return await history_store.page(offset, HISTORY_PAGE_SIZE, search or None)
 
         async def save_history(query, result):
-            await amem.save("search_history", 
-                            [(query, result, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))] + 
-                            await amem.load("search_history", []))
+            await history_store.add(query, result)
             
         async def search_handler(
                 query: str, 
@@ -155,7 +219,13 @@ def create_ui() -> gr.Interface:
                 articles: int, 
                 article_quality: int, 
                 model: str,
-                search_engine: str
+                search_engine: str,
+                crawl_mode: str,
+                prefilter: str,
+                prefilter_threshold: float,
+                batch_size: int,
+                time_limit: int,
+                cache_first: bool
                 ) -> AsyncGenerator[list, None]:
             await amem.save("setting_current_model", model)
             await amem.save("setting_keywords_count", keywords_count)
@@ -164,11 +234,19 @@ def create_ui() -> gr.Interface:
             await amem.save("setting_articles", articles)
             await amem.save("setting_article_quality", article_quality)
             await amem.save("setting_current_engine", search_engine)
+            await amem.save("setting_crawl_mode", crawl_mode)
+            await amem.save("setting_prefilter", prefilter)
+            await amem.save("setting_prefilter_threshold", prefilter_threshold)
+            await amem.save("setting_batch_size", batch_size)
+            await amem.save("setting_time_limit", time_limit)
+            await amem.save("setting_cache_first", cache_first)
 
             outputs = []
             final_result = ""
             async for progress, status, result in searcher.search(
-                query, keywords_count, depth, threads, articles, article_quality, model, search_engine):
+                query, keywords_count, depth, threads, articles, article_quality, model, search_engine,
+                crawl_mode=crawl_mode, prefilter=prefilter, prefilter_threshold=prefilter_threshold,
+                batch_size=batch_size, time_limit=time_limit or None, cache_first=cache_first):
                 final_result = result
                 outputs = [
                     int(progress),  # progress_bar の値
@@ -181,14 +259,29 @@ def create_ui() -> gr.Interface:
             if progress >= 1.0:
                 await save_history(query, final_result)
 
-        search_button.click(
+        search_event = search_button.click(
             fn=search_handler,
-            inputs=[query_input, keywords_bar, depth_bar, threads_bar, articles_bar, article_quality_bar, model_dropdown, engine_dropdown],
+            inputs=[query_input, keywords_bar, depth_bar, threads_bar, articles_bar, article_quality_bar, model_dropdown, engine_dropdown, crawl_mode_dropdown,
+                    prefilter_dropdown, prefilter_threshold_bar, batch_size_bar, time_limit_bar, cache_first_checkbox],
             outputs=[progress_bar, progress_text, result_output]
         )
 
+        # 中止するとイベントのタスクがキャンセルされ、実行中の取得と解析も止まる
+        stop_button.click(fn=None, cancels=[search_event])
+
         interface.load(
             fn=load_history,
+            inputs=[history_search, history_page],
+            outputs=history_list
+        )
+        history_search.submit(
+            fn=load_history,
+            inputs=[history_search, history_page],
+            outputs=history_list
+        )
+        history_page.change(
+            fn=load_history,
+            inputs=[history_search, history_page],
             outputs=history_list
         )
 
@@ -0,0 +1,412 @@
+import time
+import zlib
+import pickle
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import argparse
+import functools
+from typing import Optional
+
+from .cache import LRUCache, DEFAULT_CACHE_FILE
+from .retrieval import DEFAULT_INDEX_FILE, LocalIndex, get_local_index
+from .sqlitestore import SQLiteStore
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE_STORE_FILE = "page_store.db"
+
+# この期間内に取得したページは再検証せずにそのまま使う (秒)
+FRESH_TTL = 7 * 24 * 60 * 60
+# この期間より前に取得したページは prune で削除する (秒)
+MAX_AGE = 60 * 24 * 60 * 60
+# 圧縮後の本文の合計サイズの上限 (超えると取得の古いページから削除する)
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+# 辞書の学習に使う本文の数と辞書のサイズ
+DICT_TRAIN_SAMPLES = 256
+DICT_SIZE = 112 * 1024
+
+# 展開済みの本文をプロセス内に保持する上限
+MEMORY_MAX_ENTRIES = 256
+MEMORY_MAX_BYTES = 32 * 1024 * 1024
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def header_value(headers: dict, name: str) -> Optional[str]:
+    """大文字小文字を区別せずにヘッダの値を返す"""
+    name = name.lower()
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+class StoredPage:
+    """URL ごとの取得結果 (本文と、再検証に使う取得時のメタデータ)"""
+
+    def __init__(self, url: str, final_url: str, text: str, status: int, etag: Optional[str], last_modified: Optional[str], fetched_at: float) -> None:
+        self.url = url
+        self.final_url = final_url
+        self.text = text
+        self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+    def is_fresh(self, ttl: float = FRESH_TTL) -> bool:
+        return time.time() - self.fetched_at < ttl
+
+    def conditional_headers(self) -> dict:
+        """条件付きリクエストのヘッダ (ETag も Last-Modified も無ければ空)"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class PageStore(SQLiteStore):
+    """抽出済みの本文を圧縮して内容のハッシュで保存するストア
+
+    本文は内容のハッシュをキーに1回だけ保存し、URL からは別の表で参照する。
+    異なる URL から同じ本文が得られた場合 (転載・URL の揺れ) も保存は1つで済む。
+    zstandard があれば本文から学習した辞書で zstd 圧縮し、無ければ zlib で圧縮する。
+    圧縮後の合計サイズが max_bytes を超えると、取得の古いページから削除して index からも取り除く。
+    """
+
+    # 圧縮・展開も sqlite と同じ専用スレッドで行う
+    thread_name = "pagestore"
+
+    def __init__(self, path: str = DEFAULT_PAGE_STORE_FILE, index: Optional[LocalIndex] = None, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        super().__init__(path)
+        self.index = index
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        self.memory = LRUCache(MEMORY_MAX_ENTRIES, MEMORY_MAX_BYTES)
+        self._dictionaries = {}
+        self._dictionary_id = None
+        # 辞書の学習を試みる本文の数 (学習に失敗したら倍に増やす)
+        self._next_training = DICT_TRAIN_SAMPLES
+
+    def _setup(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS contents (
+                hash TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                stored_size INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                final_url TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                status INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                fetched_at REAL NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash)")
+        conn.execute("CREATE INDEX IF NOT EXISTS pages_fetched_at ON pages (fetched_at)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS dictionaries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data BLOB NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+        row = conn.execute("SELECT MAX(id) FROM dictionaries").fetchone()
+        self._dictionary_id = row[0]
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM contents").fetchone()[0]
+
+    def _dictionary(self, id: int):
+        if id not in self._dictionaries:
+            data = self._connect().execute("SELECT data FROM dictionaries WHERE id = ?", (id,)).fetchone()[0]
+            self._dictionaries[id] = zstandard.ZstdCompressionDict(data)
+        return self._dictionaries[id]
+
+    def _compress(self, data: bytes) -> tuple[str, bytes]:
+        if zstandard is None:
+            return "zlib", zlib.compress(data, ZLIB_LEVEL)
+        if self._dictionary_id is None:
+            return "zstd", zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self._dictionary(self._dictionary_id))
+        return f"zstd:{self._dictionary_id}", compressor.compress(data)
+
+    def _decompress(self, codec: str, data: bytes) -> bytes:
+        if codec == "zlib":
+            return zlib.decompress(data)
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {codec} pages")
+        if codec == "zstd":
+            return zstandard.ZstdDecompressor().decompress(data)
+        dictionary = self._dictionary(int(codec.split(":", 1)[1]))
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data)
+
+    def _decode(self, codec: str, data: bytes) -> Optional[str]:
+        """本文を展開する (zstandard が無い・データや辞書が壊れているなどで読めなければ None)"""
+        try:
+            return self._decompress(codec, data).decode("utf-8")
+        except Exception as e:
+            logger.warning(f"Failed to decode a stored page ({codec}): {str(e)}")
+            return None
+
+    def _load_sync(self, url: str) -> Optional[StoredPage]:
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT pages.final_url, pages.status, pages.etag, pages.last_modified, pages.fetched_at, pages.hash, contents.codec, contents.data "
+            "FROM pages JOIN contents ON contents.hash = pages.hash WHERE pages.url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        final_url, status, etag, last_modified, fetched_at, digest, codec, data = row
+        text = self._decode(codec, data)
+        if text is None:
+            # 読めないページは取得し直させる
+            conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._delete_orphans_sync([digest])
+            conn.commit()
+            return None
+        return StoredPage(url, final_url, text, status, etag, last_modified, fetched_at)
+
+    def _save_sync(self, page: StoredPage) -> tuple[bool, list[str]]:
+        conn = self._connect()
+        digest = content_hash(page.text)
+        old = conn.execute("SELECT hash FROM pages WHERE url = ?", (page.url,)).fetchone()
+        if conn.execute("SELECT 1 FROM contents WHERE hash = ?", (digest,)).fetchone() is None:
+            raw = page.text.encode("utf-8")
+            codec, data = self._compress(raw)
+            conn.execute(
+                "INSERT INTO contents (hash, codec, data, size, stored_size, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, codec, data, len(raw), len(data), time.time()))
+            self.total_bytes += len(data)
+        conn.execute(
+            "INSERT OR REPLACE INTO pages (url, final_url, hash, status, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (page.url, page.final_url, digest, page.status, page.etag, page.last_modified, page.fetched_at))
+        if old is not None and old[0] != digest:
+            self._delete_orphans_sync([old[0]])
+        conn.commit()
+        if zstandard is not None and self._dictionary_id is None:
+            self._maybe_train_sync()
+        evicted = []
+        if self.total_bytes > self.max_bytes:
+            evicted = self._evict_sync(int(self.max_bytes * 0.9))
+        return old is None or old[0] != digest, evicted
+
+    def _touch_sync(self, url: str, fetched_at: float):
+        conn = self._connect()
+        conn.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (fetched_at, url))
+        conn.commit()
+
+    def _delete_orphans_sync(self, hashes: Optional[list] = None) -> int:
+        conn = self._connect()
+        if hashes is None:
+            deleted = conn.execute("DELETE FROM contents WHERE hash NOT IN (SELECT hash FROM pages)").rowcount
+            self.total_bytes = conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM contents").fetchone()[0]
+            return deleted
+        deleted = 0
+        for digest in hashes:
+            row = conn.execute(
+                "SELECT stored_size FROM contents WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM pages WHERE pages.hash = contents.hash)",
+                (digest,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM contents WHERE hash = ?", (digest,))
+                self.total_bytes -= row[0]
+                deleted += 1
+        return deleted
+
+    def _evict_sync(self, target_bytes: int) -> list[str]:
+        """合計サイズが target_bytes 以下になるまで取得の古いページから削除し、削除した URL を返す"""
+        conn = self._connect()
+        evicted = []
+        rows = conn.execute("SELECT url, hash FROM pages ORDER BY fetched_at").fetchall()
+        for url, digest in rows:
+            if self.total_bytes <= target_bytes:
+                break
+            conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+            self._delete_orphans_sync([digest])
+            evicted.append(url)
+        conn.commit()
+        logger.info(f"Page store evicted {len(evicted)} pages ({self.total_bytes} bytes left)")
+        return evicted
+
+    def _maybe_train_sync(self, force: bool = False):
+        """本文が十分に溜まったら zstd の辞書を学習する (以降の保存に使う)"""
+        conn = self._connect()
+        count = conn.execute("SELECT COUNT(*) FROM contents").fetchone()[0]
+        if count < self._next_training and not force:
+            return
+        rows = conn.execute(
+            "SELECT codec, data FROM contents ORDER BY created_at DESC LIMIT ?", (DICT_TRAIN_SAMPLES * 4,)).fetchall()
+        samples = [text.encode("utf-8") for text in (self._decode(codec, data) for codec, data in rows) if text is not None]
+        try:
+            dictionary = zstandard.train_dictionary(DICT_SIZE, samples)
+        except zstandard.ZstdError as e:
+            logger.warning(f"Failed to train a compression dictionary: {str(e)}")
+            self._next_training = count * 2
+            return
+        cursor = conn.execute(
+            "INSERT INTO dictionaries (data, created_at) VALUES (?, ?)", (dictionary.as_bytes(), time.time()))
+        conn.commit()
+        self._dictionary_id = cursor.lastrowid
+        logger.info(f"Trained a compression dictionary from {len(samples)} pages")
+
+    def _recompress_sync(self) -> int:
+        """現在の辞書で圧縮されていない本文を圧縮し直す"""
+        conn = self._connect()
+        if self._dictionary_id is None:
+            return 0
+        rows = conn.execute(
+            "SELECT hash, codec, data FROM contents WHERE codec != ?", (f"zstd:{self._dictionary_id}",)).fetchall()
+        recompressed = 0
+        for digest, old_codec, data in rows:
+            text = self._decode(old_codec, data)
+            if text is None:
+                continue
+            new_codec, new_data = self._compress(text.encode("utf-8"))
+            conn.execute(
+                "UPDATE contents SET codec = ?, data = ?, stored_size = ? WHERE hash = ?",
+                (new_codec, new_data, len(new_data), digest))
+            recompressed += 1
+        conn.commit()
+        self.total_bytes = conn.execute("SELECT COALESCE(SUM(stored_size), 0) FROM contents").fetchone()[0]
+        return recompressed
+
+    def _prune_sync(self, max_age: float) -> tuple[list[str], int]:
+        conn = self._connect()
+        cutoff = time.time() - max_age
+        urls = [row[0] for row in conn.execute("SELECT url FROM pages WHERE fetched_at < ?", (cutoff,))]
+        conn.execute("DELETE FROM pages WHERE fetched_at < ?", (cutoff,))
+        contents = self._delete_orphans_sync()
+        conn.commit()
+        conn.execute("VACUUM")
+        return urls, contents
+
+    def _stats_sync(self) -> dict:
+        conn = self._connect()
+        pages = conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        contents, size, stored_size = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored_size), 0) FROM contents").fetchone()
+        return {
+            "pages": pages,
+            "contents": contents,
+            "bytes": size,
+            "stored_bytes": stored_size,
+            "ratio": stored_size / size if size else 0.0,
+            "dictionary": self._dictionary_id,
+        }
+
+    def _scan_sync(self, after: str, limit: int) -> list[tuple[str, str]]:
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT pages.url, contents.codec, contents.data FROM pages JOIN contents ON contents.hash = pages.hash "
+            "WHERE pages.url > ? ORDER BY pages.url LIMIT ?", (after, limit)).fetchall()
+        pages = [(url, self._decode(codec, data)) for url, codec, data in rows]
+        return [(url, text) for url, text in pages if text is not None]
+
+    async def load(self, url: str) -> Optional[StoredPage]:
+        page = self.memory.get(url)
+        if page is not None:
+            return page[0]
+        page = await self._run(self._load_sync, url)
+        if page is not None:
+            self.memory.set(url, page, len(page.text), None)
+        return page
+
+    async def save(self, url: str, final_url: str, text: str, status: int = 200, headers: Optional[dict] = None) -> bool:
+        """本文と取得時のメタデータを保存し、本文が前回から変わった (または新規の) 場合は True を返す"""
+        page = StoredPage(
+            url, final_url, text, status,
+            header_value(headers, "ETag"), header_value(headers, "Last-Modified"), time.time())
+        self.memory.set(url, page, len(text), None)
+        changed, evicted = await self._run(self._save_sync, page)
+        await self._forget(evicted)
+        return changed
+
+    async def touch(self, url: str):
+        """再検証で変更が無かった (304) ページの取得時刻を更新する"""
+        fetched_at = time.time()
+        page = self.memory.get(url)
+        if page is not None:
+            page[0].fetched_at = fetched_at
+        await self._run(self._touch_sync, url, fetched_at)
+
+    async def scan(self, after: str = "", limit: int = 100) -> list[tuple[str, str]]:
+        """URL 順に (URL, 本文) を limit 件ずつ返す (after に前回の最後の URL を渡して続きを読む)"""
+        return await self._run(self._scan_sync, after, limit)
+
+    async def train(self) -> Optional[int]:
+        """辞書を学習し直し、既存の本文も新しい辞書で圧縮し直す"""
+        if zstandard is None:
+            return None
+        await self._run(self._maybe_train_sync, True)
+        return await self._run(self._recompress_sync)
+
+    async def _forget(self, urls: list[str]):
+        """削除したページをプロセス内の保持と索引から取り除く"""
+        for url in urls:
+            self.memory.delete(url)
+        if urls and self.index is not None:
+            await self.index.delete(urls)
+
+    async def prune(self, max_age: float = MAX_AGE) -> dict:
+        """古いページと、どの URL からも参照されなくなった本文を削除する"""
+        urls, contents = await self._run(self._prune_sync, max_age)
+        await self._forget(urls)
+        return {"pages": len(urls), "contents": contents}
+
+    async def stats(self) -> dict:
+        return await self._run(self._stats_sync)
+
+
+@functools.cache
+def get_page_store() -> PageStore:
+    # 削除したページは共有の索引からも取り除く
+    return PageStore(index=get_local_index())
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="本文ストアのメンテナンス")
+    parser.add_argument("command", choices=["stats", "prune", "train", "import"])
+    parser.add_argument("--store", default=DEFAULT_PAGE_STORE_FILE)
+    parser.add_argument("--cache", default=DEFAULT_CACHE_FILE, help="import で取り込む旧形式のページキャッシュ")
+    parser.add_argument("--index", default=DEFAULT_INDEX_FILE, help="削除したページを取り除く索引")
+    parser.add_argument("--max-age-days", type=float, default=MAX_AGE / 24 / 60 / 60)
+    parser.add_argument("--max-mb", type=int, default=DEFAULT_MAX_BYTES // 1024 // 1024)
+    args = parser.parse_args()
+
+    store = PageStore(args.store, index=LocalIndex(args.index), max_bytes=args.max_mb * 1024 * 1024)
+    if args.command == "import":
+        # 以前は本文を web_cache.db の page 名前空間に URL ごとに保存していた
+        conn = sqlite3.connect(args.cache)
+        redirects = {key: pickle.loads(value) for key, value in conn.execute("SELECT key, value FROM cache WHERE namespace = 'redirect'")}
+        count = 0
+        for url, value in conn.execute("SELECT key, value FROM cache WHERE namespace = 'page'"):
+            await store.save(url, redirects.get(url, url), pickle.loads(value))
+            count += 1
+        print(f"{count} pages imported")
+    elif args.command == "prune":
+        print(await store.prune(args.max_age_days * 24 * 60 * 60))
+    elif args.command == "train":
+        recompressed = await store.train()
+        print("zstandard is not installed" if recompressed is None else f"{recompressed} pages recompressed")
+    print(await store.stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,242 @@
+import math
+import time
+import array
+import asyncio
+import logging
+import argparse
+import functools
+from collections import Counter
+from typing import Optional
+
+from .lexical import tokenize
+from .sqlitestore import SQLiteStore
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_FILE = "local_index.db"
+
+# BM25 のパラメータ
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 埋め込みで並べ替える BM25 の上位候補数
+RERANK_CANDIDATES = 50
+# 埋め込みに使う本文の先頭の文字数
+EMBED_CHARS = 2000
+
+
+class EmbeddingBackend:
+    """埋め込みベクトルを作るバックエンドの基底クラス"""
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+    """sentence-transformers による CPU の埋め込み (パッケージがある場合のみ使える)"""
+
+    def __init__(self, model_name: str = "intfloat/multilingual-e5-small") -> None:
+        # torch ごと読み込まれるので、埋め込みを使うときだけ import する
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("SentenceTransformerBackend requires sentence-transformers (pip install sentence-transformers)") from e
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        return [list(vector) for vector in self.model.encode(texts, normalize_embeddings=True)]
+
+
+def cosine(left, right) -> float:
+    dot = sum(x * y for x, y in zip(left, right))
+    norm = math.sqrt(sum(x * x for x in left)) * math.sqrt(sum(y * y for y in right))
+    return dot / norm if norm else 0.0
+
+
+class LocalIndex(SQLiteStore):
+    """取得済みのページに対する転置索引 (BM25) を SQLite に保持するクラス
+
+    page_to_text がページを保存するたびに追加され、Web を検索する前に手元のページから候補を探すのに使う。
+    embedding を指定すると、BM25 の上位候補を埋め込みの類似度も加えて並べ替える。
+    """
+
+    # トークン化・埋め込みの計算も sqlite と同じ専用スレッドで行う
+    thread_name = "index"
+
+    def __init__(self, path: str = DEFAULT_INDEX_FILE, embedding: Optional[EmbeddingBackend] = None) -> None:
+        super().__init__(path)
+        self.embedding = embedding
+        # add_in_background で追加中のタスク
+        self._pending = set()
+
+    def _setup(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS docs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL UNIQUE,
+                length INTEGER NOT NULL,
+                embedding BLOB,
+                added_at REAL NOT NULL
+            )""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                doc_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, doc_id)
+            ) WITHOUT ROWID""")
+        conn.execute("CREATE INDEX IF NOT EXISTS postings_doc_id ON postings (doc_id)")
+
+    def _remove_locked(self, urls: list[str]) -> int:
+        conn = self._connect()
+        removed = 0
+        for url in urls:
+            row = conn.execute("SELECT id FROM docs WHERE url = ?", (url,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM postings WHERE doc_id = ?", (row[0],))
+                conn.execute("DELETE FROM docs WHERE id = ?", (row[0],))
+                removed += 1
+        return removed
+
+    def _add_sync(self, url: str, text: str):
+        conn = self._connect()
+        counts = Counter(tokenize(text))
+        vector = None
+        if counts and self.embedding is not None:
+            vector = array.array("f", self.embedding.embed([text[:EMBED_CHARS]])[0]).tobytes()
+        self._remove_locked([url])
+        if not counts:
+            conn.commit()
+            return
+        cursor = conn.execute(
+            "INSERT INTO docs (url, length, embedding, added_at) VALUES (?, ?, ?, ?)",
+            (url, sum(counts.values()), vector, time.time()))
+        doc_id = cursor.lastrowid
+        conn.executemany(
+            "INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+            [(term, doc_id, tf) for term, tf in counts.items()])
+        conn.commit()
+
+    def _search_sync(self, query: str, limit: int) -> list[tuple[str, float]]:
+        conn = self._connect()
+        terms = set(tokenize(query))
+        total, average_length = conn.execute("SELECT COUNT(*), AVG(length) FROM docs").fetchone()
+        if not terms or not total:
+            return []
+        scores = Counter()
+        for term in terms:
+            rows = conn.execute(
+                "SELECT postings.doc_id, postings.tf, docs.length FROM postings JOIN docs ON docs.id = postings.doc_id "
+                "WHERE postings.term = ?", (term,)).fetchall()
+            if not rows:
+                continue
+            idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+            for doc_id, tf, length in rows:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        if not scores:
+            return []
+
+        candidates = scores.most_common(RERANK_CANDIDATES if self.embedding is not None else limit)
+        if self.embedding is not None:
+            query_vector = self.embedding.embed([query])[0]
+            best = candidates[0][1]
+            reranked = []
+            for doc_id, score in candidates:
+                blob = conn.execute("SELECT embedding FROM docs WHERE id = ?", (doc_id,)).fetchone()[0]
+                similarity = cosine(query_vector, array.array("f", blob)) if blob else 0.0
+                reranked.append((doc_id, score / best * 0.5 + similarity * 0.5))
+            candidates = sorted(reranked, key=lambda item: -item[1])[:limit]
+
+        urls = dict(conn.execute(
+            f"SELECT id, url FROM docs WHERE id IN ({','.join('?' * len(candidates))})",
+            [doc_id for doc_id, _ in candidates]).fetchall())
+        return [(urls[doc_id], score) for doc_id, score in candidates]
+
+    def _delete_sync(self, urls: list[str]) -> int:
+        removed = self._remove_locked(urls)
+        self._connect().commit()
+        return removed
+
+    def _stats_sync(self) -> dict:
+        conn = self._connect()
+        docs = conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+        terms = conn.execute("SELECT COUNT(DISTINCT term) FROM postings").fetchone()[0]
+        return {"docs": docs, "terms": terms}
+
+    async def add(self, url: str, text: str):
+        """ページを索引に追加する (同じ URL は置き換える)"""
+        if text:
+            await self._run(self._add_sync, url, text)
+
+    def add_in_background(self, url: str, text: str):
+        """取得の完了を待たせないように、索引への追加を裏で行う"""
+        if not text:
+            return
+        task = asyncio.ensure_future(self.add(url, text))
+        self._pending.add(task)
+        task.add_done_callback(self._added)
+
+    def _added(self, task: asyncio.Task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Failed to index a page: {str(task.exception())}")
+
+    async def wait_pending(self):
+        """裏で追加中のページがすべて索引に入るまで待つ"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def delete(self, urls: list[str]) -> int:
+        """ページを索引から削除し、削除した件数を返す"""
+        if not urls:
+            return 0
+        return await self._run(self._delete_sync, list(urls))
+
+    async def search(self, query: str, limit: int = 10) -> list[tuple[str, float]]:
+        """query に近いページを (URL, スコア) のリストでスコアの高い順に返す"""
+        return await self._run(self._search_sync, query, limit)
+
+    async def stats(self) -> dict:
+        return await self._run(self._stats_sync)
+
+
+@functools.cache
+def get_local_index() -> LocalIndex:
+    return LocalIndex()
+
+
+async def main():
+    # pagestore は削除したページを索引からも消すためにこのモジュールを使う
+    from .pagestore import DEFAULT_PAGE_STORE_FILE, PageStore
+
+    parser = argparse.ArgumentParser(description="取得済みページの索引のメンテナンス")
+    parser.add_argument("command", choices=["build", "search", "stats"])
+    parser.add_argument("query", nargs="?", default="")
+    parser.add_argument("--index", default=DEFAULT_INDEX_FILE)
+    parser.add_argument("--store", default=DEFAULT_PAGE_STORE_FILE, help="build で取り込む本文ストア")
+    args = parser.parse_args()
+
+    index = LocalIndex(args.index)
+    if args.command == "build":
+        # 索引を作る前から保存されていたページを取り込む
+        store = PageStore(args.store, index=index)
+        count = 0
+        pages = await store.scan()
+        while pages:
+            for url, text in pages:
+                await index.add(url, text)
+            count += len(pages)
+            pages = await store.scan(pages[-1][0])
+        print(f"{count} pages indexed")
+    elif args.command == "search":
+        for url, score in await index.search(args.query):
+            print(f"{score:.3f} {url}")
+    else:
+        print(await index.stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,19 +1,35 @@
 import os
+import copy
 import gradio as gr
 import asyncio
-from typing import Tuple, AsyncGenerator
+from typing import AsyncGenerator, Optional
 import logging
 import markdown
 import json
 import traceback
+import hashlib
+import time
+import functools
+from collections import OrderedDict
 from datetime import datetime
 
-import trafilatura
-from duckduckgo_search import DDGS
-from googleapiclient.discovery import build
-
 from chat_assistant import ChatAssistant
-from pmem.async_pmem import PersistentMemory
+
+from .backends import create_backend
+from .budget import ModelBudget, get_budget
+from .context import build_answer_context
+from .cache import TieredCache, get_cache
+from .fetcher import Fetcher, get_fetcher
+from .extractor import Extractor, get_extractor
+from .events import ProgressEvent, StatusLog, coalesce
+from .crawler import Crawler, CRAWL_MODE_FIFO
+from .dedup import minhash
+from .lexical import RelevanceGate, PREFILTER_OFF
+from .pagestore import PageStore, get_page_store
+from .retrieval import LocalIndex, get_local_index
+from .singleflight import SingleFlight
+from .tracing import Trace, current_trace, span, annotate
+from .urlutil import canonicalize_url, normalize_keyword
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
@@ -88,11 +104,56 @@ ___article___
 ```
 """
 
+prompt_page_analyze_batch = """
+問い合わせ内容を検索して複数の記事を見つけました。記事ごとに以下を行ってください。
+
+1. 問い合わせ内容および記事の関連キーワードと、記事の関連性を10段階 (0 - 10)で評価してください。
+2. 問い合わせを解決するために追加調査すべきキーワードがあれば、そのキーワードを優先度の高い順に ___search_word_count___ 個抽出してください。
+3. 参考にすべきリンクがあれば、そのリンクを優先度の高い順に ___search_word_count___ 個抽出してください。
+4. 問い合わせへの回答作成に参考になる文面を抜粋してください。文字数に限らず、問い合わせおよびキーワードに対する説明および回答作成に参考になる文面を抜粋してください。
+
+記事ごとの結果を記事と同じ順番で JSON の配列として出力してください。"URL" には記事の URL をそのまま記載してください。
+出力にコメントや補足は不要です。
+
+回答フォーマット：
+```json
+[
+{"URL": "https://...",
+"Relevance rating": x (0 - 10),
+"Related links to explore":
+[
+"https://...",
+"https://..."
+],
+"Keywords to research":
+[
+"keyword1",
+"keyword2"
+],
+"Excerpted articles":
+[
+"Excerpted article 1",
+"Excerpted article 2"
+]
+}
+]
+```
+
+問い合わせ内容：
+```question
+___question___
+```
+
+検索した記事：
+___articles___
+"""
+
 prompt_generate_answer = """
 問い合わせ内容を検索して記事を見つけました。
 
 問い合わせ内容と記事の内容を良く読み、関連性をよく考慮して、詳細な情報の回答を作成してください。
-参考にした際には、引用元のURLを明記してください。
+記事の内容は [番号] URL と、その記事からの抜粋の箇条書きです。
+参考にした際には、該当箇所に [1] のように出典の番号を付け、回答の最後に番号と引用元のURLの一覧を記載してください。
 
 問い合わせ内容：
 ___question___
@@ -102,6 +163,44 @@ ___articles___
 """
 
 
+# 回答のストリーミング表示の最大更新回数 (毎秒)
+ANSWER_STREAM_FPS = 8
+
+# 画面を更新する最短間隔 (秒)
+UI_UPDATE_INTERVAL = 0.2
+
+# cache-first で手元の索引から取り出す候補数 (参照記事数に対する倍率)
+LOCAL_CANDIDATES_FACTOR = 2
+
+
+class IncrementalMarkdown:
+    """ストリーミング中の markdown を、確定したブロックだけ追加でレンダリングするクラス"""
+
+    def __init__(self) -> None:
+        self.source = ""
+        self.html = ""
+
+    def render(self, text: str, final: bool = False) -> str:
+        if final:
+            return markdown.markdown(text)
+        if not text.startswith(self.source):
+            self.source = ""
+            self.html = ""
+
+        # コードブロックの外にある最後の空行までを確定したブロックとみなす
+        boundary = len(self.source)
+        position = text.find("\n\n", boundary)
+        while position != -1:
+            if text.count("```", 0, position) % 2 == 0:
+                boundary = position + 2
+            position = text.find("\n\n", position + 2)
+
+        if boundary > len(self.source):
+            self.html += markdown.markdown(text[len(self.source):boundary]) + "\n"
+            self.source = text[:boundary]
+        return self.html + markdown.markdown(text[boundary:])
+
+
 class QueryAnalyzeResult:
     def __init__(self, result, original_query) -> None:
         self.original_query = original_query
@@ -120,141 +219,436 @@ class ArticleAnalyzeResult:
         self.url = result.get('url', "")
         self.article = result.get('article', "")
         self.keyword = result.get('keyword', "")
+        self.tokens_saved = result.get('tokens_saved', 0)
 
 
 class SearchEngine:
     """検索エンジンのクラス"""
 
-    def __init__(self, engine: str) -> None:
+    def __init__(
+            self, 
+            engine: str, 
+            fetcher: Fetcher = None, 
+            extractor: Extractor = None, 
+            cache: TieredCache = None, 
+            use_llm_cache: bool = True, 
+            cache_answers: bool = False, 
+            llm_cache_ttl: float = None,
+            budget: ModelBudget = None,
+            max_batch_size: int = 4,
+            assistant: ChatAssistant = None,
+            search_backend = None,
+            index: LocalIndex = None,
+            page_store: PageStore = None) -> None:
         self.engine = engine.strip().lower()
-        self.assistant = ChatAssistant()
-        self.memory = PersistentMemory("search_cache.db")
+        self.assistant = assistant or ChatAssistant()
+        # (query, max_results) を受け取り検索結果のリストを返す非同期関数 (既定はエンジン名から作る)
+        self.search_backend = search_backend or create_backend(self.engine)
+        self.cache = cache or get_cache()
+        self.fetcher = fetcher or get_fetcher()
+        self.extractor = extractor or get_extractor()
+        self.budget = budget or get_budget()
+        # 抽出済みの本文 (取得時の ETag / Last-Modified を使って再検証する)
+        self.page_store = page_store or get_page_store()
+        # 取得したページの転置索引 (cache-first で手元の記事を探すのに使う)
+        self.index = index or get_local_index()
+        # LLM の応答キャッシュ (use_llm_cache=False で完全にバイパスする)
+        self.use_llm_cache = use_llm_cache
+        self.cache_answers = cache_answers
+        self.llm_cache_ttl = llm_cache_ttl
+        # analyze_batch で1回の LLM 呼び出しにまとめる最大記事数
+        self.max_batch_size = max_batch_size
+        # 先読みと通常の取得が重なった場合などに、同じ URL の取得を1回にまとめる
+        self.inflight_pages = SingleFlight()
+
+    def with_model(self, model: str) -> "SearchEngine":
+        """model を使う実行専用の SearchEngine を返す (キャッシュ・取得・実行中の取得などは共有する)"""
+        search_engine = copy.copy(self)
+        search_engine.assistant = pin_model(self.assistant, model)
+        return search_engine
+
+    def llm_cache_key(self, template: str, inputs: list[str], content: str = "") -> str:
+        """(モデル, プロンプトテンプレート, 正規化した入力, 記事本文) から LLM キャッシュのキーを作る"""
+        key = hashlib.sha256()
+        parts = [
+            self.assistant.model_manager.get_current_model(),
+            hashlib.sha256(template.encode()).hexdigest(),
+            *[normalize_keyword(str(value)) for value in inputs],
+            hashlib.sha256(content.encode()).hexdigest(),
+        ]
+        for part in parts:
+            key.update(part.encode())
+            key.update(b"\0")
+        return key.hexdigest()
+
+    def estimate_tokens(self, text) -> int:
+        if not isinstance(text, str):
+            text = json.dumps(text, ensure_ascii=False)
+        return self.budget.estimate(text, self.assistant.model_manager.get_current_model())
+
+    async def cached_chat(self, template: str, inputs: list[str], content: str, system: str, message: str, json_mode: bool, enabled: bool = True, validate=None):
+        """永続キャッシュを通して LLM を呼び出す (validate を満たさない応答はキャッシュしない)"""
+        annotate(model=self.assistant.model_manager.get_current_model())
+        key = None
+        if self.use_llm_cache and enabled:
+            key = self.llm_cache_key(template, inputs, content)
+            result = await self.cache.load("llm", key)
+            if result is not None:
+                logger.info(f"LLM result found in cache: {message[:50]}")
+                annotate(cache="hit")
+                return result
+
+        # トークン数は ChatAssistant から取得できないため、モデルごとの係数で見積もる
+        annotate(cache="miss", prompt_tokens=self.estimate_tokens(system) + self.estimate_tokens(message))
+        result = await self.assistant.chat(system, message, use_cache=self.use_llm_cache, json_mode=json_mode)
+        annotate(completion_tokens=self.estimate_tokens(result or ""))
+        if key is not None and result and (validate is None or validate(result)):
+            await self.cache.save("llm", key, result, self.llm_cache_ttl)
+        return result
 
-    async def answer(self, question: str, articles: list[ArticleAnalyzeResult]) -> str:
+    def build_answer_context(self, question: str, articles: list[ArticleAnalyzeResult]) -> str:
+        """記事の抜粋を順位付け・重複除去し、モデルの予算内に収めた出典番号付きの文章にする"""
+        model = self.assistant.model_manager.get_current_model()
+        return build_answer_context(question, articles, self.budget.answer_budget(model), self.budget.estimator(model))
+
+    async def answer_stream(self, question: str, articles: list[ArticleAnalyzeResult]) -> AsyncGenerator[str, None]:
+        """回答をストリーミングで生成し、それまでに生成された全文を順に返す"""
+        if not hasattr(self.assistant, "chat_stream"):
+            # ストリーミング非対応の ChatAssistant では一括で生成する
+            yield await self.answer(question, articles)
+            return
+
+        article_text = self.build_answer_context(question, articles)
+        prompt = prompt_generate_answer.replace('___question___', question).replace('___articles___', article_text)
+
+        logger.info(f"Answering (stream): {question}")
+
+        with span("answer", model=self.assistant.model_manager.get_current_model(), articles=len(articles)) as s:
+            key = None
+            if self.use_llm_cache and self.cache_answers:
+                key = self.llm_cache_key(prompt_generate_answer, [question], article_text)
+                result = await self.cache.load("llm", key)
+                if result is not None:
+                    s.set(cache="hit")
+                    yield result
+                    return
+
+            s.set(prompt_tokens=self.estimate_tokens(prompt))
+            result = ""
+            first_chunk = None
+            async for chunk in self.assistant.chat_stream("", prompt, use_cache=self.use_llm_cache, json_mode=False):
+                if first_chunk is None:
+                    first_chunk = time.perf_counter()
+                    s.set(first_chunk_ms=round((first_chunk - s.start) * 1000, 1))
+                result += chunk
+                yield result
+            s.set(completion_tokens=self.estimate_tokens(result))
 
-        average_score = sum([article.relevance_rating for article in articles]) / len(articles)
+            if key is not None and result:
+                await self.cache.save("llm", key, result, self.llm_cache_ttl)
 
-        article_text = ""
-        for article in articles:
-            article_text += f"URL: {article.url}\n{article.excerpted_articles}\n\n"
+    async def answer(self, question: str, articles: list[ArticleAnalyzeResult]) -> str:
+        article_text = self.build_answer_context(question, articles)
         
         logger.info(f"Answering: {question}")
         logger.info(f"Articles: {article_text}")
 
-        result = await self.assistant.chat(
-            "", 
-            prompt_generate_answer.replace('___question___', question).replace('___articles___', article_text), 
-            json_mode=False)
+        with span("answer", articles=len(articles)):
+            result = await self.cached_chat(
+                prompt_generate_answer,
+                [question],
+                article_text,
+                "", 
+                prompt_generate_answer.replace('___question___', question).replace('___articles___', article_text), 
+                json_mode=False,
+                enabled=self.cache_answers)
         
         return result
 
     async def analyze_keyword(self, query: str, keywords_count:int=3) -> QueryAnalyzeResult:
-        result = await self.assistant.chat(prompt_analyze_keyword.replace('___search_word_count___', str(keywords_count)), query, json_mode=True)
+        with span("analyze_keyword"):
+            result = await self.cached_chat(
+                prompt_analyze_keyword,
+                [query, keywords_count],
+                "",
+                prompt_analyze_keyword.replace('___search_word_count___', str(keywords_count)), 
+                query, 
+                json_mode=True)
         return QueryAnalyzeResult(result, query)
     
-    async def analyze(self, question: str, article_url: str, keyword:str, keywords_count:int=3) -> ArticleAnalyzeResult:
-        article_text = await self.page_to_text(article_url)
+    async def analyze(self, question: str, article_url: str, keyword:str, keywords_count:int=3, article_text:str=None) -> ArticleAnalyzeResult:
+        if article_text is None:
+            article_text = await self.page_to_text(article_url)
         if article_text is None:
             return None
-        result = await self.assistant.chat(prompt_page_analyze
-            .replace('___question___', question)
-            .replace('___search_word_count___', str(keywords_count))
-            .replace('___article___', article_text)
-            .replace('___keyword___', keyword)
-            .replace('___URL___', article_url), 
-            article_url, json_mode=True)
+        # モデルのトークン予算に収まるよう、問い合わせに関連する部分だけを送る
+        fitted_text, tokens_saved = self.budget.fit_article(
+            article_text, f"{question} {keyword}", self.assistant.model_manager.get_current_model())
+        with span("analyze", url=article_url, tokens_saved=tokens_saved):
+            result = await self.cached_chat(
+                prompt_page_analyze,
+                [question, keyword, keywords_count, article_url],
+                fitted_text,
+                prompt_page_analyze
+                .replace('___question___', question)
+                .replace('___search_word_count___', str(keywords_count))
+                .replace('___article___', fitted_text)
+                .replace('___keyword___', keyword)
+                .replace('___URL___', article_url), 
+                article_url, json_mode=True)
+        # キャッシュ上のオブジェクトを書き換えないようにコピーする
+        result = dict(result)
         result["question"] = question
         result["url"] = article_url
         result["article"] = article_text
         result["keyword"] = keyword
+        result["tokens_saved"] = tokens_saved
         return ArticleAnalyzeResult(result)
 
-    async def page_to_text(self, url:str) -> str:
-        logger.info(f"Fetching: {url}")
-        text = await self.memory.load(url)
-        if text is not None:
-            return text
-        
-        loop = asyncio.get_event_loop()
-        downloaded = await loop.run_in_executor(None, 
-                                                trafilatura.fetch_url,
-                                                url)
-        text = await loop.run_in_executor(None, 
-                                            trafilatura.extract,
-                                            downloaded,   # filecontent: Any,
-                                            url,          # url: Any | None = None,
-                                            None,     # record_id: Any | None = None,
-                                            False,    # no_fallback: bool = False,
-                                            False,    # favor_precision: bool = False,
-                                            False,    # favor_recall: bool = False,
-                                            True,     # include_comments: bool = True,
-                                            "markdown",   # output_format: str = "txt",
-                                            False,    # tei_validation: bool = False,
-                                            None,    # target_language: Any | None = None,
-                                            True,    # include_tables: bool = True,
-                                            False,    # include_images: bool = False, 
-                                            False,    # include_formatting: bool = False,
-                                            True,    # include_links: bool = False,
-                                            False,    # deduplicate: bool = False,
-                                            None,    # date_extraction_params: Any | None = None,
-                                            True,    # with_metadata: bool = False,
-                                            )
+    async def analyze_batch(self, question: str, items: list[tuple[str, str, str]], keywords_count:int=3, max_batch_size:int=None) -> list[ArticleAnalyzeResult]:
+        """複数の記事 (URL, キーワード, 本文) をまとめて解析する
+
+        モデルのコンテキスト長に収まる範囲で最大 max_batch_size 件ずつ1回の LLM 呼び出しにまとめる。
+        """
+        model = self.assistant.model_manager.get_current_model()
+        estimate = self.budget.estimator(model)
+        max_tokens = self.budget.for_model(model)["context_tokens"] // 2
+        max_batch_size = max_batch_size or self.max_batch_size
+
+        batches = []
+        current = []
+        used = 0
+        for url, keyword, article_text in items:
+            if article_text is None:
+                continue
+            fitted_text, tokens_saved = self.budget.fit_article(article_text, f"{question} {keyword}", model)
+            tokens = estimate(fitted_text)
+            if current and (used + tokens > max_tokens or len(current) >= max_batch_size):
+                batches.append(current)
+                current = []
+                used = 0
+            current.append((url, keyword, article_text, fitted_text, tokens_saved))
+            used += tokens
+        if current:
+            batches.append(current)
+
+        analyzed = await asyncio.gather(*[self._analyze_packed(question, batch, keywords_count) for batch in batches])
+        results = {}
+        for batch, batch_results in zip(batches, analyzed):
+            for item, result in zip(batch, batch_results):
+                results[item[0]] = result
+        return [results.get(url) for url, _, _ in items]
+
+    async def _analyze_packed(self, question: str, batch: list[tuple], keywords_count: int) -> list[ArticleAnalyzeResult]:
+        if len(batch) == 1:
+            url, keyword, article_text, _, _ = batch[0]
+            return [await self.analyze(question, url, keyword, keywords_count, article_text=article_text)]
+
+        articles = ""
+        for index, (url, keyword, _, fitted_text, _) in enumerate(batch):
+            articles += f"```article {index + 1}\nURL: {url}\n関連キーワード: {keyword}\n{fitted_text}\n```\n\n"
+        urls = [item[0] for item in batch]
+
+        def parse(result) -> dict:
+            # {"results": [...]} のように包まれて返ってくる場合も受け付ける
+            if isinstance(result, dict):
+                lists = [value for value in result.values() if isinstance(value, list)]
+                result = lists[0] if len(lists) == 1 else [result]
+            if not isinstance(result, list):
+                return {}
+            entries = [entry for entry in result if isinstance(entry, dict)]
+            parsed = {}
+            for entry in entries:
+                key = canonicalize_url(str(entry.get("URL", "")))
+                for url in urls:
+                    if canonicalize_url(url) == key:
+                        parsed[url] = entry
+            # URL が書き換えられていても件数と順番が一致していれば順番で対応付ける
+            if not parsed and len(entries) == len(batch):
+                parsed = dict(zip(urls, entries))
+            return parsed
+
+        with span("analyze_batch", articles=len(batch)):
+            result = await self.cached_chat(
+                prompt_page_analyze_batch,
+                [question, keywords_count, *[f"{url} {keyword}" for url, keyword, *_ in batch]],
+                articles,
+                prompt_page_analyze_batch
+                .replace('___question___', question)
+                .replace('___search_word_count___', str(keywords_count))
+                .replace('___articles___', articles),
+                "\n".join(urls), json_mode=True,
+                validate=lambda result: len(parse(result)) == len(batch))
+        parsed = parse(result)
+
+        results = {}
+        missing = []
+        for item in batch:
+            url, keyword, article_text, _, tokens_saved = item
+            entry = parsed.get(url)
+            if entry is None:
+                missing.append(item)
+                continue
+            entry = dict(entry)
+            entry["question"] = question
+            entry["url"] = url
+            entry["article"] = article_text
+            entry["keyword"] = keyword
+            entry["tokens_saved"] = tokens_saved
+            results[url] = ArticleAnalyzeResult(entry)
+
+        if missing:
+            # 応答が壊れていた記事はバッチを分割して再試行する
+            logger.warning(f"Malformed batch result: {len(missing)} / {len(batch)} articles missing, splitting")
+            if len(missing) == len(batch):
+                middle = len(batch) // 2
+                halves = await asyncio.gather(
+                    self._analyze_packed(question, batch[:middle], keywords_count),
+                    self._analyze_packed(question, batch[middle:], keywords_count))
+                retried = halves[0] + halves[1]
+            else:
+                retried = await self._analyze_packed(question, missing, keywords_count)
+            for item, analyzed in zip(missing, retried):
+                results[item[0]] = analyzed
+
+        return [results.get(url) for url in urls]
+
+    async def fingerprint(self, article_text: str) -> Optional[tuple]:
+        """本文の MinHash 署名を返す (本文のハッシュをキーにページと同じキャッシュに保存する。トークンが無ければ None)"""
+        key = hashlib.sha256(article_text.encode()).hexdigest()
+        signature = await self.cache.load("fingerprint", key)
+        if signature is None:
+            signature = minhash(article_text)
+            if signature is not None:
+                await self.cache.save("fingerprint", key, signature)
+        return signature
 
-        
-        await self.memory.save(url, text)
+    async def page_to_text(self, url:str) -> str:
+        _, text = await self.fetch_page(url)
         return text
 
+    async def fetch_page(self, url:str) -> tuple[str, str]:
+        """ページを取得して (リダイレクト後の URL, 本文) を返す"""
+        return await self.inflight_pages.run(url, self._fetch_page, url)
+
+    async def _fetch_page(self, url:str) -> tuple[str, str]:
+        logger.info(f"Fetching: {url}")
+        with span("page_to_text", url=url) as s:
+            stored = await self.page_store.load(url)
+            if stored is not None and stored.is_fresh():
+                s.set(cache="hit")
+                return stored.final_url, stored.text
+            
+            # 期限切れのページは条件付きリクエストで変更の有無だけを確かめる
+            headers = stored.conditional_headers() if stored is not None else {}
+            started = time.perf_counter()
+            response = await self.fetcher.fetch(url, headers=headers or None)
+            s.set(cache="miss", fetch_ms=round((time.perf_counter() - started) * 1000, 1))
+            if response is not None:
+                s.set(status=response.status, bytes=len(response.body or b""))
+            if stored is not None and response is not None and response.status == 304:
+                s.set(cache="revalidated")
+                await self.page_store.touch(url)
+                return stored.final_url, stored.text
+            if stored is not None and (response is None or response.status >= 500):
+                # 一時的な障害の間は古い本文を使う
+                logger.info(f"Using stale page: {url}")
+                s.set(cache="stale")
+                return stored.final_url, stored.text
+
+            downloaded = None
+            final_url = url
+            if response is not None and response.status == 200 and response.body:
+                downloaded = response.html
+                final_url = response.final_url
+            
+            started = time.perf_counter()
+            text = await self.extractor.extract(downloaded, url)
+            s.set(extract_ms=round((time.perf_counter() - started) * 1000, 1), extracted=text is not None)
+            
+            if text is not None:
+                changed = await self.page_store.save(url, final_url, text, response.status, response.headers)
+                if changed:
+                    self.index.add_in_background(url, text)
+            return final_url, text
+
+    async def search_local(self, query: str, limit: int = 10) -> list[str]:
+        """取得済みのページから query に近いものの URL を返す"""
+        with span("search_local", query=query) as s:
+            hits = await self.index.search(query, limit)
+            s.set(results=len(hits))
+        return [url for url, _ in hits]
+
     async def search(self, query:str, max_results:int=3) -> list[dict[str, str]]:
+        with span("search", query=query, engine=self.engine) as s:
+            results = await self._search(query, max_results)
+            s.set(results=len(results))
+            return results
+
+    async def _search(self, query:str, max_results:int=3) -> list[dict[str, str]]:
         logger.info(f"Searching: {query}")
-        key = f"search_{query}_{max_results}_{self.engine}"
+        key = f"{query}_{max_results}_{self.engine}"
         query = query.strip()
-        results = await self.memory.load(key)
+        results = await self.cache.load("search", key)
         if results is not None:
             logger.info(f"Search results found in memory: {query}")
+            annotate(cache="hit")
             return results
-        
-        def ddg_search():
-            with DDGS() as ddgs:
-                return list(ddgs.text(
-                    keywords=query,
-                    region='wt-wt',
-                    safesearch='off',
-                    timelimit=None,
-                    max_results=max_results
-                ))
-        
-        def ggl_search():
-            service = build(
-                "customsearch", "v1", developerKey=os.getenv("GOOGLE_SEARCH_API_KEY")
-            )
-
-            res = (
-                service.cse().list(
-                    fields="items(title,snippet,link)",
-                    q=query,
-                    cx=os.getenv("GOOGLE_SEARCH_ENGUINE_ID"),
-                ).execute()
-            )
-
-            return res.get('items', [])
-        
-        loop = asyncio.get_event_loop()
+        annotate(cache="miss")
 
         results = []
-        if self.engine == "duckduckgo":
-            results = await loop.run_in_executor(None, ddg_search)
-        elif self.engine == "google":
-            results = await loop.run_in_executor(None, ggl_search)
-        else:
-            logger.error(f"Unknown search engine: {self.engine}")
-        
-        results = results[:max_results]
+        if self.search_backend is not None:
+            results = (await self.search_backend(query, max_results))[:max_results]
         
-        await self.memory.save(key, results)
+        await self.cache.save("search", key, results)
         logger.info(f"Search results saved to memory: {query}")
         return results
 
 
+def pin_model(assistant, model: str):
+    """モデル設定だけを複製した assistant を返す (それ以外の状態・接続は元と共有する)
+
+    ChatAssistant は失敗するたびに model_manager.next_model() で次のモデルに切り替えるので、
+    model_manager を共有すると、1回の切り替えが以降の検索すべてに残ってしまう。
+    """
+    pinned = copy.copy(assistant)
+    pinned.model_manager = copy.copy(assistant.model_manager)
+    pinned.model_manager.change_model(model)
+    return pinned
+
+
+class EnginePool:
+    """検索エンジンごとに SearchEngine を使い回すレジストリ
+
+    ChatAssistant・HTTP 接続・キャッシュの接続を検索のたびに作り直さないようにする。
+    get() は実行ごとにモデル設定だけを持ち替えた SearchEngine を返すので、同時に検索する利用者同士で
+    モデル設定が混ざらず、失敗時のモデルの切り替えも次の検索に持ち越されない。
+    """
+
+    def __init__(self, factory=None, max_engines: int = 16) -> None:
+        self.factory = factory or SearchEngine
+        self.max_engines = max_engines
+        self.engines = OrderedDict()
+
+    def get(self, engine: str, model: str) -> SearchEngine:
+        key = engine.strip().lower()
+        search_engine = self.engines.get(key)
+        if search_engine is None:
+            logger.info(f"Creating search engine: {key}")
+            search_engine = self.factory(engine)
+            self.engines[key] = search_engine
+            while len(self.engines) > self.max_engines:
+                self.engines.popitem(last=False)
+        else:
+            self.engines.move_to_end(key)
+        return search_engine.with_model(model)
+
+
+@functools.cache
+def get_engine_pool() -> EnginePool:
+    return EnginePool()
+
+
 class ProgressTracker:
     """進捗追跡クラス"""
     def __init__(self):
@@ -267,9 +661,14 @@ class ProgressTracker:
 
 
 class SearchInterface:
-    def __init__(self):
-        self.search_engine = None
+    def __init__(self, engine_factory=None):
+        # engine 名から SearchEngine を作る関数 (ベンチマークではフェイクを注入する)。
+        # 省略時はプロセス内で共有する EnginePool から取得する
+        self.engines = EnginePool(engine_factory) if engine_factory else get_engine_pool()
         self.progress_tracker = ProgressTracker()
+        # 直近の実行の計測結果 (TRACE_DIR を指定すると実行ごとにファイルへ書き出す)
+        self.last_trace = None
+        self.trace_dir = os.getenv("TRACE_DIR") or None
 
     async def process_search(
         self, query: str, 
@@ -279,103 +678,102 @@ class SearchInterface:
         max_articles: int, 
         article_quality: int, 
         model: str,
-        engine: str
-    ) -> AsyncGenerator[Tuple[float, str, str], None]:
+        engine: str,
+        crawl_mode: str = CRAWL_MODE_FIFO,
+        prefilter: str = PREFILTER_OFF,
+        prefilter_threshold: float = 0.2,
+        batch_size: int = 1,
+        time_limit: float = None,
+        prefetch_top_k: int = 2,
+        cache_first: bool = False
+    ) -> AsyncGenerator[ProgressEvent, None]:
         
-        self.search_engine = SearchEngine(engine)
+        # 実行ごとの状態 (記事・進捗・計測) はローカル変数と Crawler に持たせ、SearchEngine は共有する
+        search_engine = self.engines.get(engine, model)
+        trace = Trace(query=query, model=model, engine=engine, crawl_mode=crawl_mode, max_depth=max_depth, max_articles=max_articles, batch_size=batch_size)
+        self.last_trace = trace
+        trace_token = current_trace.set(trace)
 
         try:
-            yield 0.0, "検索を開始します...", ""
+            yield ProgressEvent(0.0, "検索を開始します...", "")
             await asyncio.sleep(0.1)
 
-            # モデルの変更
-            yield 0.0, f"使用AIモデル: {model}", ""
-            self.search_engine.assistant.model_manager.change_model(model)
+            yield ProgressEvent(0.0, f"使用AIモデル: {model}", "")
             
-            yield 0.1, "検索キーワードを解析...", ""
-            analyze_user = await self.search_engine.analyze_keyword(query, keywords_count)
-            yield 0.1, "検索キーワードを解析完了", ""
-
-            yield 0.1, f"分析結果 : {analyze_user.fulltext_question}", ""
-            yield 0.1, f"検索キーワード : {analyze_user.search_words + analyze_user.search_words_english}", ""
-
-            search_semaphore = asyncio.Semaphore(max_threads)
-            analyze_semaphore = asyncio.Semaphore(max_threads)
-
-            # async analyze article results
-            articles = []
-
-            async def search_and_analyze(keyword, depth):
-                await asyncio.sleep(0.1)
-                if depth > max_depth:
-                    return
-                if len(articles) >= max_articles:
-                    return
-
-                yield 0.2 + (len(articles) / max_articles / 2), f"検索中: {keyword} (深さ: {depth})", ""
-
-                async with search_semaphore:
-                    results = await self.search_engine.search(keyword)
-
-                yield 0.2 + (len(articles) / max_articles / 2), f"検索完了: {keyword} - {len(results)}件の結果", ""
-
-                for search_result in results:
-                    url = search_result.get('href', search_result.get('link', ""))
-                    async for progress, status, result in analyze_and_follow(url, keyword, depth+1):
-                        yield progress, status, result
-
-            async def analyze_and_follow(url, keyword, depth):
-                await asyncio.sleep(0.1)
-                if depth > max_depth:
-                    return
-                if len(articles) >= max_articles:
-                    return
-
-                yield 0.3 + (len(articles) / max_articles / 2), f"記事を解析中: {url} (深さ: {depth})", ""
-
-                async with analyze_semaphore:
-                    try:
-                        analyzed_url = await self.search_engine.analyze(analyze_user.fulltext_question, url, keyword)
-                        if analyzed_url is not None:
-                            if analyzed_url.relevance_rating >= article_quality:
-                                articles.append(analyzed_url)
-                            yield 0.3 + (len(articles) / max_articles / 2), f"記事の解析完了: {url}\nスコア ( {analyzed_url.relevance_rating} / 10 )", ""
-                            if len(articles) >= max_articles:
-                                return
-                        else:
-                            logger.error(f"url none: {url}")
-                            yield 0.3 + (len(articles) / max_articles / 2), f"記事の解析失敗: {url}", ""
-                            return
-                    except Exception as e:
-                        logger.error(f"記事の解析でエラーが発生: {str(e)}")
-                        yield 0.3 + (len(articles) / max_articles / 2), f"記事の解析エラー: {url} - {str(e)}", ""
-                        return
-
-                for keyword in analyzed_url.keywords:
-                    async for progress, status, result in search_and_analyze(keyword, depth+1):
-                        yield progress, status, result
-                for link in analyzed_url.related_links:
-                    async for progress, status, result in analyze_and_follow(link, keyword, depth+1):
-                        yield progress, status, result
-
-            # 初期のキーワードで検索と解析を開始
-            for keyword in (analyze_user.search_words + analyze_user.search_words_english):
-                async for progress, status, result in search_and_analyze(keyword, 1):
-                    yield progress, status, result
-
-            yield 0.8, "集計中...", ""
-            yield 0.8, f"検索記事数: {len(articles)}", ""
-
-            yield 0.9, "検索結果を整理中...", ""
-            result = await self.search_engine.answer(analyze_user.fulltext_question, articles)
+            yield ProgressEvent(0.1, "検索キーワードを解析...", "")
+            analyze_user = await search_engine.analyze_keyword(query, keywords_count)
+            yield ProgressEvent(0.1, "検索キーワードを解析完了", "")
+
+            yield ProgressEvent(0.1, f"分析結果 : {analyze_user.fulltext_question}", "")
+            yield ProgressEvent(0.1, f"検索キーワード : {analyze_user.search_words + analyze_user.search_words_english}", "")
+
+            # 検索と記事解析を max_threads 個のワーカーで並列に処理する
+            crawler = Crawler(
+                search_engine,
+                analyze_user.fulltext_question,
+                max_depth,
+                max_threads,
+                max_articles,
+                article_quality,
+                crawl_mode,
+                RelevanceGate(prefilter_threshold, prefilter),
+                batch_size,
+                time_limit,
+                prefetch_top_k)
+
+            local_urls = []
+            if cache_first:
+                local_urls = await search_engine.search_local(
+                    " ".join([analyze_user.fulltext_question] + analyze_user.search_words),
+                    max_articles * LOCAL_CANDIDATES_FACTOR)
+                yield ProgressEvent(0.2, f"手元の記事の候補: {len(local_urls)}件", "")
+
+            # 初期のキーワードで検索と解析を開始 (cache-first では手元の記事で足りないときだけ Web を検索する)
+            async for event in crawler.run(analyze_user.search_words + analyze_user.search_words_english, local_urls):
+                yield event
+
+            articles = crawler.articles
+            if crawler.tokens_saved:
+                yield ProgressEvent(0.8, f"記事の切り詰めで削減したトークン数: {crawler.tokens_saved}", "")
+            if crawler.prefilter_skipped:
+                yield ProgressEvent(0.8, f"事前フィルタで除外した記事数: {crawler.prefilter_skipped}", "")
+            if crawler.duplicates_skipped:
+                yield ProgressEvent(0.8, f"内容の重複で除外した記事数: {crawler.duplicates_skipped}", "")
+            if crawler.local_candidates:
+                yield ProgressEvent(0.8, f"手元の記事から採用した記事数: {crawler.local_articles} / {crawler.local_candidates}", "")
+            if crawler.prefetcher.prefetched:
+                yield ProgressEvent(0.8, f"先読みした記事数: {crawler.prefetcher.prefetched} (うち解析に使用: {crawler.prefetcher.used})", "")
+
+            yield ProgressEvent(0.8, "集計中...", "")
+            yield ProgressEvent(0.8, f"検索記事数: {len(articles)}", "")
+
+            yield ProgressEvent(0.9, "検索結果を整理中...", "")
+            result = ""
+            last_update = 0.0
+            async for result in search_engine.answer_stream(analyze_user.fulltext_question, articles):
+                # 画面の更新は一定のフレームレートに間引く
+                now = time.monotonic()
+                if now - last_update >= 1 / ANSWER_STREAM_FPS:
+                    last_update = now
+                    yield ProgressEvent(0.9, "回答を生成中...", result)
+
+            yield ProgressEvent(0.9, trace.summary_text(), result)
+            if self.trace_dir:
+                paths = trace.export(self.trace_dir)
+                logger.info(f"Trace exported: {paths}")
 
             # 完了
-            yield 1.0, "検索完了!", result
+            yield ProgressEvent(1.0, "検索完了!", result)
 
         except Exception as e:
             logger.error(f"検索処理でエラーが発生: {str(e)}")
-            yield 0.0, f"エラーが発生しました: {str(e)}", ""
+            yield ProgressEvent(0.0, f"エラーが発生しました: {str(e)}", "")
             logger.error(traceback.format_exc())
+        finally:
+            try:
+                current_trace.reset(trace_token)
+            except ValueError:
+                pass
 
 
 async def search(
@@ -387,23 +785,42 @@ async def search(
         article_quality: int, 
         model: str,
         search_engine: str,
-        output_format:str="html"
+        output_format:str="html",
+        crawl_mode:str=CRAWL_MODE_FIFO,
+        prefilter:str=PREFILTER_OFF,
+        prefilter_threshold:float=0.2,
+        batch_size:int=1,
+        time_limit:float=None,
+        prefetch_top_k:int=2,
+        cache_first:bool=False
         ) -> AsyncGenerator[list, None]:
 
     search_interface = SearchInterface()
 
     outputs = []
-    status_log = []
-    async for progress, status, result in search_interface.process_search(
-        query, keywords_count, depth, threads, articles, article_quality, model, search_engine):
-        status_log.append(status)
-        if output_format == "html":
-            output_data = "<hr />" + markdown.markdown(result) + "<hr />"
-        else:
-            output_data = result
+    status_log = StatusLog()
+    renderer = IncrementalMarkdown()
+    rendered_result = None
+    output_data = ""
+    events = search_interface.process_search(
+        query, keywords_count, depth, threads, articles, article_quality, model, search_engine, crawl_mode,
+        prefilter, prefilter_threshold, batch_size, time_limit, prefetch_top_k, cache_first)
+    # 短時間に届いたイベントはまとめて1回の画面更新にする
+    async for batch in coalesce(events, UI_UPDATE_INTERVAL):
+        for event in batch:
+            status_log.append(event.status)
+        progress, _, result = batch[-1]
+        final = progress >= 1.0
+        # 回答が変わったときだけ markdown をレンダリングする
+        if result != rendered_result or final:
+            rendered_result = result
+            if output_format == "html":
+                output_data = "<hr />" + renderer.render(result, final=final) + "<hr />"
+            else:
+                output_data = result
         outputs = [
             max(0, min(100, progress * 100)),  # progress_bar の値
-            '\n'.join(status_log),         # progress_text の値
+            status_log.text(),         # progress_text の値
             output_data  # result_output の値
         ]
         yield outputs
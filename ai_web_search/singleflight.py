@@ -0,0 +1,45 @@
+import asyncio
+from functools import partial
+
+
+class SingleFlight:
+    """同じキーの同時実行を1回にまとめるクラス
+
+    実行中のキーで呼ばれた場合は新しく実行せず、実行中の結果を共有する。
+    待っている呼び出し元の1つがキャンセルされても処理は続け、全員がキャンセルされたときだけ止める。
+    """
+
+    def __init__(self) -> None:
+        self.tasks = {}
+        self.waiters = {}
+
+    def running(self, key) -> bool:
+        task = self.tasks.get(key)
+        return task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop()
+
+    def _finished(self, key, task: asyncio.Task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+        # 呼び出し元が全員キャンセルされていても例外を回収しておく
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key, func, *args):
+        if not self.running(key):
+            task = asyncio.ensure_future(func(*args))
+            self.tasks[key] = task
+            self.waiters[task] = 0
+            task.add_done_callback(partial(self._finished, key))
+        task = self.tasks[key]
+        self.waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self.waiters[task] -= 1
+            if not self.waiters[task]:
+                del self.waiters[task]
+                if not task.done():
+                    # 止めている最中のタスクに後から来た呼び出しが相乗りしないよう、先に外しておく
+                    if self.tasks.get(key) is task:
+                        del self.tasks[key]
+                    task.cancel()
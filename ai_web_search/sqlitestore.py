@@ -0,0 +1,40 @@
+import sqlite3
+import asyncio
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SQLiteStore:
+    """1つの SQLite ファイルを専用スレッドから扱うストアの基底クラス
+
+    sqlite の接続は作ったスレッドでしか使えないので、接続は最初に使うときに専用スレッドで開き、
+    読み書きは _xxx_sync メソッドを _run に渡してそのスレッドで実行する。
+    表の作成など接続を開いたときの処理は派生クラスの _setup に書く。
+    """
+
+    # 専用スレッドの名前と、sqlite3.connect に渡すトランザクションの扱い (None なら自動コミット)
+    thread_name = "sqlite"
+    isolation_level: Optional[str] = ""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.thread_name)
+        self._conn = None
+
+    def _setup(self, conn: sqlite3.Connection):
+        """接続を開いたときに表を作る (専用スレッドで呼ばれる)"""
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=self.isolation_level)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._setup(conn)
+            if conn.in_transaction:
+                conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """計測区間"""
+
+    def __init__(self, name: str, span_id: int, parent_id: Optional[int], lane: str, attrs: dict) -> None:
+        self.name = name
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.lane = lane
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            "name": self.name,
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "lane": self.lane,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration_ms, 3),
+            **self.attrs,
+        }
+
+
+class Trace:
+    """1回の検索実行の計測結果"""
+
+    def __init__(self, run_id: str = None, **attrs) -> None:
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.attrs = attrs
+        self.spans = []
+        self.origin = time.perf_counter()
+        self.started_at = time.time()
+
+    def start_span(self, name: str, attrs: dict) -> Span:
+        parent = current_span.get()
+        try:
+            lane = asyncio.current_task().get_name()
+        except RuntimeError:
+            lane = "main"
+        span = Span(name, len(self.spans) + 1, parent.span_id if parent else None, lane, attrs)
+        self.spans.append(span)
+        return span
+
+    def to_jsonl(self) -> str:
+        header = {"run_id": self.run_id, "started_at": self.started_at, **self.attrs}
+        lines = [json.dumps(header, ensure_ascii=False, default=str)]
+        lines += [json.dumps(span.to_dict(self.origin), ensure_ascii=False, default=str) for span in self.spans]
+        return "\n".join(lines) + "\n"
+
+    def to_chrome_trace(self) -> dict:
+        """chrome://tracing や Perfetto で読み込める形式"""
+        lanes = {}
+        events = []
+        for span in self.spans:
+            tid = lanes.setdefault(span.lane, len(lanes) + 1)
+            events.append({
+                "name": span.name,
+                "ph": "X",
+                "ts": round((span.start - self.origin) * 1_000_000),
+                "dur": round(span.duration_ms * 1000),
+                "pid": 1,
+                "tid": tid,
+                "args": span.attrs,
+            })
+        for lane, tid in lanes.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": lane}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"run_id": self.run_id, **self.attrs}}
+
+    def export(self, directory: str) -> list[str]:
+        os.makedirs(directory, exist_ok=True)
+        jsonl_path = os.path.join(directory, f"{self.run_id}.jsonl")
+        chrome_path = os.path.join(directory, f"{self.run_id}.trace.json")
+        with open(jsonl_path, "w", encoding="utf-8") as f:
+            f.write(self.to_jsonl())
+        with open(chrome_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_chrome_trace(), f, ensure_ascii=False, default=str)
+        return [jsonl_path, chrome_path]
+
+    def summary(self) -> dict:
+        """処理段階ごとの回数・合計時間と、トークン数・取得バイト数・キャッシュヒット数の集計"""
+        stages = {}
+        totals = {"prompt_tokens": 0, "completion_tokens": 0, "bytes": 0, "cache_hits": 0, "cache_misses": 0}
+        for span in self.spans:
+            stage = stages.setdefault(span.name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stage["count"] += 1
+            stage["total_ms"] += span.duration_ms
+            stage["max_ms"] = max(stage["max_ms"], span.duration_ms)
+            totals["prompt_tokens"] += span.attrs.get("prompt_tokens", 0)
+            totals["completion_tokens"] += span.attrs.get("completion_tokens", 0)
+            totals["bytes"] += span.attrs.get("bytes", 0)
+            if "cache" in span.attrs:
+                totals["cache_hits" if span.attrs["cache"] == "hit" else "cache_misses"] += 1
+        return {
+            "run_id": self.run_id,
+            "wall_ms": (time.perf_counter() - self.origin) * 1000,
+            "stages": stages,
+            **totals,
+        }
+
+    def summary_text(self) -> str:
+        summary = self.summary()
+        lines = [f"処理時間: {summary['wall_ms'] / 1000:.1f} 秒 (run: {summary['run_id']})"]
+        for name, stage in sorted(summary["stages"].items(), key=lambda item: -item[1]["total_ms"]):
+            lines.append(f"  {name}: {stage['count']} 回 / 合計 {stage['total_ms'] / 1000:.1f} 秒 / 最大 {stage['max_ms'] / 1000:.1f} 秒")
+        lines.append(
+            f"  トークン (推定): 入力 {summary['prompt_tokens']} / 出力 {summary['completion_tokens']}"
+            f" / 取得 {summary['bytes'] / 1024:.0f} KB"
+            f" / キャッシュ {summary['cache_hits']} ヒット, {summary['cache_misses']} ミス")
+        return "\n".join(lines)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """現在の Trace に計測区間を記録する (Trace が無い場合は何も記録しない)"""
+    trace = current_trace.get()
+    if trace is None:
+        yield Span(name, 0, None, "", attrs)
+        return
+    item = trace.start_span(name, attrs)
+    token = current_span.set(item)
+    try:
+        yield item
+    except asyncio.CancelledError:
+        item.set(status="cancelled")
+        raise
+    except Exception as e:
+        item.set(status="error", error=str(e))
+        raise
+    finally:
+        item.end = time.perf_counter()
+        try:
+            current_span.reset(token)
+        except ValueError:
+            # 非同期ジェネレータが別のコンテキストで閉じられた場合
+            pass
+
+
+def annotate(**attrs):
+    """実行中の計測区間に属性を追加する"""
+    item = current_span.get()
+    if item is not None:
+        item.set(**attrs)
@@ -0,0 +1,139 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from duckduckgo_search.exceptions import RatelimitException
+
+from ai_web_search import backends
+from ai_web_search.backends import (
+    FederatedBackend, SearchBackend, SearchScheduler, TokenBucket, is_rate_limited, normalize_result, reciprocal_rank_fusion)
+
+
+def hit(url: str, title: str = "") -> dict:
+    return {"href": url, "title": title, "body": ""}
+
+
+class StaticBackend(SearchBackend):
+    def __init__(self, name: str, results: list[dict], delay: float = 0.0, error: Exception = None) -> None:
+        self.name = name
+        self.results = results
+        self.delay = delay
+        self.error = error
+
+    async def search(self, query: str, max_results: int) -> list[dict]:
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return self.results
+
+
+def test_normalize_result_maps_google_keys():
+    assert normalize_result({"title": "t", "link": "https://example.com/", "snippet": "s"}) == {
+        "title": "t", "href": "https://example.com/", "body": "s"}
+
+
+def test_reciprocal_rank_fusion_merges_duplicates_and_ranks_shared_results_first():
+    fused = reciprocal_rank_fusion({
+        "a": [hit("https://example.com/only-a"), hit("https://www.example.com/shared#top", "from a")],
+        "b": [hit("https://example.com/shared", "from b"), hit("https://example.com/only-b")],
+    })
+    assert [result["href"] for result in fused] == [
+        "https://www.example.com/shared#top", "https://example.com/only-a", "https://example.com/only-b"]
+    assert fused[0]["title"] == "from a"
+    assert fused[0]["engines"] == ["a", "b"]
+
+
+def test_reciprocal_rank_fusion_skips_results_without_url():
+    assert reciprocal_rank_fusion({"a": [hit(""), hit("https://example.com/")]})[0]["engines"] == ["a"]
+    assert len(reciprocal_rank_fusion({"a": [hit("")]})) == 0
+
+
+def test_federated_backend_tolerates_failures_and_stops_waiting_for_slow_engines():
+    backend = FederatedBackend([
+        StaticBackend("fast", [hit("https://example.com/a")]),
+        StaticBackend("broken", [], error=RuntimeError("rate limited")),
+        StaticBackend("slow", [hit("https://example.com/b")], delay=5),
+    ], timeout=10, grace=0.05)
+    results = asyncio.run(backend("python", max_results=5))
+    assert [result["href"] for result in results] == ["https://example.com/a"]
+    assert results[0]["engines"] == ["fast"]
+
+
+def test_is_rate_limited_detects_ddg_and_http_429():
+    assert is_rate_limited(RatelimitException("slow down"))
+    assert is_rate_limited(Exception()) is False
+    error = Exception()
+    error.resp = SimpleNamespace(status=429)
+    assert is_rate_limited(error)
+
+
+def test_token_bucket_allows_a_burst_then_spaces_requests():
+    async def main():
+        bucket = TokenBucket(rate=20, capacity=2)
+        started = time.monotonic()
+        await bucket.acquire()
+        await bucket.acquire()
+        burst = time.monotonic() - started
+        await bucket.acquire()
+        return burst, time.monotonic() - started
+    burst, total = asyncio.run(main())
+    assert burst < 0.02
+    assert total >= 0.04
+
+
+class FlakyRequest:
+    def __init__(self, failures: int, error: Exception = None) -> None:
+        self.failures = failures
+        self.error = error or RatelimitException("slow down")
+        self.calls = 0
+
+    async def __call__(self, query: str, max_results: int) -> list[dict]:
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if self.calls <= self.failures:
+            raise self.error
+        return [hit(f"https://example.com/{query}")]
+
+
+@pytest.fixture
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(backends, "BACKOFF_BASE", 0.01)
+    monkeypatch.setattr(backends, "MAX_RETRIES", 2)
+
+
+def test_scheduler_backs_off_and_retries_when_rate_limited(fast_backoff):
+    scheduler = SearchScheduler("test", rate=1000, capacity=10)
+    request = FlakyRequest(failures=2)
+    results = asyncio.run(scheduler.run(request, "python", 3))
+    assert results == [hit("https://example.com/python")]
+    assert request.calls == 3
+    assert scheduler.blocked_until > 0
+
+
+def test_scheduler_raises_other_errors_and_gives_up_after_max_retries(fast_backoff):
+    scheduler = SearchScheduler("test", rate=1000, capacity=10)
+    request = FlakyRequest(failures=1, error=ValueError("bad query"))
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.run(request, "python", 3))
+    assert request.calls == 1
+
+    request = FlakyRequest(failures=10)
+    with pytest.raises(RatelimitException):
+        asyncio.run(scheduler.run(request, "python", 3))
+    assert request.calls == 3
+
+
+def test_scheduler_coalesces_identical_queries_and_survives_cancelled_callers():
+    scheduler = SearchScheduler("test", rate=1000, capacity=10)
+    request = FlakyRequest(failures=0)
+
+    async def main():
+        first = asyncio.create_task(scheduler.run(request, "Python", 3))
+        second = asyncio.create_task(scheduler.run(request, "python ", 3))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+    assert asyncio.run(main()) == [hit("https://example.com/Python")]
+    assert request.calls == 1
+    assert scheduler.inflight.tasks == {}
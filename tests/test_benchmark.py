@@ -0,0 +1,42 @@
+import asyncio
+
+from ai_web_search.benchmark import find_regressions, run_case
+from ai_web_search.crawler import CRAWL_MODE_BEST
+from ai_web_search.fakes import Fixtures
+
+PARAMS = {
+    "keywords_count": 2,
+    "article_quality": 6,
+    "model": "fake-model",
+    "engine": "fake",
+    "crawl_mode": CRAWL_MODE_BEST,
+    "batch_size": 1,
+    "max_depth": 2,
+    "max_threads": 2,
+    "max_articles": 3,
+}
+LATENCIES = {"search": 0.0, "fetch": 0.0, "llm": 0.0}
+
+
+def result(wall_s: float, llm_calls: int, ok: bool = True) -> dict:
+    return {
+        "depth": 1, "threads": 1, "articles": 5, "run": "cold", "ok": ok,
+        "wall_s": wall_s, "llm_calls": llm_calls, "fetch_calls": 10, "search_calls": 3,
+    }
+
+
+def test_find_regressions_reports_failures_and_slower_metrics():
+    baseline = [result(1.0, 10)]
+    assert find_regressions([result(1.1, 10)], baseline, 0.25) == []
+    assert find_regressions([result(2.0, 10)], baseline, 0.25) == ["(1, 1, 5, 'cold'): wall_s 1.0 -> 2.0"]
+    assert find_regressions([result(1.0, 20, ok=False)], baseline, 0.25) == [
+        "(1, 1, 5, 'cold'): failed", "(1, 1, 5, 'cold'): llm_calls 10 -> 20"]
+
+
+def test_run_case_replays_synthetic_fixtures_offline():
+    fixtures = Fixtures.synthetic(pages=12, paragraphs=3)
+    cold, warm = asyncio.run(run_case(fixtures, PARAMS, LATENCIES, warm=True))
+    assert cold["ok"] and warm["ok"]
+    assert cold["llm_calls"] > 0 and cold["fetch_calls"] > 0
+    assert warm["fetch_calls"] < cold["fetch_calls"]
+    assert warm["cache_hit_rate"] > cold["cache_hit_rate"]
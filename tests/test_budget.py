@@ -0,0 +1,35 @@
+import json
+
+from ai_web_search.budget import ModelBudget
+
+
+def write_limits(tmp_path) -> str:
+    path = tmp_path / "model_limits.json"
+    path.write_text(json.dumps({
+        "default": {"article_tokens": 50},
+        "small": {"context_tokens": 40, "cjk_tokens_per_char": 2.0},
+    }), encoding="utf-8")
+    return str(path)
+
+
+def test_for_model_layers_model_limits_over_defaults(tmp_path):
+    budget = ModelBudget(write_limits(tmp_path))
+    assert budget.for_model("unknown")["article_tokens"] == 50
+    assert budget.for_model("small")["context_tokens"] == 40
+    assert budget.estimate("日本語", "unknown") == 3 + 1
+    assert budget.estimate("日本語", "small") == 6 + 1
+
+
+def test_missing_limits_file_falls_back_to_defaults(tmp_path):
+    budget = ModelBudget(str(tmp_path / "missing.json"))
+    assert budget.for_model("any")["context_tokens"] == 32000
+
+
+def test_fit_article_trims_to_half_the_context_and_reports_savings(tmp_path):
+    budget = ModelBudget(write_limits(tmp_path))
+    text = "# Title\n\n" + "\n\n".join(f"## paragraph {i}\n\n" + "word " * 5 for i in range(10))
+    assert budget.fit_article("# Title\n\nshort", "paragraph", "small") == ("# Title\n\nshort", 0)
+    fitted, saved = budget.fit_article(text, "paragraph 3", "small")
+    assert budget.estimate(fitted, "small") < budget.estimate(text, "small")
+    assert saved == budget.estimate(text, "small") - budget.estimate(fitted, "small")
+    assert "paragraph 3" in fitted
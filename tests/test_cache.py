@@ -0,0 +1,51 @@
+import asyncio
+
+from ai_web_search.cache import LRUCache, TieredCache
+
+
+def test_lru_cache_drops_least_recently_used_entries():
+    lru = LRUCache(max_entries=2, max_bytes=100)
+    lru.set("a", 1, 10, None)
+    lru.set("b", 2, 10, None)
+    lru.get("a")
+    lru.set("c", 3, 10, None)
+    assert lru.get("b") is None
+    assert lru.get("a") is not None
+    assert lru.total_bytes == 20
+
+
+def test_lru_cache_skips_values_larger_than_the_budget():
+    lru = LRUCache(max_entries=10, max_bytes=5)
+    lru.set("a", "x" * 100, 100, None)
+    assert lru.get("a") is None
+    assert lru.total_bytes == 0
+
+
+def test_tiered_cache_reads_back_from_disk_and_expires(tmp_path):
+    async def main():
+        cache = TieredCache(str(tmp_path / "cache.db"))
+        await cache.save("search", "python", ["https://example.com/"])
+        await cache.save("page", "old", "本文", ttl=-1)
+        cache.memory = LRUCache(16, 1024 * 1024)
+        assert await cache.load("search", "python") == ["https://example.com/"]
+        assert await cache.load("page", "old", "missing") == "missing"
+        return cache.get_stats()
+    stats = asyncio.run(main())
+    assert stats["disk_hits"] == 1
+    assert stats["expired"] == 1
+
+
+def test_tiered_cache_evicts_least_recently_accessed_entries(tmp_path):
+    async def main():
+        cache = TieredCache(str(tmp_path / "cache.db"), max_bytes=10 ** 6)
+        for i in range(20):
+            await cache.save("page", str(i), "x" * 1000)
+        cache.memory = LRUCache(16, 1024 * 1024)
+        await cache.load("page", "0")
+        evicted = await cache._run(cache._evict_sync, 10 * 1024)
+        return cache, evicted
+    cache, evicted = asyncio.run(main())
+    assert evicted > 0
+    assert cache.total_bytes <= 10 * 1024
+    assert asyncio.run(cache.load("page", "0")) is not None
+    assert asyncio.run(cache.load("page", "1")) is None
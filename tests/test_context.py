@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+from ai_web_search.context import build_answer_context, collect_excerpts, dedupe_excerpts
+from ai_web_search.lexical import estimate_tokens
+
+
+def article(url: str, rating: int, *excerpts) -> SimpleNamespace:
+    return SimpleNamespace(url=url, relevance_rating=rating, excerpted_articles=list(excerpts))
+
+
+def test_collect_excerpts_ranks_by_rating_and_overlap():
+    articles = [
+        article("https://example.com/low", 3, "python asyncio tasks"),
+        article("https://example.com/high", 9, "unrelated text", "python asyncio event loop"),
+    ]
+    excerpts = collect_excerpts("python asyncio", articles)
+    assert [excerpt.text for excerpt in excerpts] == [
+        "python asyncio event loop", "unrelated text", "python asyncio tasks"]
+
+
+def test_dedupe_excerpts_drops_contained_excerpts():
+    articles = [
+        article("https://example.com/a", 9, "asyncio runs tasks on one event loop thread"),
+        article("https://example.com/b", 8, "asyncio runs tasks on one event loop thread today"),
+        article("https://example.com/c", 7, "threads need locks"),
+    ]
+    kept = dedupe_excerpts(collect_excerpts("asyncio", articles))
+    assert [excerpt.url for excerpt in kept] == ["https://example.com/a", "https://example.com/c"]
+
+
+def test_build_answer_context_numbers_sources_and_covers_each_source_first():
+    articles = [
+        article("https://example.com/a", 9, "python asyncio first", "python asyncio second " + "detail " * 50),
+        article("https://example.com/b", 6, "python threads"),
+    ]
+    context = build_answer_context("python asyncio", articles, 30, estimate_tokens)
+    assert context == "[1] https://example.com/a\n- python asyncio first\n\n[2] https://example.com/b\n- python threads"
+
+    context = build_answer_context("python asyncio", articles, 10000, estimate_tokens)
+    assert context.startswith("[1] https://example.com/a\n- python asyncio first\n- python asyncio second")
+    assert context.endswith("[2] https://example.com/b\n- python threads")
+
+
+def test_build_answer_context_without_excerpts_is_empty():
+    assert build_answer_context("q", [article("https://example.com/", 9)], 100, estimate_tokens) == ""
@@ -0,0 +1,160 @@
+import time
+import asyncio
+
+from ai_web_search.crawler import Crawler, CrawlTask, CRAWL_MODE_BEST, CRAWL_MODE_FIFO
+from ai_web_search.dedup import minhash
+
+
+class Analyzed:
+    def __init__(self, url: str, rating: int, keywords=(), related_links=()) -> None:
+        self.url = url
+        self.relevance_rating = rating
+        self.keywords = list(keywords)
+        self.related_links = list(related_links)
+        self.tokens_saved = 0
+
+
+class FakeEngine:
+    """キーワードごとに決まった検索結果を返し、URL ごとに決まった評価をする SearchEngine の代わり"""
+
+    def __init__(self, results: dict, ratings: dict = None, links: dict = None, redirects: dict = None, titles: dict = None, texts: dict = None, delay: float = 0.01) -> None:
+        self.results = results
+        self.texts = texts or {}
+        self.titles = titles or {}
+        self.ratings = ratings or {}
+        self.links = links or {}
+        self.redirects = redirects or {}
+        self.delay = delay
+        self.searched = []
+        self.fetched = []
+        self.analyzed = []
+        self.running = 0
+        self.max_running = 0
+
+    async def search(self, query: str, max_results: int = 3) -> list[dict]:
+        self.searched.append(query)
+        await asyncio.sleep(self.delay)
+        return [{"href": url, "title": self.titles.get(url, "")} for url in self.results.get(query, [])]
+
+    async def fetch_page(self, url: str) -> tuple[str, str]:
+        self.fetched.append(url)
+        return self.redirects.get(url, url), self.texts.get(url, f"本文 {url}")
+
+    async def fingerprint(self, article_text: str):
+        return minhash(article_text)
+
+    async def analyze(self, question: str, url: str, keyword: str, **kwargs):
+        self.analyzed.append(url)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        return Analyzed(url, self.ratings.get(url, 8), related_links=self.links.get(url, ()))
+
+
+def crawl(crawler: Crawler, keywords: list[str]) -> list:
+    async def main():
+        return [event async for event in crawler.run(keywords)]
+    return asyncio.run(main())
+
+
+def test_crawl_follows_related_links_up_to_max_depth():
+    engine = FakeEngine({"k": ["a", "b"]}, links={"a": ["c"], "c": ["d"]})
+    crawler = Crawler(engine, "q", max_depth=3, max_threads=2, max_articles=10, article_quality=5)
+    crawl(crawler, ["k"])
+    assert engine.searched == ["k"]
+    assert sorted(engine.analyzed) == ["a", "b", "c"]
+    assert sorted(article.url for article in crawler.articles) == ["a", "b", "c"]
+
+
+def test_crawl_keeps_only_relevant_articles_up_to_max_articles():
+    engine = FakeEngine({"k": ["a", "b", "c", "d"]}, ratings={"a": 2})
+    crawler = Crawler(engine, "q", max_depth=2, max_threads=1, max_articles=2, article_quality=5)
+    crawl(crawler, ["k"])
+    assert [article.url for article in crawler.articles] == ["b", "c"]
+    assert "d" not in engine.analyzed
+
+
+def test_workers_analyze_articles_concurrently():
+    engine = FakeEngine({"k": ["a", "b", "c", "d"]}, delay=0.05)
+    crawler = Crawler(engine, "q", max_depth=2, max_threads=4, max_articles=10, article_quality=5)
+    crawl(crawler, ["k"])
+    assert len(crawler.articles) == 4
+    assert engine.max_running > 1
+
+
+def test_crawl_skips_urls_and_keywords_already_seen_in_the_run():
+    engine = FakeEngine(
+        {"Python": ["https://www.example.com/a#top", "http://example.com/a?utm_source=x"], "python ": ["https://example.com/b"]},
+        redirects={"https://example.com/b": "https://example.com/a"})
+    crawler = Crawler(engine, "q", max_depth=2, max_threads=1, max_articles=10, article_quality=5)
+    crawl(crawler, ["Python", "python "])
+    assert engine.searched == ["Python"]
+    assert engine.analyzed == ["https://www.example.com/a#top"]
+
+
+def test_priority_prefers_higher_scores_and_shallower_tasks():
+    best = CrawlTask(CrawlTask.ANALYZE, "a", "k", 2, 0.9)
+    worse = CrawlTask(CrawlTask.ANALYZE, "b", "k", 2, 0.5)
+    deeper = CrawlTask(CrawlTask.ANALYZE, "c", "k", 3, 0.9)
+    assert best.priority() < worse.priority()
+    assert best.priority() < deeper.priority()
+
+
+def test_best_first_analyzes_promising_results_first():
+    results = {"k": ["https://example.com/other", "https://example.com/match"]}
+    titles = {"https://example.com/match": "python asyncio tutorial"}
+
+    engine = FakeEngine(results, titles=titles)
+    crawl(Crawler(engine, "python asyncio", 2, 1, 10, 5, mode=CRAWL_MODE_BEST), ["k"])
+    assert engine.analyzed == ["https://example.com/match", "https://example.com/other"]
+
+    engine = FakeEngine(results, titles=titles)
+    crawl(Crawler(engine, "python asyncio", 2, 1, 10, 5, mode=CRAWL_MODE_FIFO), ["k"])
+    assert engine.analyzed == ["https://example.com/other", "https://example.com/match"]
+
+
+def test_crawl_stops_and_cancels_in_flight_work_at_max_articles():
+    engine = FakeEngine({"k": ["a", "b", "c"]}, links={"a": ["d"]}, delay=0.05)
+    crawler = Crawler(engine, "q", max_depth=3, max_threads=3, max_articles=1, article_quality=5)
+    events = crawl(crawler, ["k"])
+    assert len(crawler.articles) == 1
+    assert crawler.stop_reason is not None
+    assert events[-1].status == crawler.stop_reason
+    assert engine.running == 0
+    assert "d" not in engine.analyzed
+
+
+def test_crawl_stops_at_the_time_limit():
+    engine = FakeEngine({"k": ["a", "b"]}, delay=5)
+    crawler = Crawler(engine, "q", max_depth=2, max_threads=2, max_articles=10, article_quality=5, time_limit=0.05)
+    started = time.monotonic()
+    crawl(crawler, ["k"])
+    assert time.monotonic() - started < 1
+    assert "制限時間" in crawler.stop_reason
+    assert crawler.articles == []
+    assert engine.running == 0
+
+
+def test_top_results_are_prefetched_once_while_the_llm_is_busy():
+    engine = FakeEngine({"k": ["a", "b", "c"]}, links={"a": ["d", "e"]}, delay=0.02)
+    crawler = Crawler(engine, "q", max_depth=3, max_threads=1, max_articles=10, article_quality=5, prefetch_top_k=2)
+    crawl(crawler, ["k"])
+    assert sorted(engine.fetched) == ["a", "b", "c", "d", "e"]
+    assert crawler.prefetcher.prefetched == 4
+    assert crawler.prefetcher.used == 4
+    assert crawler.prefetcher.pending_bytes == 0
+
+
+def test_near_duplicate_pages_are_not_analyzed_twice():
+    article = " ".join(f"word{i}" for i in range(200))
+    engine = FakeEngine(
+        {"k": ["a", "b", "c", "d"]},
+        texts={"a": article, "b": article + " extra", "c": "ひらがなだけ", "d": "ひらがなだけ"})
+    crawler = Crawler(engine, "q", max_depth=2, max_threads=1, max_articles=10, article_quality=5)
+    crawl(crawler, ["k"])
+    # トークンの無い本文は署名が無いので、重複とはみなさずに解析する
+    assert engine.analyzed == ["a", "c", "d"]
+    assert crawler.duplicates_skipped == 1
@@ -0,0 +1,33 @@
+from ai_web_search.dedup import NUM_BINS, DuplicateIndex, minhash, similarity
+
+ARTICLE = " ".join(f"word{i}" for i in range(300))
+
+
+def test_minhash_is_stable_and_estimates_similarity():
+    signature = minhash(ARTICLE)
+    assert len(signature) == NUM_BINS
+    assert minhash(ARTICLE) == signature
+    assert similarity(signature, minhash(ARTICLE + " one more sentence here")) > 0.8
+    assert similarity(signature, minhash(" ".join(f"other{i}" for i in range(300)))) < 0.2
+
+
+def test_minhash_returns_none_without_tokens():
+    assert minhash("") is None
+    assert minhash("ひらがなだけ") is None
+    assert minhash("!!! ---") is None
+    assert minhash("Привет") is not None
+
+
+def test_duplicate_index_finds_near_duplicates_only():
+    index = DuplicateIndex(threshold=0.8)
+    index.add("a", minhash(ARTICLE))
+    key, score = index.find(minhash(ARTICLE.replace("word150", "changed")))
+    assert key == "a" and score >= 0.8
+    assert index.find(minhash(" ".join(f"other{i}" for i in range(300)))) is None
+
+
+def test_duplicate_index_ignores_missing_signatures():
+    index = DuplicateIndex()
+    index.add("empty", None)
+    assert index.signatures == {}
+    assert index.find(None) is None
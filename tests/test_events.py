@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from ai_web_search.events import ProgressEvent, StatusLog, coalesce
+
+
+def test_status_log_skips_repeats_and_keeps_the_last_lines():
+    log = StatusLog(max_lines=2)
+    assert log.append("a")
+    assert not log.append("a")
+    assert not log.append("")
+    log.append("b")
+    log.append("c")
+    assert log.text() == "... (1 行省略)\nb\nc"
+
+
+def test_progress_event_unpacks_like_a_tuple():
+    progress, status, result = ProgressEvent(0.5, "検索中")
+    assert (progress, status, result) == (0.5, "検索中", "")
+
+
+async def events(count: int, delay: float = 0.0, error: Exception = None):
+    for i in range(count):
+        await asyncio.sleep(delay)
+        yield i
+    if error:
+        raise error
+
+
+async def collect(source, interval: float) -> list:
+    return [batch async for batch in coalesce(source, interval)]
+
+
+def test_coalesce_yields_first_event_then_batches():
+    batches = asyncio.run(collect(events(5), interval=0.05))
+    assert batches[0] == [0]
+    assert sum(batches, []) == [0, 1, 2, 3, 4]
+    assert len(batches) < 5
+
+
+def test_coalesce_without_interval_keeps_every_event():
+    batches = asyncio.run(collect(events(3, delay=0.01), interval=0))
+    assert batches == [[0], [1], [2]]
+
+
+def test_coalesce_raises_errors_from_the_source():
+    with pytest.raises(ValueError):
+        asyncio.run(collect(events(2, error=ValueError("boom")), interval=0))
+
+
+def test_coalesce_cancels_the_source_when_the_consumer_stops():
+    cancelled = []
+
+    async def source():
+        try:
+            for i in range(100):
+                await asyncio.sleep(0.01)
+                yield i
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def main():
+        stream = coalesce(source(), interval=0)
+        async for batch in stream:
+            break
+        await stream.aclose()
+    asyncio.run(main())
+    assert cancelled == [True]
@@ -0,0 +1,29 @@
+import asyncio
+
+from ai_web_search.extractor import Extractor
+
+HTML = """<html><head><title>Asyncio guide</title></head><body><article>
+<h1>Asyncio guide</h1>
+<p>Asyncio lets a single thread wait on many sockets at once, which suits crawlers that spend most of their time on I/O.</p>
+<p>Tasks are scheduled on an event loop and switch only at await points, so shared state needs no locks between awaits.</p>
+</article></body></html>"""
+
+
+def extract(extractor: Extractor, html):
+    async def main():
+        try:
+            return await extractor.extract(html, "https://example.com/guide")
+        finally:
+            extractor.shutdown()
+    return asyncio.run(main())
+
+
+def test_extract_returns_none_without_html():
+    assert extract(Extractor(), None) is None
+
+
+def test_thread_and_process_pool_extract_the_same_text():
+    in_thread = extract(Extractor(), HTML)
+    in_process = extract(Extractor(workers=1, min_process_size=0), HTML)
+    assert "single thread wait on many sockets" in in_thread
+    assert in_process == in_thread
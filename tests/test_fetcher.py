@@ -0,0 +1,14 @@
+from ai_web_search.fetcher import FetchResult, detect_charset
+
+
+def test_detect_charset_prefers_header_then_meta_then_utf8():
+    body = '<meta charset="shift_jis"><p>日本語</p>'.encode("shift_jis")
+    assert detect_charset(body) == "shift_jis"
+    assert detect_charset("日本語".encode("utf-8"), "utf-8") == "utf-8"
+    assert detect_charset("日本語".encode("utf-8"), "no-such-charset") == "utf-8"
+
+
+def test_fetch_result_decodes_html_with_detected_charset():
+    body = '<meta charset="euc-jp"><p>本文</p>'.encode("euc-jp")
+    result = FetchResult("https://example.com/", "https://example.com/", 200, {}, body)
+    assert "本文" in result.html
@@ -0,0 +1,58 @@
+import asyncio
+
+import pytest
+
+from ai_web_search.history import HistoryStore
+
+ENTRIES = [
+    ["Pythonの非同期処理", "asyncio を使います。"],
+    ["Rust の所有権", "借用チェッカーが検査します。"],
+    ["100%_done", "特殊文字を含む問い合わせ"],
+]
+
+
+@pytest.fixture(params=[True, False], ids=["fts", "like"])
+def store(request, tmp_path) -> HistoryStore:
+    store = HistoryStore(str(tmp_path / "history.db"))
+
+    async def fill():
+        await store._run(store._connect)
+        # LIKE だけで検索する場合 (FTS5 が無い SQLite) も同じ結果になること
+        store.fts = store.fts and request.param
+        for query, answer in ENTRIES:
+            await store.add(query, answer)
+    asyncio.run(fill())
+    return store
+
+
+def queries(rows: list[list]) -> list[str]:
+    return [row[1] for row in rows]
+
+
+def test_page_lists_newest_first_with_preview(store):
+    rows = asyncio.run(store.page(limit=2))
+    assert queries(rows) == ["100%_done", "Rust の所有権"]
+    assert asyncio.run(store.count()) == 3
+    assert asyncio.run(store.get(rows[1][0]))[:2] == ("Rust の所有権", "借用チェッカーが検査します。")
+
+
+def test_search_matches_query_and_answer(store):
+    assert queries(asyncio.run(store.page(search="asyncio"))) == ["Pythonの非同期処理"]
+    assert queries(asyncio.run(store.page(search="非同期"))) == ["Pythonの非同期処理"]
+    assert asyncio.run(store.count(search="借用チェッカー")) == 1
+
+
+def test_short_and_special_search_terms_fall_back_to_like(store):
+    assert queries(asyncio.run(store.page(search="所有"))) == ["Rust の所有権"]
+    assert queries(asyncio.run(store.page(search="%_"))) == ["100%_done"]
+    assert asyncio.run(store.count(search="_")) == 1
+
+
+def test_migrate_imports_old_history_once(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    old = [["new", "b", "2024-01-02 00:00:00"], ["old", "a", "2024-01-01 00:00:00"], ["broken", "c"]]
+    assert asyncio.run(store.migrate(old)) == 3
+    assert asyncio.run(store.migrate(old)) == 0
+    rows = asyncio.run(store.page())
+    assert queries(rows) == ["broken", "new", "old"]
+    assert rows[1][3] == "2024-01-02 00:00:00"
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from ai_web_search import jobs
+from ai_web_search.jobs import JobStore, JobLost, QueueFull, JOB_CANCELLED, JOB_DONE, JOB_RUNNING
+
+
+def test_heartbeat_purges_finished_jobs_after_retention(tmp_path):
+    async def main():
+        store = JobStore(str(tmp_path / "jobs.db"), retention=0)
+        job_id = await store.submit({"query": "q"}, 10)
+        await store.claim("w")
+        await store.add_event(job_id, "w", 0.5, "回答中", "abc")
+        await store.add_event(job_id, "w", 1.0, "完了", "def", append=True)
+        events = await store.events(job_id)
+        await store.finish(job_id, "w", JOB_DONE, result="abcdef")
+        await store.heartbeat("w", [])
+        return events, await store.get(job_id), await store.events(job_id)
+
+    events, job, left = asyncio.run(main())
+    assert [event[3:] for event in events] == [("abc", False), ("def", True)]
+    assert job is None
+    assert left == []
+
+
+def test_stale_worker_cannot_write_to_a_requeued_job(tmp_path, monkeypatch):
+    async def main():
+        store = JobStore(str(tmp_path / "jobs.db"))
+        job_id = await store.submit({"query": "q"}, 10)
+        await store.claim("old")
+        # old のハートビートが途絶えたものとして、new がやり直す
+        monkeypatch.setattr(jobs, "STALE_AFTER", -1)
+        assert (await store.claim("new"))[0] == job_id
+        with pytest.raises(JobLost):
+            await store.add_event(job_id, "old", 0.5, "古い実行", "old")
+        finished = await store.finish(job_id, "old", JOB_DONE, result="old")
+        await store.requeue(job_id, "old")
+        return finished, await store.get(job_id), await store.events(job_id)
+
+    finished, job, events = asyncio.run(main())
+    assert not finished
+    assert job["status"] == JOB_RUNNING
+    assert job["result"] is None
+    assert events == []
+
+
+def test_submit_bounds_the_queue_and_cancel_follows_status(tmp_path):
+    async def main():
+        store = JobStore(str(tmp_path / "jobs.db"))
+        first = await store.submit({"query": "a"}, 2)
+        second = await store.submit({"query": "b"}, 2)
+        with pytest.raises(QueueFull):
+            await store.submit({"query": "c"}, 2)
+        claimed = await store.claim("w")
+        statuses = [await store.cancel(first), await store.cancel(second), await store.cancel("missing")]
+        cancelled = await store.heartbeat("w", [first])
+        return first, claimed, statuses, cancelled, await store.get(second), await store.counts()
+
+    first, claimed, statuses, cancelled, second, counts = asyncio.run(main())
+    assert claimed == (first, {"query": "a"})
+    assert statuses == [JOB_RUNNING, JOB_CANCELLED, None]
+    assert cancelled == [first]
+    assert second["status"] == JOB_CANCELLED
+    assert counts == {JOB_RUNNING: 1, JOB_CANCELLED: 1}
@@ -0,0 +1,69 @@
+from ai_web_search.lexical import (
+    PREFILTER_LOG, PREFILTER_ON, RelevanceGate, estimate_tokens, overlap_score, select_chunks, tokenize)
+
+
+def test_tokenize_words_and_cjk_bigrams():
+    assert tokenize("The Python tutorial") == ["python", "tutorial"]
+    assert tokenize("東京都") == ["東京", "京都"]
+    assert tokenize("Ｐｙｔｈｏｎ 3") == ["python", "3"]
+    assert tokenize("") == []
+
+
+def test_tokenize_keeps_accented_latin_and_other_scripts():
+    assert tokenize("Café für Straße") == ["café", "für", "strasse"]
+    assert tokenize("Привет, мир") == ["привет", "мир"]
+    assert tokenize("snake_case") == ["snake", "case"]
+
+
+def test_tokenize_drops_hiragana_only_bigrams():
+    assert tokenize("ひらがなだけ") == []
+    assert tokenize("東京のてんき") == ["東京", "京の"]
+
+
+def test_overlap_score_is_the_share_of_query_tokens_in_text():
+    assert overlap_score("python asyncio", "An asyncio guide for Python") == 1.0
+    assert overlap_score("python asyncio", "A guide for Python") == 0.5
+    assert overlap_score("", "anything") == 0.0
+
+
+def test_select_chunks_keeps_short_text_as_is():
+    text = "# Title\n\nshort body"
+    assert select_chunks(text, "python", 100) is text
+
+
+def test_select_chunks_keeps_head_and_relevant_sections_in_order():
+    filler = " ".join(["lorem ipsum dolor"] * 40)
+    text = "\n\n".join([
+        "# Guide",
+        f"## Cooking\n\n{filler}",
+        "## Asyncio\n\nasyncio event loop tasks in python",
+        f"## Gardening\n\n{filler}",
+        "## Python\n\npython asyncio examples",
+    ])
+    selected = select_chunks(text, "python asyncio", 40, max_chunk_tokens=200)
+    assert selected.startswith("# Guide")
+    assert selected.index("## Asyncio") < selected.index("## Python")
+    assert "Cooking" not in selected and "Gardening" not in selected
+    assert "[...]" in selected
+    assert estimate_tokens(selected) <= 40 + estimate_tokens("[...]") * 2
+
+
+def test_relevance_gate_drops_unrelated_articles_only_when_on():
+    gate = RelevanceGate(threshold=0.3, mode=PREFILTER_ON)
+    assert gate.check("Python asyncio tutorial", "python asyncio")[0]
+    keep, score = gate.check("A recipe for bread", "python asyncio")
+    assert not keep and score == 0.0
+
+    log_only = RelevanceGate(threshold=0.3, mode=PREFILTER_LOG)
+    assert log_only.enabled
+    assert log_only.check("A recipe for bread", "python asyncio") == (True, 0.0)
+
+
+def test_relevance_gate_weights_rare_query_tokens_higher():
+    gate = RelevanceGate()
+    for _ in range(5):
+        gate.score("python guide", "python")
+    common = gate.score("python", "python asyncio")
+    rare = gate.score("asyncio", "python asyncio")
+    assert rare > common > 0.0
+    assert gate.score("anything", "the") == 1.0
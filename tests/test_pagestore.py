@@ -0,0 +1,80 @@
+import asyncio
+
+from ai_web_search.pagestore import PageStore, StoredPage
+from ai_web_search.retrieval import LocalIndex
+
+
+def test_same_text_is_stored_once_and_changes_are_reported(tmp_path):
+    async def main():
+        store = PageStore(str(tmp_path / "pages.db"))
+        text = "同じ本文 " * 100
+        assert await store.save("a", "a", text, 200, {"ETag": '"v1"'})
+        assert await store.save("b", "b", text)
+        assert not await store.save("a", "a", text, 200, {"etag": '"v2"'})
+        assert await store.save("a", "a", text + "追記")
+        store.memory.delete("b")
+        return await store.stats(), await store.load("b")
+
+    stats, page = asyncio.run(main())
+    assert stats["pages"] == 2
+    assert stats["contents"] == 2
+    assert stats["stored_bytes"] < stats["bytes"]
+    assert page.text == "同じ本文 " * 100
+
+
+def test_stored_page_revalidation_headers():
+    page = StoredPage("u", "u", "本文", 200, '"v1"', "Mon, 01 Jan 2024 00:00:00 GMT", 0)
+    assert not page.is_fresh()
+    assert page.conditional_headers() == {"If-None-Match": '"v1"', "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"}
+    assert StoredPage("u", "u", "本文", 200, None, None, 0).conditional_headers() == {}
+
+
+def test_prune_removes_old_pages_and_unused_contents(tmp_path):
+    async def main():
+        store = PageStore(str(tmp_path / "pages.db"))
+        await store.save("old", "old", "古い本文")
+        await store.save("new", "new", "新しい本文")
+        await store._run(store._touch_sync, "old", 0)
+        return await store.prune(), await store.stats()
+
+    pruned, stats = asyncio.run(main())
+    assert pruned == {"pages": 1, "contents": 1}
+    assert stats["pages"] == 1
+
+
+def test_unreadable_page_is_a_miss(tmp_path):
+    async def main():
+        store = PageStore(str(tmp_path / "pages.db"))
+        await store.save("u", "u", "本文")
+
+        def corrupt():
+            conn = store._connect()
+            conn.execute("UPDATE contents SET codec = 'zlib', data = x'00'")
+            conn.commit()
+        await store._run(corrupt)
+        store.memory.delete("u")
+        page = await store.load("u")
+        return page, await store.stats()
+
+    page, stats = asyncio.run(main())
+    assert page is None
+    assert stats["pages"] == 0
+    assert stats["contents"] == 0
+
+
+def test_save_evicts_oldest_pages_from_store_and_index(tmp_path):
+    async def main():
+        index = LocalIndex(str(tmp_path / "index.db"))
+        store = PageStore(str(tmp_path / "pages.db"), index=index, max_bytes=2000)
+        for i in range(20):
+            text = f"page{i} " + "".join(chr(0x3042 + (i * 7 + j) % 80) for j in range(400))
+            await store.save(f"u{i}", f"u{i}", text)
+            await index.add(f"u{i}", text)
+        await index.wait_pending()
+        return store, await store.stats(), await index.stats(), await store.load("u0"), await store.load("u19")
+
+    store, stats, index_stats, oldest, newest = asyncio.run(main())
+    assert stats["stored_bytes"] <= 2000
+    assert oldest is None
+    assert newest is not None
+    assert index_stats["docs"] == stats["pages"]
@@ -0,0 +1,77 @@
+import sys
+import asyncio
+
+import pytest
+
+from ai_web_search.retrieval import EmbeddingBackend, LocalIndex, SentenceTransformerBackend
+
+PAGES = {
+    "https://example.com/asyncio": "Python asyncio の使い方。イベントループとタスク。",
+    "https://example.com/threads": "Python のスレッドとロック。",
+    "https://example.com/rust": "Rust の所有権と借用。",
+}
+
+
+def make_index(tmp_path, embedding=None) -> LocalIndex:
+    index = LocalIndex(str(tmp_path / "index.db"), embedding=embedding)
+
+    async def fill():
+        for url, text in PAGES.items():
+            await index.add(url, text)
+    asyncio.run(fill())
+    return index
+
+
+def urls(results: list) -> list[str]:
+    return [url for url, _ in results]
+
+
+def test_search_ranks_pages_by_bm25(tmp_path):
+    index = make_index(tmp_path)
+    assert urls(asyncio.run(index.search("asyncio イベントループ"))) == ["https://example.com/asyncio"]
+    assert urls(asyncio.run(index.search("python")))[0] != "https://example.com/rust"
+    assert asyncio.run(index.search("")) == []
+    assert asyncio.run(index.stats())["docs"] == 3
+
+
+def test_add_replaces_and_delete_removes_pages(tmp_path):
+    index = make_index(tmp_path)
+
+    async def main():
+        await index.add("https://example.com/rust", "Go の goroutine")
+        assert urls(await index.search("所有権")) == []
+        assert urls(await index.search("goroutine")) == ["https://example.com/rust"]
+        assert await index.delete(["https://example.com/rust", "https://example.com/missing"]) == 1
+        assert await index.search("goroutine") == []
+        return await index.stats()
+    assert asyncio.run(main())["docs"] == 2
+
+
+def test_add_in_background_is_searchable_after_wait_pending(tmp_path):
+    index = LocalIndex(str(tmp_path / "index.db"))
+
+    async def main():
+        index.add_in_background("https://example.com/a", "バックグラウンドで索引に追加")
+        index.add_in_background("https://example.com/empty", "")
+        await index.wait_pending()
+        return await index.search("索引")
+    assert urls(asyncio.run(main())) == ["https://example.com/a"]
+
+
+class KeywordEmbedding(EmbeddingBackend):
+    """「借用」を含むかどうかだけを表す2次元の埋め込み"""
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        return [[1.0, 0.0] if "借用" in text else [0.0, 1.0] for text in texts]
+
+
+def test_embedding_reranks_bm25_candidates(tmp_path):
+    index = make_index(tmp_path, embedding=KeywordEmbedding())
+    results = asyncio.run(index.search("Python 借用"))
+    assert urls(results)[0] == "https://example.com/rust"
+
+
+def test_sentence_transformer_backend_reports_missing_package(monkeypatch):
+    monkeypatch.setitem(sys.modules, "sentence_transformers", None)
+    with pytest.raises(ImportError, match="pip install sentence-transformers"):
+        SentenceTransformerBackend()
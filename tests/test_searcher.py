@@ -0,0 +1,169 @@
+import asyncio
+
+from ai_web_search import searcher
+from ai_web_search.cache import TieredCache
+
+
+class FakeModelManager:
+    def __init__(self) -> None:
+        self.model = "model-a"
+
+    def get_current_model(self) -> str:
+        return self.model
+
+    def change_model(self, model: str):
+        self.model = model
+
+
+class FakeAssistant:
+    def __init__(self) -> None:
+        self.model_manager = FakeModelManager()
+        self.calls = 0
+        self.messages = []
+        self.reply = lambda system, message: {"answer": message}
+
+    async def chat(self, system, message, use_cache=True, json_mode=False):
+        self.calls += 1
+        self.messages.append(message)
+        return self.reply(system, message)
+
+
+def make_engine(monkeypatch, tmp_path, **kwargs) -> searcher.SearchEngine:
+    monkeypatch.setattr(searcher, "ChatAssistant", FakeAssistant)
+    return searcher.SearchEngine("duckduckgo", cache=TieredCache(str(tmp_path / "cache.db")), **kwargs)
+
+
+def test_cached_chat_reuses_result_until_model_or_content_changes(monkeypatch, tmp_path):
+    engine = make_engine(monkeypatch, tmp_path)
+
+    async def main():
+        await engine.cached_chat("tpl", ["Python"], "本文", "", "msg", json_mode=True)
+        await engine.cached_chat("tpl", [" python "], "本文", "", "msg", json_mode=True)
+        assert engine.assistant.calls == 1
+        await engine.cached_chat("tpl", ["Python"], "別の本文", "", "msg", json_mode=True)
+        assert engine.assistant.calls == 2
+        engine.assistant.model_manager.model = "model-b"
+        await engine.cached_chat("tpl", ["Python"], "本文", "", "msg", json_mode=True)
+        assert engine.assistant.calls == 3
+    asyncio.run(main())
+
+
+def test_cached_chat_can_be_bypassed(monkeypatch, tmp_path):
+    engine = make_engine(monkeypatch, tmp_path, use_llm_cache=False)
+
+    async def main():
+        for _ in range(2):
+            await engine.cached_chat("tpl", ["Python"], "本文", "", "msg", json_mode=True)
+        assert engine.assistant.calls == 2
+    asyncio.run(main())
+
+
+ITEMS = [(f"https://example.com/{i}", "python", f"本文 {i}") for i in range(3)]
+
+
+def batch_reply(malformed: bool):
+    def reply(system, message):
+        urls = message.split("\n")
+        if len(urls) == 1:
+            return {"Relevance rating": 7}
+        if malformed:
+            return "not json"
+        return {"results": [{"URL": url, "Relevance rating": 9} for url in urls]}
+    return reply
+
+
+def test_analyze_batch_packs_articles_into_one_call(monkeypatch, tmp_path):
+    engine = make_engine(monkeypatch, tmp_path)
+    engine.assistant.reply = batch_reply(malformed=False)
+    results = asyncio.run(engine.analyze_batch("q", ITEMS + [("https://example.com/x", "python", None)]))
+    assert engine.assistant.calls == 1
+    assert [result.relevance_rating for result in results[:3]] == [9, 9, 9]
+    assert [result.url for result in results[:3]] == [url for url, _, _ in ITEMS]
+    assert results[3] is None
+
+
+def test_analyze_batch_splits_and_retries_malformed_output(monkeypatch, tmp_path):
+    engine = make_engine(monkeypatch, tmp_path)
+    engine.assistant.reply = batch_reply(malformed=True)
+    results = asyncio.run(engine.analyze_batch("q", ITEMS))
+    assert [result.relevance_rating for result in results] == [7, 7, 7]
+    # 3件 -> 1件 + 2件 -> 1件 + 1件
+    assert sorted(len(message.split("\n")) for message in engine.assistant.messages) == [1, 1, 1, 2, 3]
+
+    # 壊れた応答はキャッシュされず、1件ずつの解析結果だけが再利用される
+    engine.assistant.messages.clear()
+    asyncio.run(engine.analyze_batch("q", ITEMS))
+    assert sorted(len(message.split("\n")) for message in engine.assistant.messages) == [2, 3]
+
+
+def test_analyze_batch_retries_only_missing_articles(monkeypatch, tmp_path):
+    engine = make_engine(monkeypatch, tmp_path, use_llm_cache=False)
+
+    def reply(system, message):
+        urls = message.split("\n")
+        if len(urls) == 1:
+            return {"Relevance rating": 7}
+        return [{"URL": urls[0], "Relevance rating": 9}]
+    engine.assistant.reply = reply
+    results = asyncio.run(engine.analyze_batch("q", ITEMS))
+    assert [result.relevance_rating for result in results] == [9, 9, 7]
+
+
+def test_incremental_markdown_renders_only_new_complete_blocks():
+    renderer = searcher.IncrementalMarkdown()
+    first = renderer.render("# Title\n\nfirst para")
+    assert first == "<h1>Title</h1>\n<p>first para</p>"
+    rendered = renderer.source
+    renderer.render("# Title\n\nfirst paragraph\n\nsecond")
+    assert renderer.source.startswith(rendered)
+    assert renderer.source == "# Title\n\nfirst paragraph\n\n"
+
+    text = "# Title\n\nfirst paragraph\n\n```\ncode\n\nmore\n```\n\nend"
+    assert renderer.render(text, final=True) == searcher.markdown.markdown(text)
+    partial = renderer.render(text[:text.index("more")])
+    assert "<code>" not in renderer.html
+    assert partial.startswith(renderer.html)
+
+
+def test_incremental_markdown_restarts_when_text_is_rewritten():
+    renderer = searcher.IncrementalMarkdown()
+    renderer.render("a\n\nb\n\n")
+    assert renderer.render("x\n\ny") == "<p>x</p>\n<p>y</p>"
+
+
+def test_engine_pool_reuses_engines_and_pins_the_model_per_run(monkeypatch, tmp_path):
+    created = []
+
+    def factory(engine: str) -> searcher.SearchEngine:
+        created.append(engine)
+        return make_engine(monkeypatch, tmp_path)
+
+    pool = searcher.EnginePool(factory, max_engines=1)
+    first = pool.get("DuckDuckGo", "model-a")
+    second = pool.get("duckduckgo ", "model-b")
+    assert created == ["DuckDuckGo"]
+    assert first.cache is second.cache
+    assert first.assistant.model_manager.get_current_model() == "model-a"
+    assert second.assistant.model_manager.get_current_model() == "model-b"
+
+    # 実行中のモデル切り替えは共有のエンジンに残らない
+    first.assistant.model_manager.change_model("fallback")
+    assert pool.get("duckduckgo", "model-a").assistant.model_manager.get_current_model() == "model-a"
+
+    pool.get("google", "model-a")
+    pool.get("duckduckgo", "model-a")
+    assert created == ["DuckDuckGo", "google", "duckduckgo"]
+
+
+def test_fingerprint_caches_signatures_but_not_missing_ones(monkeypatch, tmp_path):
+    engine = make_engine(monkeypatch, tmp_path)
+
+    async def main():
+        assert await engine.fingerprint("ひらがなだけ") is None
+        signature = await engine.fingerprint("python asyncio event loop tasks")
+        assert signature is not None
+        assert await engine.fingerprint("python asyncio event loop tasks") == signature
+        return engine.cache.get_stats()
+    stats = asyncio.run(main())
+    assert stats["memory_hits"] == 1
+    assert stats["misses"] == 2
@@ -0,0 +1,48 @@
+import asyncio
+
+from ai_web_search.singleflight import SingleFlight
+
+
+async def slow(value, started=None):
+    if started is not None:
+        started.set()
+    await asyncio.sleep(0.05)
+    return value
+
+
+def test_concurrent_calls_share_one_run():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def work(value):
+            calls.append(value)
+            return await slow(value)
+
+        results = await asyncio.gather(*(flight.run("u", work, i) for i in range(3)))
+        return results, calls
+
+    results, calls = asyncio.run(main())
+    assert results == [0, 0, 0]
+    assert calls == [0]
+
+
+def test_call_after_last_waiter_cancelled_starts_a_new_run():
+    async def main():
+        flight = SingleFlight()
+        started = asyncio.Event()
+        first = asyncio.create_task(flight.run("u", slow, "first", started))
+        await started.wait()
+        first.cancel()
+        # 最後の待ち手が外れた直後 (共有タスクの完了コールバックより前) に同じキーで呼ぶ
+        await asyncio.sleep(0)
+        second = await flight.run("u", slow, "second")
+        try:
+            await first
+        except asyncio.CancelledError:
+            pass
+        return first.cancelled(), second
+
+    cancelled, second = asyncio.run(main())
+    assert cancelled
+    assert second == "second"
@@ -0,0 +1,59 @@
+import json
+import asyncio
+
+import pytest
+
+from ai_web_search.tracing import Trace, annotate, current_trace, span
+
+
+def run_traced(trace: Trace, coro):
+    async def main():
+        current_trace.set(trace)
+        return await coro()
+    return asyncio.run(main())
+
+
+def test_spans_record_parents_attributes_and_errors():
+    trace = Trace("run1", query="python")
+
+    async def work():
+        with span("search", keyword="python"):
+            with span("fetch", url="https://example.com/"):
+                annotate(bytes=1024, cache="hit")
+        with pytest.raises(ValueError):
+            with span("llm"):
+                raise ValueError("boom")
+    run_traced(trace, work)
+
+    search, fetch, llm = trace.spans
+    assert fetch.parent_id == search.span_id
+    assert search.parent_id is None
+    assert fetch.attrs == {"url": "https://example.com/", "bytes": 1024, "cache": "hit"}
+    assert llm.attrs["status"] == "error"
+    summary = trace.summary()
+    assert summary["stages"]["fetch"]["count"] == 1
+    assert (summary["bytes"], summary["cache_hits"], summary["cache_misses"]) == (1024, 1, 0)
+
+
+def test_span_without_trace_records_nothing():
+    with span("search") as item:
+        annotate(bytes=1)
+    assert item.span_id == 0
+    assert current_trace.get() is None
+
+
+def test_export_writes_jsonl_and_chrome_trace(tmp_path):
+    trace = Trace("run2", query="python")
+
+    async def work():
+        with span("search"):
+            pass
+    run_traced(trace, work)
+
+    jsonl_path, chrome_path = trace.export(str(tmp_path))
+    lines = [json.loads(line) for line in open(jsonl_path, encoding="utf-8")]
+    assert lines[0]["run_id"] == "run2" and lines[0]["query"] == "python"
+    assert lines[1]["name"] == "search"
+    with open(chrome_path, encoding="utf-8") as f:
+        events = json.load(f)["traceEvents"]
+    assert [event["ph"] for event in events] == ["X", "M"]
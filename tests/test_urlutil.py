@@ -0,0 +1,24 @@
+from ai_web_search.urlutil import canonicalize_url, normalize_keyword
+
+
+def test_canonicalize_url_ignores_scheme_www_fragment_and_tracking_params():
+    assert canonicalize_url("http://WWW.Example.com:80/path/?utm_source=x&b=2&a=1#top") == "https://example.com/path?a=1&b=2"
+    assert canonicalize_url("https://example.com") == "https://example.com/"
+    assert canonicalize_url("https://example.com//a//b/") == "https://example.com/a/b"
+
+
+def test_canonicalize_url_keeps_meaningful_differences():
+    assert canonicalize_url("https://example.com:8443/a") == "https://example.com:8443/a"
+    assert canonicalize_url("https://example.com/a?id=1") != canonicalize_url("https://example.com/a?id=2")
+    assert canonicalize_url("https://example.com/%7Euser") == canonicalize_url("https://example.com/~user")
+
+
+def test_canonicalize_url_leaves_other_schemes_alone():
+    assert canonicalize_url("mailto:someone@example.com") == "mailto:someone@example.com"
+    assert canonicalize_url("") == ""
+
+
+def test_normalize_keyword_ignores_case_width_and_spaces():
+    assert normalize_keyword("  Python　入門 ") == "python 入門"
+    assert normalize_keyword("ＰＹＴＨＯＮ") == "python"
+    assert normalize_keyword("") == ""